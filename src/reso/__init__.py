@@ -1 +1 @@
-from . import palette, regionmapper, resoboard
+from . import palette, regionmapper, profiling, netlist, cache, resoboard, output
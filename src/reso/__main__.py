@@ -1,16 +1,37 @@
 import argparse
+import asyncio
+import glob
+import os
+import sys
 from math import log, ceil
 from time import time
-import numpy as np
-from PIL import Image
-from .resoboard import ResoBoard
+from .resoboard import ResoBoard, ENGINES
+from .cache import BoardCache, DEFAULT_CACHE_DIR, DEFAULT_MAX_BYTES
+from .output import PNGWriterPool, IndexedFrames, GIFWriter, APNGWriter, RawWriter
+from .trace import write_trace
+from .stream import serve_board
+from .profiling import Profiler
+from .batch import expand_boards, run_batch, write_report, print_summary
 
 def main(
     load_filename,
     save_prefix,
     iterations = 1,
     save_each_iteration = True,
-    V = False):
+    V = False,
+    cache = None,
+    detect_cycles = False,
+    writer = None,
+    animation = None,
+    raw = False,
+    frame_duration = 100,
+    trace = None,
+    memmap_dir = None,
+    profile = None,
+    engine = "object",
+    indexed = False,
+    serve = None,
+    tick_rate = None):
     """Wraps the logic in 'resoboard' for simulating, exporting, etc.
     
     Used in the actual '__main__' of this function, with parameters passed from
@@ -18,7 +39,8 @@ def main(
     
     :param load_filename: location from which to load the image from
     :type load_filename: String
-    :param save_prefix: location to save the file to.
+    :param save_prefix: location to save the file to. May be None to not save
+        any PNGs, e.g. when streaming an animation, raw frames or a trace.
     :type save_prefix: String
     :param iterations: Number of simulation steps to update the circuit.
     :type iterations: Int
@@ -26,52 +48,207 @@ def main(
     :type save_each_iteration: Bool
     :param V: If True, print verbose output while running
     :type V: Bool
+    :param cache: If given, load the compiled board from (or save it to) this cache
+    :type cache: cache.BoardCache
+    :param detect_cycles: If True, skip over the periods of a periodic board, and
+        report the transient length and period found. (Only when not saving
+        every iteration.)
+    :type detect_cycles: Bool
+    :param writer: The PNGWriterPool to save images with. Defaults to one with
+        a worker thread per CPU.
+    :type writer: output.PNGWriterPool
+    :param animation: If given, stream every iteration into this animated
+        image instead of saving a PNG per iteration. A GIF if it ends with
+        '.gif', and an APNG otherwise.
+    :type animation: String
+    :param raw: If True, stream every iteration to stdout as raw RGB bytes
+        instead of saving a PNG per iteration. (Verbose output goes to stderr.)
+    :type raw: Bool
+    :param frame_duration: Milliseconds to show every frame of the animation for.
+    :type frame_duration: Int
+    :param trace: If given, save a trace of every iteration here (see trace.py)
+        instead of saving a PNG per iteration.
+    :type trace: String
+    :param memmap_dir: If given, memory-map the image and resel map from
+        temporary files in this directory, for boards larger than RAM.
+    :type memmap_dir: String
+    :param profile: If given, time every phase of the run and save a JSON
+        report here (see profiling.py), or print it if this is '-'.
+    :type profile: String
+    :param engine: The engine to simulate the board with (see resoboard.ENGINES).
+    :type engine: String
+    :param indexed: If True, save 8-bit palette PNGs straight from the resel
+        map, rather than RGB PNGs of the image. (Colors that aren't resels
+        are saved as black.)
+    :type indexed: Bool
+    :param serve: If given, push the wires that change every iteration to
+        live viewers (see stream.py) instead of saving a PNG per iteration:
+        a TCP port on localhost if it's a number, or else the location of a
+        Unix socket.
+    :type serve: String
+    :param tick_rate: If given, while serving, run at most this many
+        iterations per second.
+    :type tick_rate: Float
+    
+    :raises ValueError: If more than one of a trace, serving, and an
+        animation (or raw frames) are asked for. (Each runs the whole
+        simulation.)
+    
+    :returns: The board, after iterating.
+    :rtype: resoboard.ResoBoard
     """
+    if (trace is not None) + (serve is not None) + (animation is not None or raw) > 1:
+        raise ValueError("Only one of a trace, serving, or an animation (or raw frames) at a time")
+    if writer is None:
+        writer = PNGWriterPool()
     
     # See this ugly variable here?
     # This is why Python gave us fstrings.
     # todo: Use fstring magic throughout and see if things still print right.
     num_digits_in_fname = ceil(log(iterations+.1,10))
     
+    # Don't mix messages into a stream of raw frames.
+    messages = sys.stderr if raw else sys.stdout
     if V:
-        print(f"Loading {load_filename} and iterating {iterations} time(s)...")
-        print(f"    and then saving to {save_prefix}x{*num_digits_in_fname}.png")
+        print(f"Loading {load_filename} and iterating {iterations} time(s)...", file = messages)
+        if save_prefix is not None:
+            print(f"    and then saving to {save_prefix}{'x'*num_digits_in_fname}.png", file = messages)
+    
+    profiler = None if profile is None else Profiler()
     
     # Instantiate our ResoBoard
     compile_start = time()
-    RB = ResoBoard(load_filename)
+    RB = ResoBoard(load_filename, cache = cache, memmap_dir = memmap_dir, profiler = profiler,
+                   engine = engine)
     compile_end = time()
     
+    # Palette PNGs are saved from the resel map, so that's what is kept
+    # up-to-date, rather than the image.
+    update_resels, update_image = indexed, not indexed
+    palette = RB.get_resel_palette() if indexed else None
+    def save(ii):
+        save_loc = save_prefix + str(ii).zfill(num_digits_in_fname) + ".png"
+        writer.submit(RB.get_resel_map() if indexed else RB.get_image(), save_loc, palette = palette)
+    
     if V:
-        print(f"... Compiled in {compile_end - compile_start:.2f} seconds! Iterating now.")
+        print(f"... Compiled in {compile_end - compile_start:.2f} seconds! Iterating now.", file = messages)
     
     # Simulation!
     iter_start = time()
-    for ii in range(iterations):
-        if save_each_iteration:
-            # todo: Saving should use async/await concurrency magic.
-            save_loc = save_prefix + str(ii).zfill(num_digits_in_fname) + ".png"
-            Image.fromarray(np.swapaxes(RB.get_image(),0,1)).save(save_loc)
+    if trace is not None or animation is not None or raw or serve is not None:
+        if serve is not None:
+            address = dict(port = int(serve)) if serve.isdigit() else dict(path = serve)
+            asyncio.run(serve_board(RB, iterations, ticks_per_second = tick_rate,
+                                    messages = messages, **address))
+        elif trace is not None:
+            write_trace(RB, iterations, trace)
+        else:
+            stream_frames(RB, iterations, animation, raw, frame_duration, writer.compress_level)
         if V:
-            print("Iteration: ",ii)
-        # update_image is true if we're on our last iteration.
-        update_image = save_each_iteration or ii == iterations - 1
-        RB.iterate(update_resels = False, update_image = update_image )
+            print(f"Streamed {iterations + 1} frames in {time() - iter_start:.2f} seconds!", file = messages)
+        if save_prefix is None:
+            write_profile(profiler, profile, messages)
+            return RB
+        # The frames are painted separately, so bring the image up to date
+        # (run(0) just repaints it) before saving the last iteration below.
+        RB.run(0, update_resels = update_resels, update_image = update_image)
+    elif save_each_iteration and save_prefix is not None:
+        for ii in range(iterations):
+            # The writer compresses and saves in the background, so the next
+            # iteration runs while this one is being saved.
+            with RB._profiler.phase("save"):
+                save(ii)
+            if V:
+                print("Iteration: ",ii)
+            RB.iterate(update_resels = update_resels, update_image = update_image)
+    else:
+        # Nothing to save until the end, so run every tick in one call.
+        RB.run(iterations, update_resels = update_resels, update_image = update_image,
+               detect_cycles = detect_cycles)
+        if detect_cycles:
+            if RB.get_cycle() is None:
+                print(f"No cycle found in {iterations} iteration(s).")
+            else:
+                transient, period = RB.get_cycle()
+                print(f"Found a cycle: transient length {transient}, period {period}.")
     
     iter_end = time()
     # Last iteration, always saved
     if V:
-        print(f"Iteration: {iterations}")
-        print(f"Completed {iterations + 1} steps in {iter_end - iter_start:.2f} seconds!")
-    save_loc = save_prefix + str(iterations).zfill(num_digits_in_fname) + ".png"
-    Image.fromarray(np.swapaxes(RB.get_image(),0,1)).save(save_loc)
+        print(f"Iteration: {iterations}", file = messages)
+        print(f"Completed {iterations + 1} steps in {iter_end - iter_start:.2f} seconds!", file = messages)
+    with RB._profiler.phase("save"):
+        if save_prefix is not None:
+            save(iterations)
+        writer.close()
+    if V:
+        print(f"Saved everything in {time() - iter_start:.2f} seconds!", file = messages)
+    write_profile(profiler, profile, messages)
+    return RB
+
+
+def write_profile(profiler, profile, messages = sys.stdout):
+    """Save (or print, if profile is '-') the report of a profiler, if any.
     
+    :param profiler: The profiler, or None to do nothing.
+    :type profiler: profiling.Profiler
+    :param profile: Location to save the JSON report to, or '-' to print it.
+    :type profile: String
+    :param messages: Where to print the report to.
+    :type messages: file object
+    """
+    if profiler is None:
+        return
+    profiler.write_json(messages if profile == "-" else profile)
+
+
+def stream_frames(RB, iterations, animation = None, raw = False, frame_duration = 100,
+                  compress_level = 6):
+    """Iterate a board, streaming every frame into an animation and/or stdout.
+    
+    :param RB: The board to iterate
+    :type RB: resoboard.ResoBoard
+    :param iterations: Number of simulation steps to update the circuit.
+    :type iterations: Int
+    :param animation: If given, location of the GIF (if it ends with '.gif') or
+        APNG to stream the frames into.
+    :type animation: String
+    :param raw: If True, stream the frames to stdout as raw RGB bytes.
+    :type raw: Bool
+    :param frame_duration: Milliseconds to show every frame of the animation for.
+    :type frame_duration: Int
+    :param compress_level: zlib compression level of the APNG, from 0 to 9.
+    :type compress_level: Int
+    """
+    frames = IndexedFrames(RB, iterations)
+    width, height = RB.get_image().shape[:2]
+    streams = []
+    if animation is not None:
+        if animation.lower().endswith(".gif"):
+            streams.append(GIFWriter(animation, frames.palette, width, height,
+                                     duration = frame_duration))
+        else:
+            streams.append(APNGWriter(animation, frames.palette, width, height,
+                                      duration = frame_duration, compress_level = compress_level))
+    if raw:
+        streams.append(RawWriter(sys.stdout.buffer, frames.palette))
+    
+    try:
+        for frame, box in frames:
+            for stream in streams:
+                stream.write_frame(frame, box)
+    finally:
+        for stream in streams:
+            stream.close()
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Reso - graphical circuit design cellular automata")
-    parser.add_argument("load_location", help="Location to load image from.",
-                        type=str, nargs=1)
+    parser.add_argument("load_location",
+                        help="Location to load image from. Several locations, or glob patterns "
+                             "(e.g. 'tests/testing/*.png'), simulate every board in a pool of "
+                             "processes (see --processes), saving to SAVE<name>_xx.png.",
+                        type=str, nargs="*")
     parser.add_argument("--save", "-s", help="Prefix to save images to.",
                         type=str, nargs=1)
     parser.add_argument("--numiter","-n",
@@ -82,19 +259,163 @@ if __name__ == '__main__':
                         action="store_true")
     parser.add_argument("--verbose","-v", help="Print extra information; useful for debugging.",
                         action="store_true")
+    parser.add_argument("--cache-dir",
+                        help=f"Directory to cache compiled boards in. Defaults to {DEFAULT_CACHE_DIR}",
+                        type=str, nargs=1)
+    parser.add_argument("--cache-size",
+                        help=f"Maximum size of the cache, in MiB. Least recently used boards are "
+                             f"deleted past this. Defaults to {DEFAULT_MAX_BYTES // 2**20}.",
+                        type=int, nargs=1)
+    parser.add_argument("--detect-cycles", "-c",
+                        help="With --outputlast, detect when the board repeats itself, skip "
+                             "straight to the last iteration, and print the transient length "
+                             "and period.",
+                        action="store_true")
+    parser.add_argument("--workers", "-j",
+                        help="Number of threads saving images in the background. 0 saves "
+                             "every image before moving on. Defaults to the number of CPUs.",
+                        type=int, nargs=1)
+    parser.add_argument("--compress-level",
+                        help="PNG compression level, from 0 (fastest) to 9 (smallest). Defaults to 6.",
+                        type=int, nargs=1)
+    parser.add_argument("--max-pending",
+                        help="Most images waiting to be saved at once, before the simulation "
+                             "waits for them. Defaults to twice the number of workers.",
+                        type=int, nargs=1)
+    parser.add_argument("--animate", "-a",
+                        help="Stream every iteration into one animated image, instead of saving "
+                             "a PNG per iteration. A GIF if it ends with .gif, an APNG otherwise.",
+                        type=str, nargs=1)
+    parser.add_argument("--raw",
+                        help="Stream every iteration to stdout as raw RGB24 bytes (e.g. for "
+                             "ffmpeg -f rawvideo), instead of saving a PNG per iteration.",
+                        action="store_true")
+    parser.add_argument("--frame-duration",
+                        help="Milliseconds to show each frame of an animation for. Defaults to 100.",
+                        type=int, nargs=1)
+    parser.add_argument("--trace", "-t",
+                        help="Save a compact trace of every iteration (the state of every wire), "
+                             "instead of saving a PNG per iteration. Rebuild frames from it with "
+                             "python -m reso.trace.",
+                        type=str, nargs=1)
+    parser.add_argument("--serve",
+                        help="Push the wires that change every iteration to live viewers, as "
+                             "lines of JSON (see reso/stream.py), instead of saving a PNG per "
+                             "iteration. A TCP port on localhost if it's a number, or else the "
+                             "location of a Unix socket.",
+                        type=str, nargs=1)
+    parser.add_argument("--tick-rate",
+                        help="With --serve, run at most this many iterations per second.",
+                        type=float, nargs=1)
+    parser.add_argument("--memmap-dir",
+                        help="Memory-map the image, resel map and region labels from temporary "
+                             "files in this directory, and map the regions a strip at a time, to "
+                             "load boards larger than RAM.",
+                        type=str, nargs=1)
+    parser.add_argument("--profile",
+                        help="Time every phase (loading, compiling, ticking, rendering, saving), "
+                             "count the regions and fan-out of the board, and save the report "
+                             "as JSON to this file ('-' to print it).",
+                        type=str, nargs=1)
+    parser.add_argument("--engine", "-e",
+                        help="Engine to simulate with: 'object' (the default) walks every region; "
+                             "'numpy' steps the compiled netlist; 'event' only follows the wires "
+                             "that changed; 'parallel' splits the board over several processes; "
+                             "'jit' runs a fused loop compiled by Numba (like 'numpy' if Numba "
+                             "isn't installed). All give the same results.",
+                        type=str, choices=ENGINES, default="object")
+    parser.add_argument("--indexed", "-i",
+                        help="Save 8-bit palette PNGs straight from the resel map, rather than "
+                             "RGB PNGs: a third of the size to copy, and faster to encode. Colors "
+                             "that aren't part of the palette are saved as black. (Palette PNGs "
+                             "and GIFs are also loaded straight into resels.)",
+                        action="store_true")
+    parser.add_argument("--no-cache", help="Always compile the board from scratch, and don't cache it.",
+                        action="store_true")
+    parser.add_argument("--manifest", "-m",
+                        help="Simulate every board listed in this file (one image or glob pattern "
+                             "per line), like giving several load locations.",
+                        type=str, nargs=1)
+    parser.add_argument("--processes", "-p",
+                        help="Number of processes simulating boards at once, when simulating "
+                             "several boards. Defaults to the number of CPUs.",
+                        type=int, nargs=1)
+    parser.add_argument("--report", "-r",
+                        help="When simulating several boards, save a JSON report of every board "
+                             "(size, final state, cycle, time taken, errors) to this file ('-' "
+                             "to print it).",
+                        type=str, nargs=1)
 
     args = parser.parse_args()
     
-    if args.load_location is None:
+    if len(args.load_location) == 0 and args.manifest is None:
         raise ValueError
     
-    if args.save is None:
+    # Cycles are only detected while running every tick in one go, i.e. not
+    # while saving every iteration, or streaming them anywhere.
+    if args.detect_cycles and (
+            (args.save is not None and not args.outputlast) or args.animate is not None
+            or args.raw or args.trace is not None or args.serve is not None):
+        parser.error("--detect-cycles needs --outputlast when saving, and can't be combined "
+                     "with --animate, --raw, --trace or --serve")
+    
+    # Several boards (or a glob, or a manifest) are simulated in batch mode.
+    batch = (args.manifest is not None or len(args.load_location) > 1
+             or glob.has_magic(args.load_location[0]))
+    if batch:
+        if args.animate is not None or args.raw or args.trace is not None or \
+           args.memmap_dir is not None or args.profile is not None or args.serve is not None:
+            parser.error("--animate, --raw, --trace, --serve, --memmap-dir and --profile only "
+                         "work on one board")
+        if args.save is None and args.report is None:
+            raise ValueError
+    elif (args.trace is not None) + (args.serve is not None) + (args.animate is not None or args.raw) > 1:
+        parser.error("--trace, --serve and --animate (or --raw) can't be combined")
+    elif args.save is None and args.animate is None and not args.raw and args.trace is None \
+         and args.serve is None:
         raise ValueError
 
-    load_filename   = args.load_location[0]
-    save_prefix     = args.save[0]
+    save_prefix     = None if args.save is None else args.save[0]
     iterations = 1 if args.numiter  is None else args.numiter[0]
     save_each_iteration = not args.outputlast
     V = args.verbose
+    if args.no_cache:
+        cache = None
+    else:
+        cache = BoardCache(
+            cache_dir = DEFAULT_CACHE_DIR if args.cache_dir is None else args.cache_dir[0],
+            max_bytes = DEFAULT_MAX_BYTES if args.cache_size is None else args.cache_size[0] * 2**20)
+    
+    if batch:
+        boards = expand_boards(args.load_location,
+                               manifest = None if args.manifest is None else args.manifest[0])
+        report = run_batch(boards, save_prefix, iterations, save_each_iteration,
+                           detect_cycles = args.detect_cycles, cache = cache,
+                           processes = None if args.processes is None else args.processes[0],
+                           compress_level = 6 if args.compress_level is None else args.compress_level[0],
+                           engine = args.engine, indexed = args.indexed,
+                           messages = None if not V else sys.stderr if args.report == ["-"] else sys.stdout)
+        if args.report is not None:
+            write_report(report, sys.stdout if args.report[0] == "-" else args.report[0])
+        if args.report is None or args.report[0] != "-":
+            print_summary(report, sys.stdout)
+        sys.exit(1 if report["total"]["failed"] else 0)
+    
+    load_filename = args.load_location[0]
+    writer = PNGWriterPool(
+        workers = (os.cpu_count() or 1) if args.workers is None else args.workers[0],
+        compress_level = 6 if args.compress_level is None else args.compress_level[0],
+        max_pending = None if args.max_pending is None else args.max_pending[0])
     
-    main(load_filename, save_prefix, iterations, save_each_iteration, V)
+    main(load_filename, save_prefix, iterations, save_each_iteration, V, cache,
+         args.detect_cycles, writer,
+         animation = None if args.animate is None else args.animate[0],
+         raw = args.raw,
+         frame_duration = 100 if args.frame_duration is None else args.frame_duration[0],
+         trace = None if args.trace is None else args.trace[0],
+         memmap_dir = None if args.memmap_dir is None else args.memmap_dir[0],
+         profile = None if args.profile is None else args.profile[0],
+         engine = args.engine,
+         indexed = args.indexed,
+         serve = None if args.serve is None else args.serve[0],
+         tick_rate = None if args.tick_rate is None else args.tick_rate[0])
@@ -0,0 +1,262 @@
+'''batch.py
+
+Simulate many independent boards at once, one board per process.
+
+Regression sets (e.g. tests/testing/*.png) are hundreds of small boards, each
+compiled and iterated on its own, so they spread perfectly over a pool of
+processes: every worker compiles and runs its own ResoBoard (see
+__main__.main), saves its images, and sends back a short summary. The
+summaries are collected, in the order the boards were given, into one report.
+
+From the command line, give several images, a glob, or a manifest:
+    python -m reso "tests/testing/*.png" -n 20 -o -s out/ --report report.json
+saves out/<name>_20.png for every board, and a JSON report like
+    {"boards" : [{"file" : ..., "seconds" : ..., "regions" : ...,
+                  "wires" : ..., "wires_on" : ..., "cycle" : ...,
+                  "state_hash" : ..., "error" : ...}, ...],
+     "total"  : {"boards" : ..., "failed" : ..., "processes" : ...,
+                 "seconds" : ..., "board_seconds" : ..., "boards_per_second" : ...}}
+'state_hash' is a hash of the final state of every wire, so two reports of the
+same boards can be compared to spot boards that behave differently.
+'''
+
+import contextlib
+import glob
+import hashlib
+import io
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from time import perf_counter
+
+import numpy as np
+
+
+def expand_boards(patterns, manifest = None):
+    """List the boards to simulate from glob patterns and/or a manifest.
+
+    :param patterns: Locations of images, or glob patterns matching them, e.g.
+        'tests/testing/*.png'. Patterns matching nothing are an error.
+    :type patterns: List of String
+    :param manifest: If given, a text file listing one image (or pattern) per
+        line. Blank lines and lines starting with '#' are skipped, and relative
+        locations are relative to the manifest.
+    :type manifest: String
+
+    :raises ValueError: If a pattern matches no files.
+
+    :returns: Locations of the boards, in the order given (and sorted within
+        each pattern), without duplicates.
+    :rtype: List of String
+    """
+    patterns = list(patterns)
+    if manifest is not None:
+        manifest_dir = os.path.dirname(manifest)
+        with open(manifest) as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    patterns.append(os.path.join(manifest_dir, line))
+
+    boards = dict()
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        if len(matches) == 0:
+            raise ValueError(f"{pattern!r} matches no files")
+        for match in matches:
+            boards.setdefault(match, None)
+    return list(boards)
+
+
+def board_prefixes(boards, save_prefix):
+    """Name the images of every board after the board, e.g. 'out/' and
+    'boards/and.png' give 'out/and_'. Boards with the same name get their
+    index appended too, i.e. 'out/and_3_'.
+
+    :param boards: Locations of the boards
+    :type boards: List of String
+    :param save_prefix: Prefix to save every board's images to, or None.
+    :type save_prefix: String
+
+    :returns: The prefix to save every board's images to (all None if
+        save_prefix is None).
+    :rtype: List of String
+    """
+    if save_prefix is None:
+        return [None] * len(boards)
+    names = [os.path.splitext(os.path.basename(board))[0] for board in boards]
+    counts = dict()
+    for name in names:
+        counts[name] = counts.get(name, 0) + 1
+    return [f"{save_prefix}{name}_" if counts[name] == 1 else f"{save_prefix}{name}_{ii}_"
+            for ii, name in enumerate(names)]
+
+
+def simulate_board(load_filename, save_prefix = None, iterations = 1,
+                   save_each_iteration = False, detect_cycles = False, cache = None,
+                   compress_level = 6, engine = "object", indexed = False):
+    """Compile, iterate and save one board, and summarize it. This is what
+    every worker process runs.
+
+    Any exception is caught and reported in the summary, so that one bad
+    board doesn't stop the batch.
+
+    :param load_filename: Location of the board's image.
+    :type load_filename: String
+    :param save_prefix: Prefix to save the board's images to, or None to not
+        save any.
+    :type save_prefix: String
+    :param iterations: Number of simulation steps to update the circuit.
+    :type iterations: Int
+    :param save_each_iteration: If true, save an image of the circuit each iteration.
+    :type save_each_iteration: Bool
+    :param detect_cycles: If True, skip over the periods of a periodic board.
+    :type detect_cycles: Bool
+    :param cache: If given, load the compiled board from (or save it to) this cache
+    :type cache: cache.BoardCache
+    :param compress_level: PNG compression level, from 0 to 9.
+    :type compress_level: Int
+    :param engine: The engine to simulate the board with (see resoboard.ENGINES).
+    :type engine: String
+    :param indexed: If True, save 8-bit palette PNGs of the resel map.
+    :type indexed: Bool
+
+    :returns: Summary of the board: 'file', 'seconds', and either 'error', or
+        'regions', 'wires', 'wires_on', 'cycle' and 'state_hash'.
+    :rtype: Dict
+    """
+    # Imported here, as __main__ imports this module.
+    from .__main__ import main
+    from .output import PNGWriterPool
+
+    summary = {"file" : load_filename}
+    start = perf_counter()
+    try:
+        # Every process is already busy, so save images on this thread.
+        writer = PNGWriterPool(workers = 0, compress_level = compress_level)
+        # main() prints cycles it finds; they're in the summary instead.
+        with contextlib.redirect_stdout(io.StringIO()):
+            RB = main(load_filename, save_prefix, iterations, save_each_iteration,
+                      cache = cache, detect_cycles = detect_cycles, writer = writer, engine = engine,
+                      indexed = indexed)
+        state = RB.get_wire_states()
+        summary.update(
+            regions = RB._RM.num_regions(),
+            wires = len(state),
+            wires_on = int(np.count_nonzero(state)),
+            cycle = RB.get_cycle(),
+            state_hash = hashlib.blake2b(np.packbits(state).tobytes(), digest_size = 8).hexdigest())
+    except Exception as e:
+        summary["error"] = f"{type(e).__name__}: {e}"
+    summary["seconds"] = perf_counter() - start
+    return summary
+
+
+def run_batch(boards, save_prefix = None, iterations = 1, save_each_iteration = False,
+              detect_cycles = False, cache = None, processes = None, compress_level = 6,
+              engine = "object", indexed = False, messages = None):
+    """Simulate every board in a pool of processes, and collect the report.
+
+    :param boards: Locations of the boards, e.g. from expand_boards()
+    :type boards: List of String
+    :param save_prefix: Prefix to save images to (see board_prefixes), or None
+        to not save any.
+    :type save_prefix: String
+    :param iterations: Number of simulation steps to update every circuit.
+    :type iterations: Int
+    :param save_each_iteration: If true, save an image of every circuit each iteration.
+    :type save_each_iteration: Bool
+    :param detect_cycles: If True, skip over the periods of periodic boards.
+    :type detect_cycles: Bool
+    :param cache: If given, the cache every process loads compiled boards
+        from (or saves them to). Entries are written atomically, so the
+        processes can share it.
+    :type cache: cache.BoardCache
+    :param processes: Number of worker processes. Defaults to the number of
+        CPUs. 1 simulates every board in this process.
+    :type processes: Int
+    :param compress_level: PNG compression level, from 0 to 9.
+    :type compress_level: Int
+    :param engine: The engine to simulate every board with (see resoboard.ENGINES).
+    :type engine: String
+    :param indexed: If True, save 8-bit palette PNGs of the resel maps.
+    :type indexed: Bool
+    :param messages: If given, a text file (e.g. sys.stdout) to print a line
+        to as every board finishes.
+    :type messages: file object
+
+    :raises ValueError: If processes is less than 1.
+
+    :returns: The report, with 'boards' (the summary of every board, in the
+        order given; see simulate_board) and 'total'.
+    :rtype: Dict
+    """
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if processes < 1:
+        raise ValueError(f"processes should be at least 1, got {processes}")
+    processes = min(processes, max(1, len(boards)))
+
+    jobs = [(board, prefix, iterations, save_each_iteration, detect_cycles, cache, compress_level, engine, indexed)
+            for board, prefix in zip(boards, board_prefixes(boards, save_prefix))]
+    summaries = [None] * len(jobs)
+
+    def finished(ii, summary):
+        summaries[ii] = summary
+        if messages is not None:
+            done = sum(summary is not None for summary in summaries)
+            status = summary["error"] if "error" in summary else "ok"
+            print(f"[{done}/{len(jobs)}] {summary['file']}: {status} ({summary['seconds']:.2f}s)",
+                  file = messages)
+
+    start = perf_counter()
+    if processes == 1:
+        for ii, job in enumerate(jobs):
+            finished(ii, simulate_board(*job))
+    else:
+        with ProcessPoolExecutor(max_workers = processes) as pool:
+            futures = {pool.submit(simulate_board, *job) : ii for ii, job in enumerate(jobs)}
+            for future in as_completed(futures):
+                finished(futures[future], future.result())
+    seconds = perf_counter() - start
+
+    return {
+        "boards" : summaries,
+        "total" : {
+            "boards" : len(summaries),
+            "failed" : sum("error" in summary for summary in summaries),
+            "processes" : processes,
+            "seconds" : seconds,
+            # The time every board took on its own, summed. Over 'seconds',
+            # this is the speedup over simulating them one at a time.
+            "board_seconds" : sum(summary["seconds"] for summary in summaries),
+            "boards_per_second" : len(summaries) / seconds if seconds > 0 else 0.0,
+        }
+    }
+
+
+def write_report(report, file):
+    """Write a report from run_batch() as JSON.
+
+    :param file: Location to save the report to, or a text file object.
+    :type file: String or file object
+    """
+    if isinstance(file, str):
+        with open(file, "w") as f:
+            json.dump(report, f, indent = 2)
+            f.write("\n")
+    else:
+        json.dump(report, file, indent = 2)
+        file.write("\n")
+
+
+def print_summary(report, messages):
+    """Print a line per board that failed, and the totals of a report."""
+    for summary in report["boards"]:
+        if "error" in summary:
+            print(f"FAILED {summary['file']}: {summary['error']}", file = messages)
+    total = report["total"]
+    print(f"Simulated {total['boards']} board(s) ({total['failed']} failed) on "
+          f"{total['processes']} process(es) in {total['seconds']:.2f} seconds "
+          f"({total['boards_per_second']:.1f} boards/s, "
+          f"{total['board_seconds'] / max(total['seconds'], 1e-9):.1f}x).", file = messages)
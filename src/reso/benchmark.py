@@ -0,0 +1,541 @@
+'''benchmark.py
+
+Performance benchmarks over synthetic circuits of any size.
+
+The generators here draw Reso circuits procedurally, as (w, h, 3) RGB images
+like the ones ResoBoard() loads:
+    wire_mesh       A grid of orange and sapphire lines crossing diagonally
+                    (like in examples/adders.png), with a buffer between
+                    every two crossings. Mostly wire pixels.
+    xor_chains      Rings of xor gates, each fed by an always-on bus, so every
+                    gate inverts its input: lots of wires toggle every tick.
+    and_chains      The same, with and gates, which just pass their input on.
+    clock_rings     Small rings of buffers with one pulse going around each.
+    adders          An array of full adders (the one from examples/adders.png)
+                    with random inputs.
+
+benchmark() times, for a circuit of each size, mapping the regions, compiling
+the whole board, ticking it with each engine and repainting its image, and
+measures the memory allocated while compiling and ticking. The results can
+be saved as JSON and compared against the results of another version:
+
+    python -m reso.benchmark --sizes 64 128 256 512 --save before.json
+    (change things)
+    python -m reso.benchmark --sizes 64 128 256 512 --compare before.json
+
+Every timing is the best of a few repeats, in seconds (or seconds per tick),
+so lower is always better.
+'''
+
+import argparse
+import json
+import platform
+import tracemalloc
+from time import perf_counter, strftime
+
+import numpy as np
+from PIL import Image
+
+from .palette import resel_to_rgb, po, ps, pl
+from .profiling import Profiler
+from .resoboard import ResoBoard, ENGINES
+
+
+# Wire pixels in the generators are drawn off, then some are turned on.
+_OFF_WIRES = (po, ps, pl)
+# Length of the wires between two gates or buffers in the generated rings.
+_WIRE_LENGTH = 2
+
+# The full adder from examples/adders.png, with loops (pP next to a wire)
+# that keep its three inputs on or off. a is the orange wire at the top left,
+# b the sapphire wire below it, and the carry in the lime wire at the bottom.
+# The sum comes out of the orange wire on the top right, and the carry out of
+# the sapphire wire on the bottom right.
+_FULL_ADDER = (
+    "..pP....................",
+    "..ooooopTPooopTPopPoo...",
+    "pP...oss...oll..........",
+    "ssssssoptPslospPs.......",
+    "..........lsso...s......",
+    "..lllllpPllllptPlpTPss..",
+    "..pP....................",
+    "........................",
+)
+
+
+def _grid(rows):
+    """Turn a list of strings (one per row, '.' for blank) into an array of
+    resels of shape (h, w)."""
+    return np.array([[0 if char == "." else ord(char) for char in row] for row in rows],
+                    dtype=np.uint8)
+
+
+def _to_image(grid):
+    """Paint an (h, w) array of resels as a (w, h, 3) RGB image, indexed (x,y)."""
+    table = np.zeros((256, 3), dtype=np.uint8)
+    for resel, rgb in resel_to_rgb.items():
+        table[resel] = rgb
+    return np.swapaxes(table[grid], 0, 1)
+
+
+def _tile(grid, width, height):
+    """Tile a pattern over a (height, width) grid. Only whole copies are
+    drawn, so the rest is left blank."""
+    tiled = np.zeros((height, width), dtype=np.uint8)
+    copies_y, copies_x = height // grid.shape[0], width // grid.shape[1]
+    tiled[:copies_y * grid.shape[0], :copies_x * grid.shape[1]] = np.tile(grid, (copies_y, copies_x))
+    return tiled
+
+
+def _switch_on(grid, on_fraction, rng):
+    """Turn on a random fraction of the wires in a grid, in place.
+
+    (Strictly, of the horizontal runs of off wire pixels. A wire is on if any
+    of its pixels are, so wires made of many runs are more likely to be on.)
+    """
+    is_wire = np.isin(grid, _OFF_WIRES)
+    starts = is_wire.copy()
+    starts[:, 1:] &= ~is_wire[:, :-1]
+    run_of_pixel = np.cumsum(starts.ravel()) - 1
+    on = rng.random(int(starts.sum())) < on_fraction
+    turn_on = is_wire.ravel().copy()
+    turn_on[turn_on] = on[run_of_pixel[turn_on]]
+    # 'o' - 32 == 'O', and so on for every wire color.
+    grid.reshape(-1)[turn_on] -= 32
+
+
+def wire_mesh(width, height, pitch = 8, on_fraction = 0.5, seed = 0):
+    """A grid of orange lines (left to right) and sapphire lines (top to
+    bottom), crossing every pitch pixels, with a buffer between crossings.
+    Signals flow right and down, and off the edge of the board.
+
+    :param width: Width of the image, in pixels.
+    :type width: Int
+    :param height: Height of the image, in pixels.
+    :type height: Int
+    :param pitch: Distance between lines, at least 6.
+    :type pitch: Int
+    :param on_fraction: Fraction of the wires that start on.
+    :type on_fraction: Float
+    :param seed: Seed for choosing which wires start on.
+    :type seed: Int
+
+    :returns: The circuit, an RGB image of shape (width, height, 3)
+    :rtype: numpy.ndarray
+    """
+    if pitch < 6:
+        raise ValueError(f"pitch should be at least 6, got {pitch}")
+    # Crossings alternate, like a checkerboard, between
+    #   os      so
+    #   so  and os
+    # so that both lines zig-zag between two rows (or columns) of pixels.
+    run = pitch - 2
+    before = (run - 2) // 2
+    tile = np.zeros((2 * pitch, 2 * pitch), dtype=np.uint8)
+    for cell_x in (0, 1):
+        for cell_y in (0, 1):
+            x, y = cell_x * pitch, cell_y * pitch
+            flipped = (cell_x + cell_y) % 2 == 1
+            tile[y:y+2, x:x+2] = _grid(("so", "os") if flipped else ("os", "so"))
+            # The orange line leaves a crossing on the row it didn't come in on,
+            # and the sapphire line on the other column.
+            row, column = (0, 1) if flipped else (1, 0)
+            tile[y + row, x+2:x+pitch] = _grid(["o" * before + "pP" + "o" * (run - 2 - before)])[0]
+            tile[y+2:y+pitch, x + column] = _grid(["s" * before + "pP" + "s" * (run - 2 - before)])[0]
+    # Draw every whole cell (rather than every whole tile of four cells).
+    cells_x, cells_y = width // pitch, height // pitch
+    grid = np.zeros((height, width), dtype=np.uint8)
+    grid[:cells_y * pitch, :cells_x * pitch] = np.tile(
+        tile, ((cells_y + 1) // 2, (cells_x + 1) // 2))[:cells_y * pitch, :cells_x * pitch]
+    _switch_on(grid, on_fraction, np.random.default_rng(seed))
+    return _to_image(grid)
+
+
+def _ring(width, wire, gates = ""):
+    """Draw one ring, as rows of strings: a forward row of stages from left to
+    right, a return row of buffers from right to left, and a wire at each end
+    joining them. If gates are given, every forward stage is a gate (cycling
+    through gates), fed by an always-on bus above the ring.
+    """
+    unit = _WIRE_LENGTH + 2 + (1 if gates else 0)
+    stages = (width - 1) // unit
+    width = stages * unit + 1
+    forward = ""
+    for stage in range(stages):
+        gate = gates[stage % len(gates)] if gates else ""
+        forward += wire * _WIRE_LENGTH + "p" + gate + "P"
+    forward += wire
+
+    # The return row, from right to left: buffers, then whatever is left over
+    # joins the wire at the left end.
+    back = ["."] * (width - 1) + [wire]
+    x = width - 2
+    while x - 2 >= 0:
+        back[x], back[x - 1] = "p", "P"
+        for wire_x in range(max(0, x - 1 - _WIRE_LENGTH), x - 1):
+            back[wire_x] = wire
+        x -= 2 + _WIRE_LENGTH
+    for wire_x in range(0, x + 1):
+        back[wire_x] = wire
+
+    ends = wire + "." * (width - 2) + wire
+    rows = [forward, ends, "".join(back), "." * width]
+    if gates:
+        taps = "".join("p" if char in gates else "." for char in forward)
+        rows = ["pP" + "." * (width - 2), "O" * width, taps] + rows
+    return rows
+
+
+def gate_chains(width, height, gates = "T", on_fraction = 0.5, seed = 0):
+    """Rings of gates, each as wide as the board. Every gate has one input
+    from the wire before it, and one from an always-on bus, so xor gates ("T")
+    invert their input and and gates ("t") pass it on. Rings of inverters
+    oscillate, so most wires keep toggling.
+
+    :param width: Width of the image, in pixels.
+    :type width: Int
+    :param height: Height of the image, in pixels.
+    :type height: Int
+    :param gates: The gates of each ring, in order, cycling: "T" (xor),
+        "t" (and), or e.g. "Tt" to alternate.
+    :type gates: String
+    :param on_fraction: Fraction of the wires that start on.
+    :type on_fraction: Float
+    :param seed: Seed for choosing which wires start on.
+    :type seed: Int
+
+    :returns: The circuit, an RGB image of shape (width, height, 3)
+    :rtype: numpy.ndarray
+    """
+    if not gates or set(gates) - {"T", "t"}:
+        raise ValueError(f"gates should be a string of 'T' and 't', got {gates!r}")
+    block = np.concatenate([_grid(_ring(width, wire, gates)) for wire in "osl"])
+    grid = _tile(block, block.shape[1], height)
+    grid = np.pad(grid, ((0, 0), (0, width - grid.shape[1])))
+    # The tiling might cut the last rings short; only keep whole rings.
+    grid[height // 7 * 7:] = 0
+    _switch_on(grid, on_fraction, np.random.default_rng(seed))
+    return _to_image(grid)
+
+
+def clock_rings(width, height, stages = 8):
+    """Small rings of buffers, with one wire on in each, so every ring is a
+    clock with a period of its number of buffers.
+
+    :param width: Width of the image, in pixels.
+    :type width: Int
+    :param height: Height of the image, in pixels.
+    :type height: Int
+    :param stages: Number of buffers on the forward row of every ring.
+    :type stages: Int
+
+    :returns: The circuit, an RGB image of shape (width, height, 3)
+    :rtype: numpy.ndarray
+    """
+    ring_width = stages * (_WIRE_LENGTH + 2) + 1
+    blocks = []
+    for wire in "osl":
+        rows = _ring(ring_width, wire)
+        # Turn on the first wire, and leave a blank column between rings.
+        rows[0] = wire.upper() * _WIRE_LENGTH + rows[0][_WIRE_LENGTH:]
+        blocks.append(_grid([row + "." for row in rows]))
+    return _to_image(_tile(np.concatenate(blocks), width, height))
+
+
+def adder_array(width, height, on_fraction = 0.5, seed = 0):
+    """An array of full adders, with their inputs chosen at random.
+
+    :param width: Width of the image, in pixels.
+    :type width: Int
+    :param height: Height of the image, in pixels.
+    :type height: Int
+    :param on_fraction: Fraction of the inputs (and other wires) that start on.
+    :type on_fraction: Float
+    :param seed: Seed for choosing which wires start on.
+    :type seed: Int
+
+    :returns: The circuit, an RGB image of shape (width, height, 3)
+    :rtype: numpy.ndarray
+    """
+    grid = _tile(_grid(_FULL_ADDER), width, height)
+    _switch_on(grid, on_fraction, np.random.default_rng(seed))
+    return _to_image(grid)
+
+
+# Name --> function(width, height) drawing a circuit
+GENERATORS = {
+    "wire_mesh"   : wire_mesh,
+    "xor_chains"  : lambda width, height: gate_chains(width, height, gates = "T"),
+    "and_chains"  : lambda width, height: gate_chains(width, height, gates = "t"),
+    "clock_rings" : clock_rings,
+    "adders"      : adder_array,
+}
+
+
+def _best_time(function, repeat):
+    """Return the shortest time function() took over repeat calls."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = perf_counter()
+        function()
+        best = min(best, perf_counter() - start)
+    return best
+
+
+def _peak_bytes(function):
+    """Return the most memory allocated at once while calling function(),
+    above what was allocated before."""
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def measure(image, ticks = 100, engines = ("numpy",), repeat = 3):
+    """Time every phase of one circuit, and measure its memory use.
+
+    The metrics returned are:
+        seconds.region_mapper   Mapping the palette, and labelling the regions
+                                and their adjacencies (i.e. RegionMapper).
+        seconds.compile         All of ResoBoard(image), including the above.
+        seconds.tick.<engine>   Seconds per tick of run(), for every engine.
+        seconds.render          Repainting every wire onto the image.
+        bytes.compile           Most memory allocated at once by ResoBoard(image).
+        bytes.tick              Most memory allocated at once while ticking
+                                the first engine.
+
+    :param image: The circuit, an RGB image of shape (w, h, 3)
+    :type image: numpy.ndarray
+    :param ticks: Number of ticks to time every engine over.
+    :type ticks: Int
+    :param engines: The engines to time (see ResoBoard).
+    :type engines: Tuple of String
+    :param repeat: Number of times to repeat every timing, keeping the best.
+    :type repeat: Int
+
+    :returns: Dict with the 'pixels', 'regions' and 'wires' of the board,
+        and its 'metrics', a dict of metric name --> number (lower is better).
+    :rtype: Dict
+    """
+    for engine in engines:
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine {engine!r}; expected one of {ENGINES}")
+    metrics = dict()
+
+    # Compiling. The region mapping is timed with the profiler.
+    region_mapper, compile_seconds = float("inf"), float("inf")
+    for _ in range(repeat):
+        profiler = Profiler()
+        board = ResoBoard(image, engine = engines[0], profiler = profiler)
+        region_mapper = min(region_mapper, sum(
+            profiler.phases[phase][0] for phase in
+            ("compile.map_classes", "compile.label_regions", "compile.adjacency")))
+        compile_seconds = min(compile_seconds, profiler.phases["compile"][0])
+    metrics["seconds.region_mapper"] = region_mapper
+    metrics["seconds.compile"] = compile_seconds
+
+    # Ticking, from the same starting state every time. run(0) starts the
+    # engine first (e.g. forks the workers of "parallel"), outside the timing.
+    for engine in engines:
+        best = float("inf")
+        for _ in range(repeat):
+            with ResoBoard(image, engine = engine) as board:
+                board.run(0, update_resels = False, update_image = False)
+                start = perf_counter()
+                board.run(ticks, update_resels = False, update_image = False)
+                best = min(best, perf_counter() - start)
+        metrics[f"seconds.tick.{engine}"] = best / max(1, ticks)
+
+    # Rendering: repaint every wire, as if every wire changed.
+    metrics["seconds.render"] = _best_time(
+        lambda: board._update(resel_map = False, update_image = True, only_changed = False), repeat)
+
+    # Memory. (Measured separately, since tracing allocations slows everything down.)
+    boards = []
+    metrics["bytes.compile"] = _peak_bytes(lambda: boards.append(ResoBoard(image, engine = engines[0])))
+    with boards[0]:
+        boards[0].run(0, update_resels = False, update_image = False)
+        metrics["bytes.tick"] = _peak_bytes(
+            lambda: boards[0].run(min(ticks, 10), update_resels = False, update_image = False))
+
+    return {
+        "pixels" : int(image.shape[0] * image.shape[1]),
+        "regions" : board._RM.num_regions(),
+        "wires" : len(board.get_wire_regions()),
+        "metrics" : metrics,
+    }
+
+
+def benchmark(generators = tuple(GENERATORS), sizes = (64, 128, 256), ticks = 100,
+              engines = ("numpy",), repeat = 3, log = None):
+    """Run measure() over square circuits from every generator, at every size.
+
+    :param generators: Names of the generators to use (see GENERATORS).
+    :type generators: Tuple of String
+    :param sizes: Widths (and heights) of the circuits, in pixels.
+    :type sizes: Tuple of Int
+    :param ticks: Number of ticks to time every engine over.
+    :type ticks: Int
+    :param engines: The engines to time (see ResoBoard).
+    :type engines: Tuple of String
+    :param repeat: Number of times to repeat every timing, keeping the best.
+    :type repeat: Int
+    :param log: If given, a file to print progress to.
+    :type log: file object
+
+    :raises ValueError: If a generator or engine is unknown.
+
+    :returns: The results, a JSON-serializable dict of 'meta' (about this
+        machine and version), 'config' (the arguments) and 'results' (a list
+        of the results of measure(), with their 'generator' and 'size').
+    :rtype: Dict
+    """
+    for name in generators:
+        if name not in GENERATORS:
+            raise ValueError(f"Unknown generator {name!r}; expected one of {tuple(GENERATORS)}")
+    # The first board a process compiles is slower (imports, caches warming up),
+    # so compile one that isn't timed first.
+    ResoBoard(GENERATORS[generators[0]](32, 32) if generators else np.zeros((1, 1, 3), dtype=np.uint8))
+    results = []
+    for name in generators:
+        for size in sizes:
+            if log is not None:
+                print(f"{name} at {size}x{size}...", file = log, flush = True)
+            result = measure(GENERATORS[name](size, size), ticks = ticks,
+                             engines = engines, repeat = repeat)
+            results.append(dict(generator = name, size = size, **result))
+    return {
+        "meta" : {
+            "time" : strftime("%Y-%m-%dT%H:%M:%S"),
+            "python" : platform.python_version(),
+            "numpy" : np.__version__,
+            "platform" : platform.platform(),
+            "machine" : platform.machine(),
+        },
+        "config" : {"sizes" : list(sizes), "ticks" : ticks, "engines" : list(engines),
+                    "repeat" : repeat},
+        "results" : results,
+    }
+
+
+def scaling(results):
+    """Fit how every metric scales with the number of pixels, per generator.
+
+    :param results: As returned by benchmark()
+    :type results: Dict
+
+    :returns: Dict of generator --> Dict of metric --> exponent k, where the
+        metric grows like pixels ** k. (1.0 is linear.) Only generators with
+        at least two sizes are included.
+    :rtype: Dict
+    """
+    exponents = dict()
+    for name in dict.fromkeys(result["generator"] for result in results["results"]):
+        rows = [result for result in results["results"] if result["generator"] == name]
+        if len(rows) < 2:
+            continue
+        pixels = np.log([row["pixels"] for row in rows])
+        exponents[name] = dict()
+        for metric in rows[0]["metrics"]:
+            values = np.array([row["metrics"].get(metric, 0) for row in rows], dtype=float)
+            if (values > 0).all():
+                exponents[name][metric] = float(np.polyfit(pixels, np.log(values), 1)[0])
+    return exponents
+
+
+def compare(before, after):
+    """Compare two sets of results, e.g. from two versions.
+
+    :param before: As returned by benchmark(), e.g. loaded from JSON.
+    :type before: Dict
+    :param after: As returned by benchmark()
+    :type after: Dict
+
+    :returns: List of (generator, size, metric, before, after, after / before)
+        for every metric measured in both. A ratio below 1 is an improvement.
+    :rtype: List of Tuple
+    """
+    previous = {(result["generator"], result["size"]) : result["metrics"]
+                for result in before["results"]}
+    rows = []
+    for result in after["results"]:
+        old_metrics = previous.get((result["generator"], result["size"]))
+        if old_metrics is None:
+            continue
+        for metric, new in result["metrics"].items():
+            old = old_metrics.get(metric)
+            if old is None:
+                continue
+            rows.append((result["generator"], result["size"], metric, old, new,
+                         new / old if old > 0 else float("inf")))
+    return rows
+
+
+def _format(metric, value):
+    """Format a metric for printing, in sensible units."""
+    if metric.startswith("bytes."):
+        return f"{value / 2**20:.1f} MiB"
+    if metric.startswith("seconds.tick."):
+        return f"{value * 1e6:.1f} us/tick"
+    return f"{value * 1e3:.1f} ms"
+
+
+def print_results(results, file = None):
+    """Print results as a table, followed by the fitted scaling exponents."""
+    for result in results["results"]:
+        print(f"{result['generator']:>12} {result['size']:>6}px  "
+              f"{result['regions']:>9} regions {result['wires']:>9} wires", file = file)
+        for metric, value in result["metrics"].items():
+            print(f"{'':>21}{metric:<24}{_format(metric, value):>16}", file = file)
+    for name, exponents in scaling(results).items():
+        print(f"Scaling of {name}, as pixels ** k:", file = file)
+        for metric, exponent in exponents.items():
+            print(f"{'':>21}{metric:<24}{exponent:>16.2f}", file = file)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark Reso on synthetic circuits.")
+    parser.add_argument("--generators", "-g", help="Circuits to benchmark. Defaults to all of them.",
+                        type=str, nargs="+", choices=tuple(GENERATORS))
+    parser.add_argument("--sizes", help="Widths (and heights) of the circuits. Defaults to 64 128 256.",
+                        type=int, nargs="+")
+    parser.add_argument("--ticks", "-n", help="Ticks to time every engine over. Defaults to 100.",
+                        type=int, nargs=1)
+    parser.add_argument("--engines", "-e", help="Engines to time. Defaults to numpy.",
+                        type=str, nargs="+", choices=ENGINES)
+    parser.add_argument("--repeat", help="Repeat every timing this many times, keeping the best. "
+                                         "Defaults to 3.",
+                        type=int, nargs=1)
+    parser.add_argument("--save", "-s", help="Save the results as JSON here.",
+                        type=str, nargs=1)
+    parser.add_argument("--compare", help="Compare against results saved with --save.",
+                        type=str, nargs=1)
+    parser.add_argument("--save-images", help="Also save every circuit as a PNG, with this prefix.",
+                        type=str, nargs=1)
+    args = parser.parse_args()
+
+    generators = tuple(GENERATORS) if args.generators is None else tuple(args.generators)
+    sizes = (64, 128, 256) if args.sizes is None else tuple(args.sizes)
+    if args.save_images is not None:
+        for name in generators:
+            for size in sizes:
+                Image.fromarray(np.swapaxes(GENERATORS[name](size, size), 0, 1)).save(
+                    f"{args.save_images[0]}{name}_{size}.png")
+
+    results = benchmark(generators, sizes,
+                        ticks = 100 if args.ticks is None else args.ticks[0],
+                        engines = ("numpy",) if args.engines is None else tuple(args.engines),
+                        repeat = 3 if args.repeat is None else args.repeat[0])
+    print_results(results)
+    if args.save is not None:
+        with open(args.save[0], "w") as f:
+            json.dump(results, f, indent = 2)
+    if args.compare is not None:
+        with open(args.compare[0]) as f:
+            before = json.load(f)
+        print(f"Compared to {args.compare[0]} (from {before['meta']['time']}):")
+        for name, size, metric, old, new, ratio in compare(before, results):
+            print(f"{name:>12} {size:>6}px {metric:<24}{_format(metric, old):>16} -> "
+                  f"{_format(metric, new):>16}  {ratio:6.2f}x")
@@ -0,0 +1,197 @@
+'''cache.py
+
+An on-disk cache of compiled boards.
+
+Compiling a board (mapping its pixels to regions, and finding which regions
+are adjacent) is by far the slowest part of loading a large circuit. The
+compiled form is just a handful of arrays, so BoardCache saves them as .npy
+files, in a directory named after a hash of the image and palette (see
+board_key). The next time the same circuit is loaded, ResoBoard reads the
+arrays back instead of compiling from scratch. They are memory-mapped rather
+than read, so loading a huge board takes no more memory than compiling it
+(e.g. with --memmap-dir) would.
+
+The cache is kept under a size limit by deleting the least recently used
+entries. (An entry larger than the limit is never saved at all.)
+'''
+
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+
+# Bump this whenever the compiled form of a board changes, so that old cache
+# entries are never loaded.
+CACHE_VERSION = 3
+
+# Like most tools, we follow the XDG convention, i.e. ~/.cache/reso by default.
+DEFAULT_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+    "reso")
+
+# 256 MiB, which holds the compiled form of a few dozen 2048x2048 boards.
+DEFAULT_MAX_BYTES = 256 * 2**20
+
+# Number of pixels board_key hashes at a time.
+_HASH_PIXELS = 2**20
+
+
+def board_key(image, rgb_to_resel):
+    """Hash an image and a palette into a key for BoardCache.
+    
+    The image is hashed a strip of rows at a time, so a memory-mapped image
+    (see resoboard.load_image) is never copied into memory all at once.
+    
+    :param image: Numpy array of shape (w, h, 3) representing the RGB image.
+    :type image: numpy.ndarray
+    :param rgb_to_resel: Dict mapping pixel values (i.e. RGB 3-tuples) to 'resel'
+        enums.
+    :type rgb_to_resel: Dict
+    
+    :returns: Hex digest, safe to use as a filename.
+    :rtype: String
+    """
+    digest = hashlib.sha256()
+    digest.update(f"reso-board-v{CACHE_VERSION}".encode())
+    digest.update(f"{image.shape} {image.dtype.str}".encode())
+    digest.update(repr(sorted(
+        (tuple(int(cc) for cc in rgb), int(resel)) for rgb, resel in rgb_to_resel.items()
+    )).encode())
+    # Rows, i.e. image[:, y0:y1] transposed, are contiguous in the (h, w, 3)
+    # arrays images are views of, so these are usually copies of nothing.
+    rows = max(1, _HASH_PIXELS // max(1, image.shape[0]))
+    for y0 in range(0, image.shape[1], rows):
+        strip = np.ascontiguousarray(np.swapaxes(image[:, y0:y0 + rows], 0, 1))
+        digest.update(memoryview(strip).cast('B'))
+    return digest.hexdigest()
+
+
+class BoardCache:
+    """A directory of compiled boards, each saved as a directory of
+    uncompressed .npy files, one per array.
+    
+    Entries are never loaded with pickle, and a missing, partially-written or
+    otherwise unreadable entry is treated the same as a cache miss. Saving is
+    best-effort too: if the directory can't be written to, nothing is cached.
+    
+    :param cache_dir: Directory to store compiled boards in. Created if needed.
+    :type cache_dir: String
+    :param max_bytes: Once the entries take up more than this many bytes, the
+        least recently used ones are deleted. Larger entries aren't saved.
+    :type max_bytes: Int
+    """
+    def __init__(self, cache_dir = DEFAULT_CACHE_DIR, max_bytes = DEFAULT_MAX_BYTES):
+        if max_bytes < 0:
+            raise ValueError(f"max_bytes should be non-negative, got {max_bytes}")
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+    
+    def path(self, key):
+        """Return the path of the directory the entry for key is saved to."""
+        return os.path.join(self.cache_dir, key)
+    
+    def load(self, key):
+        """Load the arrays saved under key, or return None if there are none.
+        
+        The arrays are memory-mapped copy-on-write: pages are read from disk
+        as they're used, and changing an array never changes the entry.
+        
+        :param key: Key, e.g. from board_key()
+        :type key: String
+        
+        :returns: Dict of name --> array, or None
+        :rtype: Dict
+        """
+        path = self.path(key)
+        try:
+            arrays = {name[:-len(".npy")] : np.load(os.path.join(path, name), mmap_mode = "c",
+                                                    allow_pickle = False)
+                      for name in os.listdir(path) if name.endswith(".npy")}
+            # Mark the entry as recently used, so it is evicted last.
+            os.utime(path)
+        except (OSError, ValueError, EOFError):
+            return None
+        return arrays
+    
+    def save(self, key, arrays):
+        """Save arrays under key, then evict old entries if the cache is too big.
+        
+        The entry is written under a temporary name and then moved into place,
+        so other processes never see a partially-written entry. Entries larger
+        than max_bytes aren't saved, rather than evicting everything else.
+        
+        :param key: Key, e.g. from board_key()
+        :type key: String
+        :param arrays: Dict of name --> array
+        :type arrays: Dict
+        
+        :returns: True if the arrays were saved.
+        :rtype: Bool
+        """
+        if sum(np.asarray(array).nbytes for array in arrays.values()) > self.max_bytes:
+            return False
+        try:
+            os.makedirs(self.cache_dir, exist_ok = True)
+            temp_path = tempfile.mkdtemp(dir = self.cache_dir, suffix = ".tmp")
+            try:
+                for name, array in arrays.items():
+                    np.save(os.path.join(temp_path, name + ".npy"), array, allow_pickle = False)
+                # (Fails if another process saved the same entry in the meantime.)
+                os.replace(temp_path, self.path(key))
+            except BaseException:
+                shutil.rmtree(temp_path, ignore_errors = True)
+                raise
+        except OSError:
+            return False
+        self.evict(keep = key)
+        return True
+    
+    def entries(self):
+        """Return (modification time, size in bytes, path) of every entry,
+        least recently used first.
+        
+        :rtype: List of tuple
+        """
+        entries = []
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError:
+            return entries
+        for name in names:
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith(".tmp") or not os.path.isdir(path):
+                continue
+            try:
+                mtime = os.stat(path).st_mtime
+                size = sum(entry.stat().st_size for entry in os.scandir(path))
+            except OSError:
+                # E.g. deleted by another process in the meantime.
+                continue
+            entries.append((mtime, size, path))
+        return sorted(entries)
+    
+    def evict(self, keep = None):
+        """Delete the least recently used entries until the cache takes up at
+        most max_bytes.
+        
+        :param keep: Key of an entry to delete last, e.g. the one just saved.
+        :type keep: String
+        """
+        entries = self.entries()
+        if keep is not None:
+            keep_path = self.path(keep)
+            entries.sort(key = lambda entry: entry[2] == keep_path)
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors = True)
+            total_bytes -= size
+    
+    def clear(self):
+        """Delete every entry."""
+        for _, _, path in self.entries():
+            shutil.rmtree(path, ignore_errors = True)
@@ -0,0 +1,194 @@
+'''jit.py
+
+A fused, compiled tick for huge boards, using Numba (if it's installed).
+
+Netlist.step() is a dozen NumPy passes per tick, each making temporaries (and
+the bincounts and scatters have their own overhead). Here, the netlist is laid
+out as fan-in lists instead, CSR-style: e.g. the wires of input i are
+input_wires[input_wires_indptr[i]:input_wires_indptr[i+1]]. A tick is then one
+loop over every kind of element, reading the elements it depends on, and
+_run_ticks runs any number of ticks in one call. Numba compiles that loop to
+machine code, so it runs without any temporaries or Python in between.
+
+    simulator = JitSimulator(netlist, state)
+    simulator.run(1000)     # state is now 1000 ticks later
+
+Numba is optional (pip install numba, or pip install reso[jit]). Without it,
+JitSimulator falls back to Netlist.step(), with exactly the same results, and
+JitSimulator.compiled is False.
+'''
+
+import numpy as np
+
+from reso.netlist import _fanout
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def _run_ticks(n, state, next_state,
+               input_indptr, input_wires, input_degree,
+               xor_indptr, xor_inputs,
+               and_indptr, and_inputs, and_has_wires,
+               output_input_indptr, output_inputs,
+               output_xor_indptr, output_xors,
+               output_and_indptr, output_ands,
+               wire_output_indptr, wire_outputs,
+               wire_wire_indptr, wire_wires,
+               input_count, xor_on, and_on, output_on):
+    """Run n ticks of a netlist laid out as fan-in lists (see JitSimulator),
+    with the same semantics as Netlist.step(). Compiled by Numba when it's
+    installed.
+
+    The state of the wires is read from state, and the state after n ticks
+    is written back into it. next_state, input_count, xor_on, and_on and
+    output_on are scratch arrays, one entry per element of that kind.
+    """
+    current, following = state, next_state
+    for _ in range(n):
+        # 1. Input nodes, then logic nodes.
+        for ii in range(len(input_count)):
+            count = 0
+            for kk in range(input_indptr[ii], input_indptr[ii + 1]):
+                if current[input_wires[kk]]:
+                    count += 1
+            input_count[ii] = count
+        for ii in range(len(xor_on)):
+            # The parity of the 'on' wires seen through every input.
+            on = False
+            for kk in range(xor_indptr[ii], xor_indptr[ii + 1]):
+                if input_count[xor_inputs[kk]] & 1:
+                    on = not on
+            xor_on[ii] = on
+        for ii in range(len(and_on)):
+            # On if it sees a wire, and every wire it sees is on.
+            on = and_has_wires[ii]
+            for kk in range(and_indptr[ii], and_indptr[ii + 1]):
+                if input_count[and_inputs[kk]] < input_degree[and_inputs[kk]]:
+                    on = False
+                    break
+            and_on[ii] = on
+
+        # 2. Output nodes: the 'or' of their inputs, xors and ands.
+        for ii in range(len(output_on)):
+            on = False
+            for kk in range(output_input_indptr[ii], output_input_indptr[ii + 1]):
+                if input_count[output_inputs[kk]] > 0:
+                    on = True
+                    break
+            if not on:
+                for kk in range(output_xor_indptr[ii], output_xor_indptr[ii + 1]):
+                    if xor_on[output_xors[kk]]:
+                        on = True
+                        break
+            if not on:
+                for kk in range(output_and_indptr[ii], output_and_indptr[ii + 1]):
+                    if and_on[output_ands[kk]]:
+                        on = True
+                        break
+            output_on[ii] = on
+
+        # 3. Wires: the 'or' of their outputs (and of wires with a direct edge).
+        for ii in range(len(current)):
+            on = False
+            for kk in range(wire_output_indptr[ii], wire_output_indptr[ii + 1]):
+                if output_on[wire_outputs[kk]]:
+                    on = True
+                    break
+            if not on:
+                for kk in range(wire_wire_indptr[ii], wire_wire_indptr[ii + 1]):
+                    if current[wire_wires[kk]]:
+                        on = True
+                        break
+            following[ii] = on
+        current, following = following, current
+
+    # After an odd number of ticks, the last state is in next_state.
+    if n % 2 == 1:
+        state[:] = next_state
+
+
+# The compiled kernel, or None without Numba. (Compiled on its first call, and
+# cached on disk, so only the first run ever pays for compiling.)
+_run_ticks_compiled = None if numba is None else numba.njit(cache = True, nogil = True)(_run_ticks)
+
+
+class JitSimulator:
+    """Simulate a Netlist with the fused kernel (see _run_ticks), compiled by
+    Numba, with the same results as Netlist.step(). Without Numba, this
+    falls back to stepping the netlist.
+
+    :param netlist: The compiled circuit to simulate.
+    :type netlist: netlist.Netlist
+    :param state: Boolean array of the initial state of every wire. It is
+        updated in place by run().
+    :type state: numpy.ndarray
+    :param use_numba: Set to False to fall back to Netlist.step() even when
+        Numba is installed.
+    :type use_numba: Bool
+
+    Member variables:
+    state: Boolean array, the current state of every wire.
+    compiled: True if ticks are run by the Numba kernel, False if they fall
+        back to Netlist.step().
+    """
+    def __init__(self, netlist, state, use_numba = True):
+        self.netlist = netlist
+        self.state = state
+        self.compiled = use_numba and _run_ticks_compiled is not None
+        if self.compiled:
+            self._arrays = fanin_arrays(netlist)
+            self._next_state = np.zeros(netlist.num_wires, dtype=bool)
+            self._scratch = (np.zeros(netlist.num_inputs, dtype=np.int64),
+                             np.zeros(netlist.num_xors, dtype=bool),
+                             np.zeros(netlist.num_ands, dtype=bool),
+                             np.zeros(netlist.num_outputs, dtype=bool))
+
+    def run(self, n = 1):
+        """Advance n ticks, updating state in place.
+
+        :param n: Number of ticks.
+        :type n: Int
+        """
+        if n <= 0:
+            return
+        if self.compiled:
+            _run_ticks_compiled(n, self.state, self._next_state, *self._arrays, *self._scratch)
+        else:
+            state = self.state
+            for _ in range(n):
+                state = self.netlist.step(state)
+            self.state[:] = state
+
+
+def fanin_arrays(netlist):
+    """Lay a netlist out as fan-in lists, for _run_ticks: for every kind of
+    element, the (indptr, indices) of the elements feeding each of them.
+
+    :param netlist: The netlist
+    :type netlist: netlist.Netlist
+
+    :returns: The arrays, in the order _run_ticks takes them (from
+        input_indptr to wire_wires).
+    :rtype: Tuple of numpy.ndarray
+    """
+    nl = netlist
+    # A fan-in list is a fan-out list with the edges turned around.
+    input_wires = _fanout(nl.wire_input_dst, nl.wire_input_src, nl.num_inputs)
+    xor_inputs = _fanout(nl.input_xor_dst, nl.input_xor_src, nl.num_xors)
+    and_inputs = _fanout(nl.input_and_dst, nl.input_and_src, nl.num_ands)
+    output_inputs = _fanout(nl.input_output_dst, nl.input_output_src, nl.num_outputs)
+    output_xors = _fanout(nl.xor_output_dst, nl.xor_output_src, nl.num_outputs)
+    output_ands = _fanout(nl.and_output_dst, nl.and_output_src, nl.num_outputs)
+    wire_outputs = _fanout(nl.output_wire_dst, nl.output_wire_src, nl.num_wires)
+    wire_wires = _fanout(nl.wire_wire_dst, nl.wire_wire_src, nl.num_wires)
+    arrays = (*input_wires, nl.input_degree,
+              *xor_inputs,
+              *and_inputs, nl.and_has_wires,
+              *output_inputs, *output_xors, *output_ands,
+              *wire_outputs, *wire_wires)
+    # 32 bit indices (where they fit) halve the memory every tick reads.
+    index_dtype = np.int32 if max(nl.num_edges, nl.num_wires) < 2**31 else np.int64
+    return tuple(array if array.dtype == bool else array.astype(index_dtype) for array in arrays)
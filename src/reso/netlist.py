@@ -0,0 +1,1032 @@
+'''netlist.py
+
+A compiled, array-based form of a Reso circuit.
+
+ResoBoard.iterate() walks the regions one at a time through adjacency dicts,
+which is easy to read but slow for big boards. A Netlist is the same circuit
+'compiled' down to flat integer index arrays, one pair of arrays per kind of
+edge:
+
+    wire   -> input
+    input  -> xor, input -> and, input -> output
+    xor    -> output, and -> output
+    output -> wire
+
+Every element of a kind gets an index: wires are numbered in the order given
+when compiling (ResoBoard uses orange, then sapphire, then lime wires), and
+inputs, xors, ands and outputs are numbered in order of their region IDs.
+
+A tick is then a handful of NumPy gathers, bincounts and scatters over boolean
+state vectors (see Netlist.step), with the exact same semantics as
+ResoBoard.iterate().
+
+Netlist.optimize() then cuts a compiled netlist down before it's simulated:
+logic that no wire reads is dropped, outputs driving the same wires are
+merged, and input -> output chains are collapsed into direct edges:
+
+    wire   -> wire
+'''
+
+import numpy as np
+
+from reso.palette import pO, pS, pL, pT, pt, pP, pp
+from reso.profiling import NULL_PROFILER
+from reso.regionmapper import _csr_positions
+
+
+# Kinds of elements in a netlist. Anything else (e.g. reserved colors) is NONE.
+NONE, WIRE, INPUT, XOR, AND, OUTPUT = range(6)
+
+# The kinds of elements, and of edges as (source kind, target kind). The edges
+# of a kind are stored as <source>_<target>_src and <source>_<target>_dst.
+_KINDS = ("wire", "input", "xor", "and", "output")
+_EDGE_KINDS = (("wire", "input"), ("input", "xor"), ("input", "and"), ("input", "output"),
+               ("xor", "output"), ("and", "output"), ("output", "wire"), ("wire", "wire"))
+
+
+class Netlist:
+    """A Reso circuit compiled into flat index arrays.
+
+    Each kind of edge is stored as a pair of arrays of the same length, e.g.
+    wire_input_src[k] -> wire_input_dst[k] means wire number wire_input_src[k]
+    is adjacent to input number wire_input_dst[k].
+
+    :param region_classes: The class of every region (per RegionMapper)
+    :type region_classes: numpy.ndarray
+    :param indptr: Region adjacency graph, CSR-style (per RegionMapper.adjacency)
+    :type indptr: numpy.ndarray
+    :param indices: Region adjacency graph, CSR-style (per RegionMapper.adjacency)
+    :type indices: numpy.ndarray
+    :param wire_regions: Region IDs of the wires, in the order wire states
+        should be stored.
+    :type wire_regions: numpy.ndarray
+
+    Member variables:
+    wire_regions, input_regions, xor_regions, and_regions, output_regions:
+        Region ID of each element of that kind.
+    wire_input_src, wire_input_dst, input_xor_src, input_xor_dst, input_and_src,
+    input_and_dst, input_output_src, input_output_dst, xor_output_src,
+    xor_output_dst, and_output_src, and_output_dst, output_wire_src,
+    output_wire_dst:
+        Edge lists, as pairs of index arrays.
+    wire_wire_src, wire_wire_dst:
+        Direct edges between wires, standing in for the input -> output chains
+        collapsed by optimize(). (Empty when compiled.)
+    index_in_kind: The index of every region amongst the elements of its kind,
+        or -1. (Only for compiled netlists, i.e. None after cone() or optimize().)
+    """
+    def __init__(self, region_classes, indptr, indices, wire_regions):
+        region_classes = np.asarray(region_classes)
+        n_regions = len(region_classes)
+
+        # Kind of every region, and its index amongst regions of the same kind.
+        kind = _kinds(region_classes)
+
+        self.wire_regions   = np.asarray(wire_regions, dtype=np.intp)
+        self.input_regions  = np.flatnonzero(kind == INPUT)
+        self.xor_regions    = np.flatnonzero(kind == XOR)
+        self.and_regions    = np.flatnonzero(kind == AND)
+        self.output_regions = np.flatnonzero(kind == OUTPUT)
+
+        index_in_kind = np.full(n_regions, -1, dtype=np.intp)
+        for regions in (self.wire_regions, self.input_regions, self.xor_regions,
+                        self.and_regions, self.output_regions):
+            index_in_kind[regions] = np.arange(len(regions))
+
+        # Expand the CSR adjacency graph to (source, target) region pairs.
+        sources = np.repeat(np.arange(n_regions), np.diff(indptr))
+        targets = np.asarray(indices, dtype=np.intp)
+        # Wires are only part of the netlist if they were given in wire_regions
+        source_kind = np.where(index_in_kind[sources] >= 0, kind[sources], NONE)
+        target_kind = np.where(index_in_kind[targets] >= 0, kind[targets], NONE)
+
+        def edges(from_kind, to_kind):
+            mask = (source_kind == from_kind) & (target_kind == to_kind)
+            return index_in_kind[sources[mask]], index_in_kind[targets[mask]]
+
+        self.wire_input_src,   self.wire_input_dst   = edges(WIRE, INPUT)
+        self.input_xor_src,    self.input_xor_dst    = edges(INPUT, XOR)
+        self.input_and_src,    self.input_and_dst    = edges(INPUT, AND)
+        self.input_output_src, self.input_output_dst = edges(INPUT, OUTPUT)
+        self.xor_output_src,   self.xor_output_dst   = edges(XOR, OUTPUT)
+        self.and_output_src,   self.and_output_dst   = edges(AND, OUTPUT)
+        self.output_wire_src,  self.output_wire_dst  = edges(OUTPUT, WIRE)
+        self.wire_wire_src = self.wire_wire_dst = np.zeros(0, dtype=np.intp)
+        self.index_in_kind = index_in_kind
+
+        self._init_helpers()
+
+    def _init_helpers(self):
+        # Static helpers used every tick:
+        # input_degree[i] is the number of wires touching input i, and an
+        # 'and' node only ever turns on if some input with wires touches it.
+        self.input_degree = np.bincount(self.wire_input_dst, minlength=self.num_inputs)
+        self.and_has_wires = np.zeros(self.num_ands, dtype=bool)
+        self.and_has_wires[self.input_and_dst[self.input_degree[self.input_and_src] > 0]] = True
+        # Edge groupings for step_lanes, built the first time it is called.
+        self._lane_segments = None
+
+    def cone(self, wires):
+        """Cut out the part of the netlist that the next state of some wires
+        depends on: the outputs touching those wires, the logic and inputs
+        feeding those outputs, and every wire touching those inputs.
+
+        Stepping the cone from the current state of its wires gives the exact
+        next state of the given wires (the other wires of the cone may be
+        missing some of their outputs). This is how netlists are split up to
+        be simulated in parallel (see parallel.py).
+
+        :param wires: Indices of the wires, in this netlist.
+        :type wires: numpy.ndarray
+
+        :returns: Tuple of (cone, cone_wires, owned): the cone as a Netlist,
+            the index in this netlist of every wire of the cone, and the index
+            in the cone of every wire given.
+        :rtype: Tuple of (Netlist, numpy.ndarray, numpy.ndarray)
+        """
+        wires = np.asarray(wires, dtype=np.intp)
+
+        # Walk back from the wires: outputs, then logic, then inputs, then wires.
+        given_mask = _mask(wires, self.num_wires)
+        output_mask = _mask(self.output_wire_src[given_mask[self.output_wire_dst]], self.num_outputs)
+        xor_mask = _mask(self.xor_output_src[output_mask[self.xor_output_dst]], self.num_xors)
+        and_mask = _mask(self.and_output_src[output_mask[self.and_output_dst]], self.num_ands)
+        input_mask = _mask(np.concatenate((
+            self.input_output_src[output_mask[self.input_output_dst]],
+            self.input_xor_src[xor_mask[self.input_xor_dst]],
+            self.input_and_src[and_mask[self.input_and_dst]])), self.num_inputs)
+        # Every wire touching an input is read, so the inputs keep their degree.
+        # (As is every wire with a direct edge to a given wire.)
+        wire_mask = given_mask.copy()
+        wire_mask[self.wire_input_src[input_mask[self.wire_input_dst]]] = True
+        wire_mask[self.wire_wire_src[given_mask[self.wire_wire_dst]]] = True
+
+        # Keep the edges into the cone's elements. (Outputs may also touch wires
+        # outside the cone, which are dropped.)
+        cone, index_maps = self._select({"wire" : wire_mask, "input" : input_mask, "xor" : xor_mask,
+                                         "and" : and_mask, "output" : output_mask})
+        return cone, np.flatnonzero(wire_mask), index_maps["wire"][wires]
+
+    def _select(self, masks):
+        """Cut out some of the elements of the netlist, and the edges between them.
+
+        :param masks: Dict of kind (e.g. "input") --> boolean array, True for
+            the elements of that kind to keep.
+        :type masks: Dict
+
+        :returns: Tuple of (netlist, index_maps): the new Netlist, and a dict
+            of kind --> the index in the new netlist of every element of that
+            kind, or -1 if it was dropped.
+        :rtype: Tuple of (Netlist, Dict)
+        """
+        selected = Netlist.__new__(Netlist)
+        index_maps = dict()
+        for kind in _KINDS:
+            kept = np.flatnonzero(masks[kind])
+            setattr(selected, kind + "_regions", getattr(self, kind + "_regions")[kept])
+            index_map = np.full(len(masks[kind]), -1, dtype=np.intp)
+            index_map[kept] = np.arange(len(kept))
+            index_maps[kind] = index_map
+
+        for src_kind, dst_kind in _EDGE_KINDS:
+            name = f"{src_kind}_{dst_kind}"
+            src, dst = getattr(self, name + "_src"), getattr(self, name + "_dst")
+            # (Masking first, so only the edges kept are renumbered.)
+            kept = masks[src_kind][src] & masks[dst_kind][dst]
+            setattr(selected, name + "_src", index_maps[src_kind][src[kept]])
+            setattr(selected, name + "_dst", index_maps[dst_kind][dst[kept]])
+        selected.index_in_kind = None
+        selected._init_helpers()
+        return selected, index_maps
+
+    def _keep_all(self):
+        """Masks for _select() keeping every element."""
+        return {kind : np.ones(len(getattr(self, kind + "_regions")), dtype=bool) for kind in _KINDS}
+
+    def optimize(self):
+        """Return a smaller netlist that steps every wire to exactly the same
+        states as this one.
+
+        Compiled boards hold elements that can't change any wire, e.g. inputs
+        touching no wires, logic feeding no outputs, or outputs touching no
+        wires, which ResoBoard.iterate() evaluates anyway. This:
+        1. Drops every input, xor, and and output that can never be on, or
+           that no wire reads (see _pruned).
+        2. Merges outputs that touch exactly the same wires into one: those
+           wires are on if any of them is, so the merged output is the 'or'
+           of all their sources.
+        3. Collapses 'pass-through' outputs, fed by nothing but inputs: such
+           an output is on iff any wire touching its inputs is on, so those
+           wires get direct edges (wire_wire_src -> wire_wire_dst) to the
+           wires of the output instead. (Only where that doesn't make more
+           edges than it removes, e.g. not for an output reading 10 wires
+           and driving 10 others.)
+        4. Drops the inputs that 3. left feeding nothing.
+
+        The wires are all kept, in the same order, so states of this netlist
+        and of the optimized one are interchangeable. Elements that are kept
+        keep their region ID (merged outputs keep the first one), but the
+        optimized netlist no longer describes the board region by region.
+
+        :returns: The optimized netlist.
+        :rtype: Netlist
+        """
+        return self._pruned()._merged_outputs()._collapsed_pass_throughs()._pruned()
+
+    def _pruned(self):
+        """Drop the inputs, logic and outputs that don't affect any wire (see
+        optimize): the ones that can never be on (inputs touching no wires,
+        xors seeing no such inputs, ands with no wires, and outputs fed by none
+        of those), and the ones not feeding a wire (through any of the above).
+        """
+        # Forwards, from the wires: what can ever be on.
+        input_can = self.input_degree > 0
+        xor_can = _mask(self.input_xor_dst[input_can[self.input_xor_src]], self.num_xors)
+        and_can = self.and_has_wires
+        output_can = _mask(np.concatenate((
+            self.input_output_dst[input_can[self.input_output_src]],
+            self.xor_output_dst[xor_can[self.xor_output_src]],
+            self.and_output_dst[and_can[self.and_output_src]])), self.num_outputs)
+
+        # Backwards, to the wires: what's read. (An 'and' keeps all its inputs
+        # with wires, as any of them can turn it off.)
+        output_live = output_can & _mask(self.output_wire_src, self.num_outputs)
+        xor_live = xor_can & _mask(self.xor_output_src[output_live[self.xor_output_dst]], self.num_xors)
+        and_live = and_can & _mask(self.and_output_src[output_live[self.and_output_dst]], self.num_ands)
+        input_live = input_can & _mask(np.concatenate((
+            self.input_output_src[output_live[self.input_output_dst]],
+            self.input_xor_src[xor_live[self.input_xor_dst]],
+            self.input_and_src[and_live[self.input_and_dst]])), self.num_inputs)
+
+        pruned, _ = self._select({"wire" : np.ones(self.num_wires, dtype=bool), "input" : input_live,
+                                  "xor" : xor_live, "and" : and_live, "output" : output_live})
+        return pruned
+
+    def _merged_outputs(self):
+        """Merge the outputs that touch exactly the same wires (see optimize)."""
+        num_outputs = self.num_outputs
+        sources, wires = _unique_edges(self.output_wire_src, self.output_wire_dst, self.num_wires)
+        indptr = np.zeros(num_outputs + 1, dtype=np.intp)
+        np.cumsum(np.bincount(sources, minlength=num_outputs), out=indptr[1:])
+        degree = np.diff(indptr)
+
+        # first[output] is the first output with the same (sorted) wires. Only
+        # outputs with as many wires can match, so compare them a degree at a
+        # time, as the rows of a matrix.
+        first = np.arange(num_outputs)
+        for wire_count in np.unique(degree[degree > 0]).tolist():
+            outputs = np.flatnonzero(degree == wire_count)
+            rows = wires[indptr[outputs][:, None] + np.arange(wire_count)]
+            # (Most outputs touch one wire, which is quicker to compare as a 1D array.)
+            _, firsts, inverse = np.unique(rows[:, 0] if wire_count == 1 else rows, axis=0,
+                                           return_index=True, return_inverse=True)
+            first[outputs] = outputs[firsts][inverse.reshape(-1)]
+
+        merged, index_maps = self._select(dict(self._keep_all(), output = first == np.arange(num_outputs)))
+        # Point every edge into a merged output at the output it was merged into.
+        # (Only outputs were dropped, so the sources keep their indices.)
+        output_map = index_maps["output"][first]
+        for src_kind in ("input", "xor", "and"):
+            name = f"{src_kind}_output"
+            src, dst = _unique_edges(getattr(self, name + "_src"),
+                                     output_map[getattr(self, name + "_dst")], merged.num_outputs)
+            setattr(merged, name + "_src", src)
+            setattr(merged, name + "_dst", dst)
+        return merged
+
+    def _collapsed_pass_throughs(self):
+        """Replace the outputs fed only by inputs with direct edges between
+        wires, where that takes fewer edges (see optimize).
+        """
+        num_outputs, num_wires = self.num_outputs, self.num_wires
+        candidates = _mask(self.input_output_dst, num_outputs)
+        candidates[self.xor_output_dst] = False
+        candidates[self.and_output_dst] = False
+
+        # The wires every candidate reads (through its inputs), and writes.
+        fed = candidates[self.input_output_dst]
+        read_wires, read_outputs = _push(_fanout(self.wire_input_dst, self.wire_input_src, self.num_inputs),
+                                         self.input_output_src[fed], self.input_output_dst[fed])
+        read_outputs, read_wires = _unique_edges(read_outputs, read_wires, num_wires)
+        written = candidates[self.output_wire_src]
+        written_outputs, written_wires = _unique_edges(self.output_wire_src[written],
+                                                       self.output_wire_dst[written], num_wires)
+
+        # Collapsing an output replaces its edges (from inputs, and to wires)
+        # with one edge per pair of a wire it reads and a wire it writes.
+        num_read = np.bincount(read_outputs, minlength=num_outputs)
+        num_written = np.bincount(written_outputs, minlength=num_outputs)
+        num_fed = np.bincount(self.input_output_dst[fed], minlength=num_outputs)
+        collapse = candidates & (num_read * num_written <= num_fed + num_written)
+
+        keep = collapse[read_outputs]
+        dst, src = _push(_fanout(written_outputs, written_wires, num_outputs),
+                         read_outputs[keep], read_wires[keep])
+        collapsed, _ = self._select(dict(self._keep_all(), output = ~collapse))
+        collapsed.wire_wire_src, collapsed.wire_wire_dst = _unique_edges(
+            np.concatenate((self.wire_wire_src, src)), np.concatenate((self.wire_wire_dst, dst)), num_wires)
+        return collapsed
+
+    def patched(self, region_classes, indptr, indices, new_id_of_old, new_regions, adjacent_changed):
+        """Return this compiled netlist, brought up to date after a patch
+        changed some of the regions it was compiled from (see
+        RegionMapper.apply_patch), without compiling it again.
+
+        Elements keep their indices (and wires their place in the state
+        vector): the elements of the new regions take the places of the ones
+        that are gone, and then the last elements of a kind are moved down
+        into any places left over (or new elements go at the end), like
+        RegionMapper.apply_patch numbers regions. Only the edges out of the
+        regions in adjacent_changed are compiled again, from their adjacency
+        lists; every other edge is kept.
+
+        :param region_classes: The class of every region, after the patch
+        :type region_classes: numpy.ndarray
+        :param indptr: Region adjacency graph after the patch, CSR-style
+        :type indptr: numpy.ndarray
+        :param indices: Region adjacency graph after the patch, CSR-style
+        :type indices: numpy.ndarray
+        :param new_id_of_old: As returned by RegionMapper.apply_patch
+        :type new_id_of_old: numpy.ndarray
+        :param new_regions: As returned by RegionMapper.apply_patch
+        :type new_regions: numpy.ndarray
+        :param adjacent_changed: As returned by RegionMapper.apply_patch
+        :type adjacent_changed: numpy.ndarray
+
+        :returns: Tuple of (netlist, renumberings, touched): the new Netlist,
+            a dict of kind (e.g. "wire") --> how the elements of that kind
+            were renumbered (a _Renumbering), and the indices of the wires
+            whose next state may no longer depend on the same things (the
+            new wires, and every wire an edge that changed leads to).
+        :rtype: Tuple of (Netlist, Dict, numpy.ndarray)
+        """
+        region_classes = np.asarray(region_classes)
+        n_regions = len(region_classes)
+        old_index_in_kind = self.index_in_kind
+
+        # The regions that are gone, the regions that were moved to new IDs,
+        # and the old IDs of the (kept) regions whose edges out are compiled again.
+        gone = np.flatnonzero(new_id_of_old < 0)
+        moved_from = n_regions + np.flatnonzero(new_id_of_old[n_regions:] >= 0)
+        moved_to = new_id_of_old[moved_from]
+        relisted = adjacent_changed[~np.isin(adjacent_changed, new_regions)]
+        is_moved = np.isin(relisted, moved_to)
+        relisted[is_moved] = moved_from[np.searchsorted(moved_to, relisted[is_moved])]
+
+        index_in_kind = np.concatenate((old_index_in_kind[:n_regions],
+                                        np.full(max(0, n_regions - len(old_index_in_kind)), -1, dtype=np.intp)))
+        index_in_kind[new_regions] = -1
+        index_in_kind[moved_to] = old_index_in_kind[moved_from]
+        new_kinds = _kinds(region_classes[new_regions])
+
+        patched = Netlist.__new__(Netlist)
+        renumberings, drop_edges_from, dirty = dict(), dict(), dict()
+        for kind_id, kind in enumerate(_KINDS, start=WIRE):
+            regions = getattr(self, kind + "_regions")
+
+            def elements(region_ids):
+                # The elements of this kind, of some (old) region IDs.
+                element_ids = old_index_in_kind[region_ids]
+                ours = (element_ids >= 0) & (element_ids < len(regions))
+                ours[ours] = regions[element_ids[ours]] == region_ids[ours]
+                return element_ids[ours], ours
+
+            removed, _ = elements(gone)
+            moved, ours = elements(moved_from)
+            drop_edges_from[kind] = _mask(np.concatenate((removed, elements(relisted)[0])), len(regions))
+
+            added_regions = new_regions[new_kinds == kind_id]
+            renumbering = _Renumbering(len(regions), removed, len(added_regions))
+            renumberings[kind] = renumbering
+            regions = regions.copy()
+            regions[moved] = moved_to[ours]
+            regions = renumbering.rearranged(regions, added_regions)
+            setattr(patched, kind + "_regions", regions)
+            index_in_kind[regions[renumbering.moved_to]] = renumbering.moved_to
+            index_in_kind[added_regions] = renumbering.added
+            dirty[kind] = [renumbering.added]
+
+        # The edges out of the regions in adjacent_changed, compiled again.
+        positions, row_of_position = _csr_positions(indptr, adjacent_changed)
+        sources = adjacent_changed[row_of_position]
+        targets = np.asarray(indices[positions], dtype=np.intp)
+        source_kind = np.where(index_in_kind[sources] >= 0, _kinds(region_classes[sources]), NONE)
+        target_kind = np.where(index_in_kind[targets] >= 0, _kinds(region_classes[targets]), NONE)
+
+        for src_kind, dst_kind in _EDGE_KINDS:
+            name = f"{src_kind}_{dst_kind}"
+            src, dst = getattr(self, name + "_src"), getattr(self, name + "_dst")
+            # Drop the edges out of the removed and relisted elements (and so
+            # into the removed ones), and renumber the rest.
+            dropped = drop_edges_from[src_kind][src] | renumberings[dst_kind].is_removed[dst]
+            if dropped.any():
+                dirty[dst_kind].append(renumberings[dst_kind].kept(dst[dropped]))
+                src, dst = src[~dropped], dst[~dropped]
+            src, dst = renumberings[src_kind].moved_down(src), renumberings[dst_kind].moved_down(dst)
+            if src_kind != dst_kind:
+                new = (source_kind == _KINDS.index(src_kind) + WIRE) & (target_kind == _KINDS.index(dst_kind) + WIRE)
+                new_dst = index_in_kind[targets[new]]
+                src = np.concatenate((src, index_in_kind[sources[new]]))
+                dst = np.concatenate((dst, new_dst))
+                dirty[dst_kind].append(new_dst)
+            setattr(patched, name + "_src", src)
+            setattr(patched, name + "_dst", dst)
+        patched.index_in_kind = index_in_kind
+        patched._init_helpers()
+
+        # Everything an edge that changed leads to, as far as the wires.
+        dirty = {kind : _mask(np.concatenate(dirty[kind]), len(getattr(patched, kind + "_regions")))
+                 for kind in _KINDS}
+        nl = patched
+        dirty["xor"][nl.input_xor_dst[dirty["input"][nl.input_xor_src]]] = True
+        dirty["and"][nl.input_and_dst[dirty["input"][nl.input_and_src]]] = True
+        for src_kind in ("input", "xor", "and"):
+            name = f"{src_kind}_output"
+            dirty["output"][getattr(nl, name + "_dst")[dirty[src_kind][getattr(nl, name + "_src")]]] = True
+        dirty["wire"][nl.output_wire_dst[dirty["output"][nl.output_wire_src]]] = True
+        return patched, renumberings, np.flatnonzero(dirty["wire"])
+
+    def reoptimized(self, optimized, renumberings, touched, new_id_of_old):
+        """Bring optimize() of this netlist from before a patch up to date
+        (see patched), by optimizing only the part of this netlist that the
+        touched wires depend on, rather than all of it.
+
+        optimize() never looks further than an output, the logic and inputs
+        feeding it, and the wires around those. So the outputs and direct
+        edges into the touched wires are dropped from the old optimized
+        netlist, along with the logic and inputs that only fed them, and the
+        outputs into the touched wires (with everything feeding them, and
+        every wire they touch) are cut out of this netlist, optimized on
+        their own, and added in their place. Every wire then steps exactly
+        as it would with optimize(), though some inputs may be there twice
+        (once for the touched wires, and once for the others).
+
+        :param optimized: optimize() of this netlist from before the patch
+        :type optimized: Netlist
+        :param renumberings: The renumberings returned by patched()
+        :type renumberings: Dict
+        :param touched: The touched wires returned by patched()
+        :type touched: numpy.ndarray
+        :param new_id_of_old: As returned by RegionMapper.apply_patch, to
+            give the elements that are kept their new region IDs.
+        :type new_id_of_old: numpy.ndarray
+
+        :returns: The optimized netlist
+        :rtype: Netlist
+        """
+        wires = renumberings["wire"]
+        touched_mask = _mask(touched, self.num_wires)
+
+        # 1. The outputs into the touched wires, and what they depend on.
+        output_mask = _mask(self.output_wire_src[touched_mask[self.output_wire_dst]], self.num_outputs)
+        xor_mask = _mask(self.xor_output_src[output_mask[self.xor_output_dst]], self.num_xors)
+        and_mask = _mask(self.and_output_src[output_mask[self.and_output_dst]], self.num_ands)
+        input_mask = _mask(np.concatenate((
+            self.input_output_src[output_mask[self.input_output_dst]],
+            self.input_xor_src[xor_mask[self.input_xor_dst]],
+            self.input_and_src[and_mask[self.input_and_dst]])), self.num_inputs)
+        wire_mask = touched_mask.copy()
+        wire_mask[self.wire_input_src[input_mask[self.wire_input_dst]]] = True
+        wire_mask[self.output_wire_dst[output_mask[self.output_wire_src]]] = True
+        piece, _ = self._select({"wire" : wire_mask, "input" : input_mask, "xor" : xor_mask,
+                                 "and" : and_mask, "output" : output_mask})
+        piece = piece.optimize()
+        piece_wires = np.flatnonzero(wire_mask)
+
+        # 2. What's left of the old optimized netlist: everything but the
+        #    outputs into the touched wires (in the old numbering, where the
+        #    wires that are gone count as touched), and what only fed them.
+        old = optimized
+        old_touched = np.zeros(wires.num, dtype=bool)
+        num_kept = min(wires.num, wires.num_after)
+        old_touched[:num_kept] = touched_mask[:num_kept]
+        old_touched[wires.moved_from] = touched_mask[wires.moved_to]
+        old_touched |= wires.is_removed
+        kept = {"wire" : ~wires.is_removed}
+        kept["output"] = ~_mask(old.output_wire_src[old_touched[old.output_wire_dst]], old.num_outputs)
+        kept["xor"] = _mask(old.xor_output_src[kept["output"][old.xor_output_dst]], old.num_xors)
+        kept["and"] = _mask(old.and_output_src[kept["output"][old.and_output_dst]], old.num_ands)
+        kept["input"] = _mask(np.concatenate((
+            old.input_output_src[kept["output"][old.input_output_dst]],
+            old.input_xor_src[kept["xor"][old.input_xor_dst]],
+            old.input_and_src[kept["and"][old.input_and_dst]])), old.num_inputs)
+
+        # 3. Put the two together: the elements of the piece take the places
+        #    of the ones dropped (see patched), and the direct edges both
+        #    have into untouched wires are only kept once.
+        reoptimized = Netlist.__new__(Netlist)
+        reoptimized.wire_regions = self.wire_regions
+        new_index = {"wire" : piece_wires}
+        renumbered = {"wire" : wires}
+        num_regions = len(self.index_in_kind)
+        for kind in _KINDS[1:]:
+            renumbering = _Renumbering(len(kept[kind]), np.flatnonzero(~kept[kind]),
+                                       len(getattr(piece, kind + "_regions")))
+            regions = getattr(old, kind + "_regions")
+            moved = np.flatnonzero(regions >= num_regions)
+            if len(moved) > 0:
+                regions = regions.copy()
+                regions[moved] = new_id_of_old[regions[moved]]
+            setattr(reoptimized, kind + "_regions",
+                    renumbering.rearranged(regions, getattr(piece, kind + "_regions")))
+            new_index[kind] = renumbering.added
+            renumbered[kind] = renumbering
+        for src_kind, dst_kind in _EDGE_KINDS:
+            name = f"{src_kind}_{dst_kind}"
+            src, dst = getattr(old, name + "_src"), getattr(old, name + "_dst")
+            keep = kept[src_kind][src] & kept[dst_kind][dst]
+            if name == "wire_wire":
+                keep &= ~old_touched[dst]
+            src = np.concatenate((renumbered[src_kind].moved_down(src[keep]),
+                                  new_index[src_kind][getattr(piece, name + "_src")]))
+            dst = np.concatenate((renumbered[dst_kind].moved_down(dst[keep]),
+                                  new_index[dst_kind][getattr(piece, name + "_dst")]))
+            setattr(reoptimized, name + "_src", src)
+            setattr(reoptimized, name + "_dst", dst)
+
+        # (A pass-through collapsed in the piece, and writing a wire that
+        # isn't touched, was collapsed the same way before.)
+        shared = _mask(piece_wires[piece.wire_wire_dst], self.num_wires) & ~touched_mask
+        twice = shared[reoptimized.wire_wire_dst]
+        if twice.any():
+            src, dst = _unique_edges(reoptimized.wire_wire_src[twice], reoptimized.wire_wire_dst[twice],
+                                     self.num_wires)
+            reoptimized.wire_wire_src = np.concatenate((reoptimized.wire_wire_src[~twice], src))
+            reoptimized.wire_wire_dst = np.concatenate((reoptimized.wire_wire_dst[~twice], dst))
+        reoptimized.index_in_kind = None
+        reoptimized._init_helpers()
+        return reoptimized
+
+    @property
+    def num_wires(self):
+        return len(self.wire_regions)
+
+    @property
+    def num_inputs(self):
+        return len(self.input_regions)
+
+    @property
+    def num_xors(self):
+        return len(self.xor_regions)
+
+    @property
+    def num_ands(self):
+        return len(self.and_regions)
+
+    @property
+    def num_outputs(self):
+        return len(self.output_regions)
+
+    @property
+    def num_edges(self):
+        return sum(len(getattr(self, f"{src_kind}_{dst_kind}_src")) for src_kind, dst_kind in _EDGE_KINDS)
+
+    def step(self, state, profiler = NULL_PROFILER):
+        """Compute the next state of every wire.
+
+        This is ResoBoard.iterate(), over arrays:
+        1. Count the 'on' wires touching each input node.
+           An 'xor' node is on if it sees an odd number of 'on' wires through
+           its inputs, and an 'and' node is on if it sees at least one wire,
+           and every wire it sees is 'on'.
+        2. An output node is on if any adjacent input (with an 'on' wire), xor
+           or and is on.
+        3. A wire is on if any adjacent output node is on (or, after
+           optimize(), any wire with a direct edge to it).
+
+        :param state: Boolean array of shape (num_wires,)
+        :type state: numpy.ndarray
+        :param profiler: profiling.Profiler to time the three steps with
+            ("tick.logic", "tick.outputs" and "tick.wires")
+        :type profiler: profiling.Profiler
+
+        :returns: Boolean array of shape (num_wires,), the next state
+        :rtype: numpy.ndarray
+        """
+        # 1. Input nodes, then logic nodes.
+        with profiler.phase("tick.logic"):
+            input_count = np.bincount(self.wire_input_dst[state[self.wire_input_src]],
+                                      minlength=self.num_inputs)
+            input_on = input_count > 0
+
+            # Each input contributes input_count paths; only the parity matters.
+            input_odd = (input_count & 1).astype(bool)
+            xor_on = (np.bincount(self.input_xor_dst[input_odd[self.input_xor_src]],
+                                  minlength=self.num_xors) & 1).astype(bool)
+
+            # An 'and' turns off for good if it sees even one 'off' wire.
+            input_sees_off = input_count < self.input_degree
+            and_sees_off = np.zeros(self.num_ands, dtype=bool)
+            and_sees_off[self.input_and_dst[input_sees_off[self.input_and_src]]] = True
+            and_on = self.and_has_wires & ~and_sees_off
+
+        # 2. Output nodes. (Scattering True is a logical 'or'.)
+        with profiler.phase("tick.outputs"):
+            output_on = np.zeros(self.num_outputs, dtype=bool)
+            output_on[self.input_output_dst[input_on[self.input_output_src]]] = True
+            output_on[self.xor_output_dst[xor_on[self.xor_output_src]]] = True
+            output_on[self.and_output_dst[and_on[self.and_output_src]]] = True
+
+        # 3. Wires.
+        with profiler.phase("tick.wires"):
+            next_state = np.zeros(self.num_wires, dtype=bool)
+            next_state[self.output_wire_dst[output_on[self.output_wire_src]]] = True
+            next_state[self.wire_wire_dst[state[self.wire_wire_src]]] = True
+        return next_state
+
+    def step_lanes(self, lanes):
+        """Compute the next state of every wire, for many simulations at once.
+
+        Every bit of lanes[wire] is the state of that wire in a different,
+        independent simulation (see pack_lanes), so one call advances
+        64 * lanes.shape[1] simulations by one tick. The logic is the same as
+        step(), rewritten with bitwise operations:
+        1. An input is 'on' if any of its wires is on (OR), contributes the
+           parity of its 'on' wires to xors (XOR), and is 'all on' if every
+           one of its wires is on (AND).
+           An 'xor' is the XOR of its inputs, and an 'and' is the AND of its
+           inputs that touch any wires (and is off if there are none).
+        2. Outputs are the OR of adjacent inputs, xors and ands.
+        3. Wires are the OR of adjacent outputs (and of wires with a direct edge).
+
+        :param lanes: uint64 array of shape (num_wires, number of words)
+        :type lanes: numpy.ndarray
+
+        :returns: uint64 array of the same shape, the next state
+        :rtype: numpy.ndarray
+        """
+        if self._lane_segments is None:
+            self._lane_segments = {
+                name: _segments(getattr(self, name + '_dst'))
+                for name in ('wire_input', 'input_xor', 'input_and', 'input_output',
+                             'xor_output', 'and_output', 'output_wire', 'wire_wire')
+            }
+            # Only inputs that touch a wire take part in an 'and'.
+            has_wires = self.input_degree[self.input_and_src] > 0
+            self._lane_segments['input_and'] = _segments(
+                np.where(has_wires, self.input_and_dst, -1))
+        segments = self._lane_segments
+        n_words = lanes.shape[1]
+        all_on = np.uint64(0xFFFFFFFFFFFFFFFF)
+
+        # 1. Input nodes, then logic nodes.
+        wire_lanes = lanes[self.wire_input_src]
+        input_or = np.zeros((self.num_inputs, n_words), dtype=np.uint64)
+        input_xor = np.zeros((self.num_inputs, n_words), dtype=np.uint64)
+        input_and = np.full((self.num_inputs, n_words), all_on, dtype=np.uint64)
+        _reduce_into(np.bitwise_or, input_or, segments['wire_input'], wire_lanes)
+        _reduce_into(np.bitwise_xor, input_xor, segments['wire_input'], wire_lanes)
+        _reduce_into(np.bitwise_and, input_and, segments['wire_input'], wire_lanes)
+
+        xor_on = np.zeros((self.num_xors, n_words), dtype=np.uint64)
+        _reduce_into(np.bitwise_xor, xor_on, segments['input_xor'], input_xor[self.input_xor_src])
+
+        and_on = np.full((self.num_ands, n_words), all_on, dtype=np.uint64)
+        _reduce_into(np.bitwise_and, and_on, segments['input_and'], input_and[self.input_and_src])
+        and_on[~self.and_has_wires] = 0
+
+        # 2. Output nodes.
+        output_on = np.zeros((self.num_outputs, n_words), dtype=np.uint64)
+        _reduce_into(np.bitwise_or, output_on, segments['input_output'], input_or[self.input_output_src])
+        _reduce_into(np.bitwise_or, output_on, segments['xor_output'], xor_on[self.xor_output_src])
+        _reduce_into(np.bitwise_or, output_on, segments['and_output'], and_on[self.and_output_src])
+
+        # 3. Wires.
+        next_lanes = np.zeros((self.num_wires, n_words), dtype=np.uint64)
+        _reduce_into(np.bitwise_or, next_lanes, segments['output_wire'], output_on[self.output_wire_src])
+        _reduce_into(np.bitwise_or, next_lanes, segments['wire_wire'], lanes[self.wire_wire_src])
+        return next_lanes
+
+
+def pack_lanes(states):
+    """Pack a (number of simulations, number of wires) boolean array into
+    uint64 lanes for Netlist.step_lanes: bit k of word j of lanes[wire] is
+    the state of that wire in simulation 64*j + k.
+
+    :param states: Boolean array of shape (number of simulations, number of wires)
+    :type states: numpy.ndarray
+
+    :returns: uint64 array of shape (number of wires, ceil(simulations / 64))
+    :rtype: numpy.ndarray
+
+    >>> states = np.zeros((70, 2), dtype=bool); states[65, 1] = True
+    >>> pack_lanes(states).shape, int(pack_lanes(states)[1, 1])
+    ((2, 2), 2)
+    """
+    states = np.asarray(states, dtype=bool)
+    n_simulations, n_wires = states.shape
+    n_words = (n_simulations + 63) // 64
+    padded = np.zeros((n_wires, n_words * 64), dtype=bool)
+    padded[:, :n_simulations] = states.T
+    packed = np.packbits(padded, axis=1, bitorder='little')
+    return packed.view('<u8').astype(np.uint64)
+
+
+def unpack_lanes(lanes, n_simulations):
+    """Undo pack_lanes.
+
+    :param lanes: uint64 array of shape (number of wires, number of words)
+    :type lanes: numpy.ndarray
+    :param n_simulations: Number of simulations packed into the lanes
+    :type n_simulations: Int
+
+    :returns: Boolean array of shape (n_simulations, number of wires)
+    :rtype: numpy.ndarray
+    """
+    packed = np.ascontiguousarray(lanes, dtype='<u8').view(np.uint8)
+    states = np.unpackbits(packed, axis=1, count=n_simulations, bitorder='little')
+    return states.T.astype(bool)
+
+
+def _mask(indices, length):
+    """Boolean array of the given length, True at indices."""
+    mask = np.zeros(length, dtype=bool)
+    mask[indices] = True
+    return mask
+
+
+def _kinds(region_classes):
+    """The kind (WIRE, INPUT, ...) of every region, from its class."""
+    kind = np.full(len(region_classes), NONE, dtype=np.int8)
+    kind[np.isin(region_classes, (pO, pS, pL))] = WIRE
+    kind[region_classes == pp] = INPUT
+    kind[region_classes == pT] = XOR
+    kind[region_classes == pt] = AND
+    kind[region_classes == pP] = OUTPUT
+    return kind
+
+
+class _Renumbering:
+    """How the elements of one kind of a netlist are renumbered when some
+    are removed and others added (see Netlist.patched): the added elements
+    take the places of the removed ones first, and then the last elements are
+    moved down into any places left over, or the added elements go at the end.
+    (The same way RegionMapper.apply_patch numbers regions.)
+
+    So only elements at num_after or above are moved, and their new indices
+    are found without looking up every index.
+
+    :param num: Number of elements before
+    :type num: Int
+    :param removed: Indices of the removed elements
+    :type removed: numpy.ndarray
+    :param num_added: Number of elements added
+    :type num_added: Int
+
+    Member variables:
+    num, num_after: The number of elements before, and after.
+    is_removed: Boolean array, True for the (old) index of every removed element.
+    added: The new index of every added element.
+    moved_from, moved_to: The old and new indices of the elements moved down.
+    """
+    def __init__(self, num, removed, num_added):
+        removed = np.unique(np.asarray(removed, dtype=np.intp))
+        self.num = num
+        self.num_after = num - len(removed) + num_added
+        self.is_removed = _mask(removed, num)
+        if num_added <= len(removed):
+            self.added = removed[:num_added]
+            gaps = removed[num_added:]
+            self.moved_to = gaps[gaps < self.num_after]
+            self.moved_from = np.setdiff1d(np.arange(self.num_after, num), removed)
+        else:
+            self.added = np.concatenate((removed, np.arange(num, self.num_after)))
+            self.moved_from = self.moved_to = np.zeros(0, dtype=np.intp)
+
+    def moved_down(self, indices):
+        """The new indices of some elements that were kept."""
+        moved = np.flatnonzero(indices >= self.num_after)
+        if len(moved) == 0:
+            return indices
+        indices = indices.copy()
+        indices[moved] = self.moved_to[np.searchsorted(self.moved_from, indices[moved])]
+        return indices
+
+    def kept(self, indices):
+        """The new indices of the elements that were kept, amongst some."""
+        return self.moved_down(indices[~self.is_removed[indices]])
+
+    def rearranged(self, values, added_values):
+        """An array of values per element, from one per old element and one
+        per added element."""
+        rearranged = np.empty((self.num_after,) + values.shape[1:], dtype=values.dtype)
+        num_kept = min(self.num, self.num_after)
+        rearranged[:num_kept] = values[:num_kept]
+        rearranged[self.moved_to] = values[self.moved_from]
+        rearranged[self.added] = added_values
+        return rearranged
+
+
+def _unique_edges(sources, targets, num_targets):
+    """Drop repeated edges from a list of edges, sorting it by source, then
+    target.
+
+    :returns: Tuple of (sources, targets)
+    :rtype: tuple of numpy.ndarray
+    """
+    num_targets = max(num_targets, 1)
+    # (Sorting, then dropping repeats, is quicker than np.unique here.)
+    pairs = np.sort(np.asarray(sources, dtype=np.int64) * num_targets + targets)
+    pairs = pairs[np.r_[True, pairs[1:] != pairs[:-1]]] if len(pairs) > 0 else pairs
+    return (pairs // num_targets).astype(np.intp), (pairs % num_targets).astype(np.intp)
+
+
+def _segments(targets):
+    """Group a list of edges by target, for _reduce_into. Negative targets
+    are left out.
+
+    :returns: Tuple of (order, distinct targets, start of each group in order)
+    :rtype: tuple of numpy.ndarray
+    """
+    order = np.argsort(targets, kind='stable')
+    order = order[targets[order] >= 0]
+    sorted_targets = targets[order]
+    starts = np.flatnonzero(np.r_[True, sorted_targets[1:] != sorted_targets[:-1]]) \
+        if len(order) > 0 else np.zeros(0, dtype=np.intp)
+    return order, sorted_targets[starts], starts
+
+
+def _reduce_into(ufunc, out, segments, values):
+    """out[t] = ufunc(out[t], ufunc.reduce(values of the edges into t)), for
+    every target t. (A faster ufunc.at, using reduceat over sorted edges.)
+    """
+    order, targets, starts = segments
+    if len(order) > 0:
+        out[targets] = ufunc(out[targets], ufunc.reduceat(values[order], starts, axis=0))
+
+
+def _fanout(sources, targets, n_sources):
+    """Sort a list of edges by source, CSR-style, so the targets of source s
+    are targets[indptr[s]:indptr[s+1]].
+
+    :returns: Tuple of (indptr, targets)
+    :rtype: tuple of numpy.ndarray
+    """
+    order = np.argsort(sources, kind='stable')
+    indptr = np.zeros(n_sources + 1, dtype=np.intp)
+    np.cumsum(np.bincount(sources, minlength=n_sources), out=indptr[1:])
+    return indptr, targets[order]
+
+
+def _push(fanout, sources, deltas):
+    """Send a delta from each source along all its edges in a fanout.
+
+    :returns: Tuple of (targets, deltas), one entry per edge followed.
+    :rtype: tuple of numpy.ndarray
+    """
+    indptr, targets = fanout
+    positions, row = _csr_positions(indptr, sources)
+    return targets[positions], deltas[row]
+
+
+def _apply(counts, targets, deltas):
+    """Add deltas to counts[targets] (targets may repeat), in place.
+
+    :returns: Tuple of (touched, old, new): the distinct targets, and their
+        counts before and after.
+    :rtype: tuple of numpy.ndarray
+    """
+    touched, inverse = np.unique(targets, return_inverse=True)
+    total = np.bincount(inverse, weights=deltas, minlength=len(touched)).astype(counts.dtype)
+    counts[touched] += total
+    new = counts[touched]
+    return touched, new - total, new
+
+
+def _flips(touched, was_on, is_on):
+    """Given elements and their old/new on-ness, return the ones that changed,
+    and +1 (turned on) or -1 (turned off) for each.
+    """
+    flipped = was_on != is_on
+    return touched[flipped], np.where(is_on[flipped], 1, -1)
+
+
+class EventSimulator:
+    """Event-driven simulation of a Netlist.
+
+    Rather than re-evaluating every element every tick (like Netlist.step),
+    this keeps, for every element, a count of how many of the things feeding
+    it are 'on'. When a wire changes, only the counts along its fan-out
+    (input -> logic -> output -> wire) are updated, so the cost of a tick
+    scales with the number of wires that changed, not with the board size.
+
+    The counts always describe the current state, so a wire's next state is
+    just (wire_count > 0). The wires for which that differs from their
+    current state are 'pending': they are exactly the wires that flip on
+    the next tick.
+
+    :param netlist: The compiled circuit to simulate.
+    :type netlist: Netlist
+    :param state: Boolean array of the initial state of every wire. It is
+        updated in place by step().
+    :type state: numpy.ndarray
+    :param profiler: profiling.Profiler to time the steps of every tick with
+        ("tick.logic", "tick.outputs" and "tick.wires")
+    :type profiler: profiling.Profiler
+
+    Member variables:
+    state: Boolean array, the current state of every wire.
+    input_count, xor_count, and_off_count, output_count, wire_count:
+        Per element, the number of 'on' wires seen by an input, of 'on' wire
+        paths seen by an xor, of inputs with an 'off' wire seen by an and,
+        and of 'on' elements feeding an output or a wire (outputs, and wires
+        with a direct edge).
+    pending: Indices of the wires that will flip on the next step().
+    """
+    def __init__(self, netlist, state, profiler = NULL_PROFILER):
+        self.netlist = netlist
+        self.state = state
+        self.profiler = profiler
+        nl = netlist
+
+        self._wire_input    = _fanout(nl.wire_input_src, nl.wire_input_dst, nl.num_wires)
+        self._input_xor     = _fanout(nl.input_xor_src, nl.input_xor_dst, nl.num_inputs)
+        self._input_and     = _fanout(nl.input_and_src, nl.input_and_dst, nl.num_inputs)
+        self._input_output  = _fanout(nl.input_output_src, nl.input_output_dst, nl.num_inputs)
+        self._xor_output    = _fanout(nl.xor_output_src, nl.xor_output_dst, nl.num_xors)
+        self._and_output    = _fanout(nl.and_output_src, nl.and_output_dst, nl.num_ands)
+        self._output_wire   = _fanout(nl.output_wire_src, nl.output_wire_dst, nl.num_outputs)
+        self._wire_wire     = _fanout(nl.wire_wire_src, nl.wire_wire_dst, nl.num_wires)
+
+        # Evaluate every count once, from scratch.
+        self.input_count = np.bincount(nl.wire_input_dst[state[nl.wire_input_src]],
+                                       minlength=nl.num_inputs).astype(np.int64)
+        self.xor_count = np.zeros(nl.num_xors, dtype=np.int64)
+        np.add.at(self.xor_count, nl.input_xor_dst, self.input_count[nl.input_xor_src])
+        input_sees_off = self.input_count < nl.input_degree
+        self.and_off_count = np.bincount(nl.input_and_dst[input_sees_off[nl.input_and_src]],
+                                         minlength=nl.num_ands).astype(np.int64)
+
+        input_on = self.input_count > 0
+        xor_on = (self.xor_count & 1).astype(bool)
+        and_on = nl.and_has_wires & (self.and_off_count == 0)
+        self.output_count = (
+            np.bincount(nl.input_output_dst[input_on[nl.input_output_src]], minlength=nl.num_outputs) +
+            np.bincount(nl.xor_output_dst[xor_on[nl.xor_output_src]], minlength=nl.num_outputs) +
+            np.bincount(nl.and_output_dst[and_on[nl.and_output_src]], minlength=nl.num_outputs)
+        ).astype(np.int64)
+        output_on = self.output_count > 0
+        self.wire_count = (
+            np.bincount(nl.output_wire_dst[output_on[nl.output_wire_src]], minlength=nl.num_wires) +
+            np.bincount(nl.wire_wire_dst[state[nl.wire_wire_src]], minlength=nl.num_wires)
+        ).astype(np.int64)
+
+        self.pending = np.flatnonzero((self.wire_count > 0) != state)
+
+    def step(self):
+        """Advance one tick, updating state in place.
+
+        :returns: Indices of the wires that changed state this tick.
+        :rtype: numpy.ndarray
+        """
+        changed = self.pending
+        if len(changed) == 0:
+            return changed
+        nl = self.netlist
+        phase = self.profiler.phase
+        self.state[changed] = ~self.state[changed]
+        changed_deltas = np.where(self.state[changed], 1, -1)
+
+        with phase("tick.logic"):
+            # Wires -> inputs
+            targets, deltas = _push(self._wire_input, changed, changed_deltas)
+            inputs, old, new = _apply(self.input_count, targets, deltas)
+
+            # Inputs -> xors. Xors count 'on' paths, so they take the raw deltas.
+            targets, deltas = _push(self._input_xor, inputs, new - old)
+            xors, xor_old, xor_new = _apply(self.xor_count, targets, deltas)
+
+            # Inputs -> ands. Ands count inputs that see an 'off' wire.
+            degree = nl.input_degree[inputs]
+            sources, deltas = _flips(inputs, old < degree, new < degree)
+            targets, deltas = _push(self._input_and, sources, deltas)
+            ands, and_old, and_new = _apply(self.and_off_count, targets, deltas)
+
+        # Inputs, xors and ands -> outputs
+        with phase("tick.outputs"):
+            output_targets, output_deltas = [], []
+            for fanout, (sources, deltas) in (
+                (self._input_output, _flips(inputs, old > 0, new > 0)),
+                (self._xor_output, _flips(xors, (xor_old & 1) == 1, (xor_new & 1) == 1)),
+                (self._and_output, _flips(ands, nl.and_has_wires[ands] & (and_old == 0),
+                                                nl.and_has_wires[ands] & (and_new == 0)))
+            ):
+                targets, deltas = _push(fanout, sources, deltas)
+                output_targets.append(targets)
+                output_deltas.append(deltas)
+            outputs, old, new = _apply(self.output_count,
+                                       np.concatenate(output_targets),
+                                       np.concatenate(output_deltas))
+
+        # Outputs (and wires, through direct edges) -> wires
+        with phase("tick.wires"):
+            targets, deltas = _push(self._output_wire, *_flips(outputs, old > 0, new > 0))
+            wire_targets, wire_deltas = _push(self._wire_wire, changed, changed_deltas)
+            wires, _, _ = _apply(self.wire_count, np.concatenate((targets, wire_targets)),
+                                 np.concatenate((deltas, wire_deltas)))
+
+            # Only wires whose count changed, or that just flipped, can be pending.
+            candidates = np.union1d(wires, changed)
+            self.pending = candidates[(self.wire_count[candidates] > 0) != self.state[candidates]]
+        self.profiler.count("tick.wires_changed", len(changed))
+        return changed
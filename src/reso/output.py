@@ -0,0 +1,450 @@
+'''output.py
+
+Writing the frames of a simulation to disk.
+
+Encoding a PNG is usually much slower than simulating a tick, so the CLI hands
+frames to a PNGWriterPool, which compresses and saves them on a pool of worker
+threads while the simulation carries on. Given a palette (e.g.
+ResoBoard.get_resel_palette()), it saves the resel map instead, as an 8-bit
+palette PNG, which is a third of the size of an RGB frame to copy and encode.
+
+Alternatively, every frame can be streamed into one file (or pipe):
+IndexedFrames iterates a board and yields palette-indexed frames, in which only
+the wire pixels ever change, and GIFWriter, APNGWriter and RawWriter write them
+out one at a time. Only the part of each frame that changed is encoded, and no
+frame is kept around after it is written.
+'''
+
+import os
+import struct
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image, GifImagePlugin
+
+
+def save_png(frame, path, compress_level = 6, palette = None):
+    """Save a frame to a PNG file.
+
+    With a palette, the frame is saved as an 8-bit palette-indexed PNG: a
+    third of the size of an RGB frame, to copy and to compress. E.g. a resel
+    map with ResoBoard.get_resel_palette() saves the board (with anything
+    that isn't a resel black), and loads straight back into resels (see
+    resoboard.load_indexed_image).
+
+    :param frame: Array of shape (h, w, 3), i.e. indexed [y, x] like PIL
+        expects, or of shape (h, w) of uint8 palette indices.
+    :type frame: numpy.ndarray
+    :param path: Location to save the image to.
+    :type path: String
+    :param compress_level: zlib compression level, from 0 (none, fastest) to
+        9 (smallest, slowest).
+    :type compress_level: Int
+    :param palette: If given, the RGB color of every index in frame, as an
+        array of shape (at most 256, 3).
+    :type palette: numpy.ndarray
+
+    :raises ValueError: If a palette is given, but frame isn't 2D uint8, or
+        the palette has more than 256 colors.
+    """
+    if palette is None:
+        Image.fromarray(frame).save(path, compress_level = compress_level)
+        return
+    palette = np.asarray(palette, dtype=np.uint8)
+    if frame.ndim != 2 or frame.dtype != np.uint8 or palette.shape[1:] != (3,) or len(palette) > 256:
+        raise ValueError("A palette PNG needs a 2D uint8 frame, and at most 256 RGB colors")
+    image = Image.fromarray(frame, mode = "L")
+    image.putpalette(palette.tobytes())
+    image.save(path, compress_level = compress_level)
+
+
+class PNGWriterPool:
+    """Save images as PNGs in the background, on a pool of worker threads (or
+    processes).
+
+    submit() takes a snapshot of the image and returns straight away, unless
+    max_pending frames are already waiting to be saved, in which case it
+    blocks until one is done. (This 'backpressure' keeps memory bounded if the
+    simulation runs faster than the workers can compress.)
+
+    Use it as a context manager, so that every frame is saved (and any error
+    raised) before moving on:
+
+        with PNGWriterPool(workers = 4) as writer:
+            for ii in range(10):
+                writer.submit(board.get_image(), f"frame_{ii}.png")
+                board.iterate()
+
+    :param workers: Number of worker threads. 0 saves every frame immediately,
+        in submit(), without any background workers.
+    :type workers: Int
+    :param compress_level: zlib compression level, from 0 (none, fastest) to
+        9 (smallest, slowest).
+    :type compress_level: Int
+    :param max_pending: Most frames waiting to be saved at once. Defaults to
+        twice the number of workers.
+    :type max_pending: Int
+    :param processes: If True, use worker processes instead of threads. (Pillow
+        releases the GIL while compressing, so threads are usually enough.)
+    :type processes: Bool
+    """
+    def __init__(self, workers = os.cpu_count() or 1, compress_level = 6,
+                 max_pending = None, processes = False):
+        if workers < 0:
+            raise ValueError(f"workers should be non-negative, got {workers}")
+        if not 0 <= compress_level <= 9:
+            raise ValueError(f"compress_level should be in 0..9, got {compress_level}")
+        if max_pending is None:
+            max_pending = 2 * max(workers, 1)
+        if max_pending < 1:
+            raise ValueError(f"max_pending should be at least 1, got {max_pending}")
+
+        self.compress_level = compress_level
+        self._executor = None
+        if workers > 0:
+            executor_class = ProcessPoolExecutor if processes else ThreadPoolExecutor
+            self._executor = executor_class(max_workers = workers)
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._errors = []
+
+    def submit(self, image, path, palette = None):
+        """Save a snapshot of image to path, in the background.
+
+        :param image: Array of shape (w, h, 3), indexed [x, y], e.g. from
+            ResoBoard.get_image(). (Or of shape (w, h), with a palette, e.g.
+            from ResoBoard.get_resel_map().) It is copied, so it can be
+            changed as soon as submit() returns.
+        :type image: numpy.ndarray
+        :param path: Location to save the image to.
+        :type path: String
+        :param palette: If given, save an 8-bit palette PNG (see save_png),
+            e.g. with ResoBoard.get_resel_palette().
+        :type palette: numpy.ndarray
+
+        :raises Exception: Any error raised while saving an earlier frame.
+        """
+        self._raise_errors()
+        frame = np.swapaxes(image, 0, 1).copy(order = 'C')
+        if self._executor is None:
+            save_png(frame, path, self.compress_level, palette)
+            return
+
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(save_png, frame, path, self.compress_level, palette)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        """Free up a slot once a frame is saved, keeping track of any errors."""
+        self._slots.release()
+        if future.exception() is not None:
+            self._errors.append(future.exception())
+
+    def _raise_errors(self):
+        if self._errors:
+            raise self._errors[0]
+
+    def close(self):
+        """Wait for every frame to be saved, then shut the workers down.
+
+        :raises Exception: Any error raised while saving a frame.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait = True)
+            self._executor = None
+        self._raise_errors()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self._executor is not None:
+            # Something already went wrong; don't hide it behind a saving error.
+            self._executor.shutdown(wait = True)
+            self._executor = None
+
+
+class IndexedFrames:
+    """Iterate a board n times, yielding every frame as a palette-indexed image.
+    
+    The palette holds every color in the board's image, plus the 'on' and 'off'
+    colors of every kind of wire. The frame is painted once, and from then on
+    only the pixels of the wires that changed are repainted (see
+    ResoBoard.paint_wires).
+    
+    Iterating yields n + 1 tuples of (frame, box): the frame before the first
+    tick, then the frame after every tick. frame is an array of shape (h, w),
+    indexed [y, x], of indices into palette. It is the same array every time,
+    updated in place, so copy it to keep it. box is (left, top, right, bottom)
+    of the pixels that changed since the previous frame (None for the first
+    frame, and for frames where nothing changed).
+    
+    :param board: The board to iterate. It is iterated in place.
+    :type board: resoboard.ResoBoard
+    :param n: Number of ticks to iterate the board.
+    :type n: Int
+    
+    Member variables:
+    palette: uint8 array of shape (number of colors, 3), the RGB colors.
+    """
+    def __init__(self, board, n):
+        self._board = board
+        self._n = n
+        
+        # Every color in the image, then the wire colors.
+        image = board.get_image()
+        wire_resels = np.unique(board._wire_colors)
+        wire_rgb = np.array([board.resel_to_rgb[resel] for resel in wire_resels.tolist()], dtype=np.uint8)
+        packed_image = _pack_rgb(np.swapaxes(image, 0, 1))
+        colors, indices = np.unique(
+            np.concatenate((packed_image.ravel(), _pack_rgb(wire_rgb))), return_inverse=True)
+        self.palette = np.stack(((colors >> 16) & 255, (colors >> 8) & 255, colors & 255), axis=1).astype(np.uint8)
+        
+        index_dtype = np.uint8 if len(colors) <= 256 else np.uint16
+        indices = indices.astype(index_dtype)
+        self._frame = indices[:packed_image.size].reshape(packed_image.shape)
+        self._table = np.zeros(256, dtype=index_dtype)
+        self._table[wire_resels] = indices[packed_image.size:]
+    
+    def __iter__(self):
+        board = self._board
+        # paint_wires() indexes (x,y), so paint through a transposed view.
+        frame_xy = self._frame.T
+        board.paint_wires(frame_xy, self._table)
+        state = board.get_wire_states()
+        yield self._frame, None
+        
+        for tick in range(self._n):
+            board.iterate(update_resels = False, update_image = False)
+            new_state = board.get_wire_states()
+            changed_wires = np.flatnonzero(new_state != state)
+            state = new_state
+            if len(changed_wires) == 0:
+                yield self._frame, None
+                continue
+            xs, ys = board.paint_wires(frame_xy, self._table, wires = changed_wires, state = state)
+            yield self._frame, (int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1)
+
+
+def _pack_rgb(rgb):
+    """Pack the last axis of an array of RGB colors into 0xRRGGBB integers."""
+    rgb = rgb.astype(np.uint32)
+    return (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]
+
+
+class GIFWriter:
+    """Stream palette-indexed frames into an animated GIF.
+    
+    Only the box of each frame that changed is encoded (each GIF frame is drawn
+    over the one before it), so frames where only a few wires change are tiny.
+    
+    :param path: Location to save the GIF to.
+    :type path: String
+    :param palette: uint8 array of shape (at most 256, 3), e.g. IndexedFrames.palette
+    :type palette: numpy.ndarray
+    :param width: Width of every frame
+    :type width: Int
+    :param height: Height of every frame
+    :type height: Int
+    :param duration: How long to show every frame for, in milliseconds. (GIF
+        only supports multiples of 10ms.)
+    :type duration: Int
+    :param loop: Number of times to loop the animation. 0 loops forever.
+    :type loop: Int
+    
+    :raises ValueError: If the palette has more than 256 colors.
+    """
+    def __init__(self, path, palette, width, height, duration = 100, loop = 0):
+        if len(palette) > 256:
+            raise ValueError(f"GIFs can have at most 256 colors, but the palette has {len(palette)}")
+        # The global color table always has 256 entries, so it's 8 bits deep.
+        self._palette = np.zeros((256, 3), dtype=np.uint8)
+        self._palette[:len(palette)] = palette
+        self._duration = duration
+        self._file = open(path, "wb")
+        self._file.write(b"GIF89a" + struct.pack("<HHBBB", width, height, 0xF7, 0, 0))
+        self._file.write(self._palette.tobytes())
+        # The NETSCAPE2.0 application extension, which makes the GIF loop.
+        self._file.write(b"\x21\xFF\x0BNETSCAPE2.0\x03\x01" + struct.pack("<H", loop) + b"\x00")
+        self._first = True
+    
+    def write_frame(self, frame, box = None):
+        """Append a frame.
+        
+        :param frame: Array of shape (h, w) of indices into the palette.
+        :type frame: numpy.ndarray
+        :param box: (left, top, right, bottom) of the part of the frame that
+            changed since the last frame, or None if unknown. The whole frame is
+            always written the first time.
+        :type box: Tuple of int
+        """
+        if self._first:
+            left, top, right, bottom = 0, 0, frame.shape[1], frame.shape[0]
+            self._first = False
+        elif box is None:
+            # Nothing changed, but the frame still needs to be shown: redraw one pixel.
+            left, top, right, bottom = 0, 0, 1, 1
+        else:
+            left, top, right, bottom = box
+        image = Image.fromarray(np.ascontiguousarray(frame[top:bottom, left:right], dtype=np.uint8))
+        image.putpalette(self._palette.tobytes())
+        for chunk in GifImagePlugin.getdata(image, offset = (left, top), duration = self._duration, disposal = 1):
+            self._file.write(chunk)
+    
+    def close(self):
+        """Finish the GIF, and close the file."""
+        if not self._file.closed:
+            self._file.write(b";")
+            self._file.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class APNGWriter:
+    """Stream frames into an animated PNG.
+    
+    Palette-indexed frames are saved as such if the palette has at most 256
+    colors, and as RGB otherwise. Like GIFWriter, only the box of each frame
+    that changed is encoded.
+    
+    :param path: Location to save the PNG to.
+    :type path: String
+    :param palette: uint8 array of shape (number of colors, 3), e.g.
+        IndexedFrames.palette
+    :type palette: numpy.ndarray
+    :param width: Width of every frame
+    :type width: Int
+    :param height: Height of every frame
+    :type height: Int
+    :param duration: How long to show every frame for, in milliseconds.
+    :type duration: Int
+    :param loop: Number of times to loop the animation. 0 loops forever.
+    :type loop: Int
+    :param compress_level: zlib compression level, from 0 (none, fastest) to
+        9 (smallest, slowest).
+    :type compress_level: Int
+    """
+    def __init__(self, path, palette, width, height, duration = 100, loop = 0, compress_level = 6):
+        self._palette = np.asarray(palette, dtype=np.uint8)
+        self._indexed = len(self._palette) <= 256
+        self._duration = duration
+        self._loop = loop
+        self._compress_level = compress_level
+        self._num_frames = 0
+        self._sequence = 0
+        
+        self._file = open(path, "wb")
+        self._file.write(b"\x89PNG\r\n\x1a\n")
+        color_type = 3 if self._indexed else 2
+        self._write_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0))
+        # The number of frames isn't known yet, so acTL is filled in by close().
+        self._actl_offset = self._file.tell()
+        self._write_chunk(b"acTL", struct.pack(">II", 0, loop))
+        if self._indexed:
+            self._write_chunk(b"PLTE", self._palette.tobytes())
+    
+    def _write_chunk(self, chunk_type, data):
+        self._file.write(struct.pack(">I", len(data)) + chunk_type + data)
+        self._file.write(struct.pack(">I", zlib.crc32(chunk_type + data)))
+    
+    def write_frame(self, frame, box = None):
+        """Append a frame.
+        
+        :param frame: Array of shape (h, w) of indices into the palette.
+        :type frame: numpy.ndarray
+        :param box: (left, top, right, bottom) of the part of the frame that
+            changed since the last frame, or None if unknown. The whole frame is
+            always written the first time.
+        :type box: Tuple of int
+        """
+        if self._num_frames == 0:
+            left, top, right, bottom = 0, 0, frame.shape[1], frame.shape[0]
+        elif box is None:
+            # Nothing changed, but the frame still needs to be shown: redraw one pixel.
+            left, top, right, bottom = 0, 0, 1, 1
+        else:
+            left, top, right, bottom = box
+        
+        pixels = frame[top:bottom, left:right]
+        if not self._indexed:
+            pixels = self._palette[pixels]
+        # Every row starts with a filter type byte; 0 is 'no filter'.
+        rows = pixels.reshape(bottom - top, -1).astype(np.uint8)
+        raw = np.concatenate((np.zeros((bottom - top, 1), dtype=np.uint8), rows), axis=1)
+        data = zlib.compress(raw.tobytes(), self._compress_level)
+        
+        self._write_chunk(b"fcTL", struct.pack(">IIIIIHHBB",
+            self._sequence, right - left, bottom - top, left, top,
+            self._duration, 1000, 0, 0))
+        self._sequence += 1
+        if self._num_frames == 0:
+            # The first frame is the default image, shown by non-animated viewers.
+            self._write_chunk(b"IDAT", data)
+        else:
+            self._write_chunk(b"fdAT", struct.pack(">I", self._sequence) + data)
+            self._sequence += 1
+        self._num_frames += 1
+    
+    def close(self):
+        """Finish the PNG, and close the file."""
+        if not self._file.closed:
+            self._write_chunk(b"IEND", b"")
+            self._file.seek(self._actl_offset)
+            self._write_chunk(b"acTL", struct.pack(">II", self._num_frames, self._loop))
+            self._file.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class RawWriter:
+    """Stream frames as raw RGB bytes, e.g. into an external encoder:
+    
+        python -m reso board.png -n 1000 --raw | \\
+            ffmpeg -f rawvideo -pix_fmt rgb24 -s WIDTHxHEIGHT -i - board.mp4
+    
+    Every frame is h * w * 3 bytes, rows from top to bottom.
+    
+    :param stream: Binary file-like object to write to, e.g. sys.stdout.buffer
+    :type stream: io.BufferedIOBase
+    :param palette: uint8 array of shape (number of colors, 3), e.g.
+        IndexedFrames.palette
+    :type palette: numpy.ndarray
+    """
+    def __init__(self, stream, palette):
+        self._stream = stream
+        self._palette = np.asarray(palette, dtype=np.uint8)
+    
+    def write_frame(self, frame, box = None):
+        """Write a frame.
+        
+        :param frame: Array of shape (h, w) of indices into the palette.
+        :type frame: numpy.ndarray
+        :param box: Ignored; every frame is written whole.
+        :type box: Tuple of int
+        """
+        self._stream.write(self._palette[frame].tobytes())
+    
+    def close(self):
+        """Flush the stream. (It is not closed.)"""
+        self._stream.flush()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
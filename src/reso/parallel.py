@@ -0,0 +1,248 @@
+'''parallel.py
+
+Simulate one huge board on many cores.
+
+The wires of the compiled Netlist are split into parts, e.g. horizontal
+strips of the board (see partition_wires). Every part belongs to one worker
+process, which steps the cone of its wires (see Netlist.cone): the outputs,
+logic and inputs that the next state of those wires depends on, and the wires
+touching those inputs.
+
+The state of every wire is kept in shared memory, twice over: on every tick,
+each worker reads the current state of the wires of its cone from one
+buffer, and writes the next state of its own wires into the other. Then all
+the workers meet at a barrier, and the buffers swap. The wires a worker reads
+but doesn't own (the wires on the boundary of its part) are exchanged this
+way, through the shared buffers, once per tick. Every wire's next state only
+depends on the current state, so the result is exactly Netlist.step().
+
+    with ParallelSimulator(netlist, state, processes = 4) as simulator:
+        simulator.run(1000)
+        state = simulator.get_state()
+
+The cones of neighbouring parts overlap where a gate straddles the boundary,
+and that logic is computed by both workers. Parts in strips keep the overlap
+small for circuits that are mostly local.
+'''
+
+import multiprocessing
+import os
+import threading
+import weakref
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+# Bytes at the start of the shared memory holding the control words
+# (number of ticks to run, and which buffer holds the current state).
+_CONTROL_BYTES = 16
+
+
+def partition_wires(netlist, parts, positions = None):
+    """Split the wires of a netlist into parts of about the same amount of work.
+
+    The wires are sorted (by position, if given), then cut into parts of
+    consecutive wires, each with about the same number of edges in and out.
+
+    :param netlist: The netlist to split up.
+    :type netlist: netlist.Netlist
+    :param parts: Number of parts. At most one per wire.
+    :type parts: Int
+    :param positions: If given, a tuple of arrays (e.g. (y, x) of a pixel of
+        every wire) to sort the wires by, last array first (as np.lexsort),
+        so that parts are strips of the board.
+    :type positions: Tuple of numpy.ndarray
+
+    :raises ValueError: If parts is less than 1.
+
+    :returns: The indices of the wires of every part, in sorted order.
+    :rtype: List of numpy.ndarray
+    """
+    if parts < 1:
+        raise ValueError(f"parts should be at least 1, got {parts}")
+    num_wires = netlist.num_wires
+    order = np.arange(num_wires) if positions is None else np.lexsort(positions[::-1])
+    # The work of a wire is roughly its edges: to its inputs, and from its outputs.
+    work = (1 + np.bincount(netlist.wire_input_src, minlength=num_wires)
+              + np.bincount(netlist.output_wire_dst, minlength=num_wires)
+              + np.bincount(netlist.wire_wire_dst, minlength=num_wires))[order]
+    cumulative_work = np.cumsum(work)
+    parts = max(1, min(parts, num_wires))
+    cuts = np.searchsorted(cumulative_work, cumulative_work[-1] * np.arange(1, parts) / parts
+                           if num_wires > 0 else [])
+    return [part for part in np.split(order, cuts) if len(part) > 0] or [order]
+
+
+def _worker(cone, cone_wires, owned, owned_wires, shm_name, num_wires, barrier, tick_barrier):
+    """The loop of a worker process: wait for a command at barrier, run that
+    many ticks of the cone, meeting the other workers at tick_barrier after
+    every tick, then meet the main process at barrier again.
+    """
+    shm = shared_memory.SharedMemory(name = shm_name)
+    try:
+        control = np.ndarray(2, dtype=np.int64, buffer=shm.buf)
+        buffers = np.ndarray((2, num_wires), dtype=bool, buffer=shm.buf, offset=_CONTROL_BYTES)
+        while True:
+            barrier.wait()
+            ticks, current = int(control[0]), int(control[1])
+            if ticks < 0:
+                break
+            for _ in range(ticks):
+                next_state = cone.step(buffers[current][cone_wires])
+                buffers[1 - current][owned_wires] = next_state[owned]
+                current = 1 - current
+                tick_barrier.wait()
+            barrier.wait()
+    except BaseException:
+        # Wake everyone up, rather than leaving them waiting forever.
+        barrier.abort()
+        tick_barrier.abort()
+        raise
+    finally:
+        del control, buffers
+        shm.close()
+
+
+def _shutdown(processes, barrier, shm):
+    """Stop the workers and free the shared memory. (Also run at exit, or
+    when a ParallelSimulator is garbage collected without being closed.)
+    """
+    if len(processes) > 0:
+        control = np.ndarray(2, dtype=np.int64, buffer=shm.buf)
+        control[0] = -1
+        del control
+        try:
+            barrier.wait(timeout = 5)
+        except threading.BrokenBarrierError:
+            pass
+    for process in processes:
+        process.join(timeout = 5)
+        if process.is_alive():
+            process.terminate()
+    try:
+        shm.close()
+    except BufferError:
+        # The simulator's own views of the buffers are still alive (at exit);
+        # the memory goes when the process does.
+        pass
+    shm.unlink()
+
+
+class ParallelSimulator:
+    """Simulate a Netlist on several worker processes, with the same results
+    as Netlist.step().
+
+    :param netlist: The compiled circuit to simulate.
+    :type netlist: netlist.Netlist
+    :param state: Boolean array of the initial state of every wire.
+    :type state: numpy.ndarray
+    :param processes: Number of worker processes. Defaults to the number of
+        CPUs. (At most one per wire.)
+    :type processes: Int
+    :param parts: The wires of every worker, e.g. from partition_wires().
+        Every wire must be in exactly one part. Defaults to
+        partition_wires(netlist, processes).
+    :type parts: List of numpy.ndarray
+
+    :raises ValueError: If processes is less than 1, or parts don't cover
+        every wire exactly once.
+
+    Member variables:
+    parts: The indices of the wires of every worker.
+    """
+    def __init__(self, netlist, state, processes = None, parts = None):
+        if processes is None:
+            processes = os.cpu_count() or 1
+        if processes < 1:
+            raise ValueError(f"processes should be at least 1, got {processes}")
+        num_wires = netlist.num_wires
+        if parts is None:
+            parts = partition_wires(netlist, processes)
+        counts = np.bincount(np.concatenate(parts), minlength=num_wires) if len(parts) > 0 else np.zeros(0)
+        if len(counts) != num_wires or not np.all(counts == 1):
+            raise ValueError("parts should hold every wire exactly once")
+        self.parts = parts
+        self._num_wires = num_wires
+
+        self._shm = shared_memory.SharedMemory(create = True, size = _CONTROL_BYTES + 2 * max(num_wires, 1))
+        self._control = np.ndarray(2, dtype=np.int64, buffer=self._shm.buf)
+        self._buffers = np.ndarray((2, num_wires), dtype=bool, buffer=self._shm.buf, offset=_CONTROL_BYTES)
+        self._current = 0
+        self._buffers[0] = state
+
+        # Workers are forked where possible, so that the cones aren't pickled.
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("fork" if "fork" in methods else None)
+        workers = len(parts) if num_wires > 0 else 0
+        self._barrier = context.Barrier(workers + 1)
+        # (Process.start() drops its args, so keep the tick barrier here too:
+        #  if it were garbage collected, its shared memory could be handed to
+        #  the barriers of another ParallelSimulator.)
+        self._tick_barrier = tick_barrier = context.Barrier(max(workers, 1))
+        self._processes = []
+        for part in (parts if workers > 0 else []):
+            cone, cone_wires, owned = netlist.cone(part)
+            process = context.Process(
+                target = _worker, daemon = True,
+                args = (cone, cone_wires, owned, part, self._shm.name, num_wires,
+                        self._barrier, tick_barrier))
+            process.start()
+            self._processes.append(process)
+        # Only one thread may drive the workers at a time.
+        self._lock = threading.Lock()
+        self._finalizer = weakref.finalize(self, _shutdown, self._processes, self._barrier, self._shm)
+
+    def run(self, n = 1):
+        """Advance n ticks.
+
+        :param n: Number of ticks.
+        :type n: Int
+
+        :raises RuntimeError: If a worker process failed.
+        """
+        # (Without any wires, there's nothing to do.)
+        if n <= 0 or len(self._processes) == 0:
+            return
+        with self._lock:
+            if not self._finalizer.alive:
+                raise RuntimeError("The ParallelSimulator is closed")
+            self._control[0] = n
+            self._control[1] = self._current
+            try:
+                # Start the workers, then wait for them to finish.
+                self._barrier.wait()
+                self._barrier.wait()
+            except threading.BrokenBarrierError:
+                raise RuntimeError("A worker process of the ParallelSimulator failed") from None
+            self._current = (self._current + n) % 2
+
+    def get_state(self):
+        """Return (a copy of) the current state of every wire.
+
+        :returns: Boolean array of shape (number of wires,)
+        :rtype: numpy.ndarray
+        """
+        return self._buffers[self._current].copy()
+
+    def set_state(self, state):
+        """Set the current state of every wire.
+
+        :param state: Boolean array of shape (number of wires,)
+        :type state: numpy.ndarray
+        """
+        with self._lock:
+            self._buffers[self._current] = state
+
+    def close(self):
+        """Stop the worker processes and free the shared memory."""
+        with self._lock:
+            if self._finalizer.alive:
+                del self._control, self._buffers
+                self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,184 @@
+'''profiling.py
+
+Built-in instrumentation, to tell where the time goes when running a board.
+
+A Profiler collects three kinds of measurements:
+    phases      Wall-clock time spent in named phases, and how many times each
+                was entered, e.g. "compile.label_regions" or "tick.logic".
+    counters    Named numbers, e.g. the number of regions of every class.
+    histograms  Named {value : count} tables, e.g. the fan-out of every wire.
+
+Pass one to ResoBoard(..., profiler = Profiler()) (or use `--profile` on the
+command line) and read it back with report(). Without a profiler, the board
+uses NULL_PROFILER, which measures nothing.
+
+Phase names are dotted, and the part before the first dot is the stage:
+    load        Decoding the image.
+    compile     Everything else ResoBoard() does: palette mapping, region
+                labelling, adjacency, building the objects and the netlist,
+                and optimizing it.
+    tick        Iterating the board (tick.logic, tick.outputs, tick.wires are
+                the stages of a tick, when the engine has separate stages).
+    render      Painting wires onto the resel map, the image or frames.
+    save        Waiting for images to be written out.
+The report totals every stage, so a board can be told apart as compile-bound
+or tick-bound at a glance.
+'''
+
+import json
+from contextlib import contextmanager, nullcontext
+from time import perf_counter
+
+import numpy as np
+
+
+# The stages phases are totalled under in a report, in the order they happen.
+STAGES = ("load", "compile", "tick", "render", "save")
+
+
+class Profiler:
+    """Collects phase timings, counters and histograms.
+
+    Nested phases are timed separately, and each is also included in the time
+    of the phase around it. E.g. "tick" around "tick.logic" and "tick.wires".
+    Only the top-level phase of each stage counts towards that stage's total.
+
+    Member variables:
+    phases: Dict of phase name --> [total seconds, number of calls]
+    counters: Dict of counter name --> number
+    histograms: Dict of histogram name --> Dict of value --> count
+    """
+    def __init__(self):
+        self.phases = dict()
+        self.counters = dict()
+        self.histograms = dict()
+
+    @contextmanager
+    def phase(self, name):
+        """Time a phase, adding to its total if it was timed before:
+
+            with profiler.phase("compile.adjacency"):
+                ...
+
+        :param name: Name of the phase, e.g. "tick.logic"
+        :type name: String
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, perf_counter() - start)
+
+    def add(self, name, seconds, calls = 1):
+        """Add time to a phase, for phases that are timed by hand.
+
+        :param name: Name of the phase
+        :type name: String
+        :param seconds: Time spent in the phase
+        :type seconds: Float
+        :param calls: Number of times the phase was entered
+        :type calls: Int
+        """
+        totals = self.phases.get(name)
+        if totals is None:
+            self.phases[name] = [seconds, calls]
+        else:
+            totals[0] += seconds
+            totals[1] += calls
+
+    def count(self, name, value = 1):
+        """Add value to a counter, which starts at 0.
+
+        :param name: Name of the counter
+        :type name: String
+        :param value: Amount to add
+        :type value: Int or Float
+        """
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def histogram(self, name, values):
+        """Add values to a histogram of non-negative integers.
+
+        :param name: Name of the histogram, e.g. "fanout.wire_input"
+        :type name: String
+        :param values: Array of non-negative integers, e.g. the fan-out of
+            every wire.
+        :type values: numpy.ndarray
+        """
+        histogram = self.histograms.setdefault(name, dict())
+        counts = np.bincount(np.asarray(values, dtype=np.int64).ravel())
+        for value in np.flatnonzero(counts).tolist():
+            histogram[value] = histogram.get(value, 0) + int(counts[value])
+
+    def stage_seconds(self):
+        """Return the total time of every stage (see STAGES), i.e. of the
+        top-level phases named "stage" or "stage.something".
+
+        :returns: Dict of stage --> seconds
+        :rtype: Dict
+        """
+        totals = {stage : 0.0 for stage in STAGES}
+        for name, (seconds, calls) in self.phases.items():
+            stage, _, rest = name.partition(".")
+            # "tick.logic" is part of "tick", so count it only if there is no "tick".
+            if stage in totals and (rest == "" or stage not in self.phases):
+                totals[stage] += seconds
+        return totals
+
+    def report(self):
+        """Return everything measured so far, as a JSON-serializable dict.
+
+        'bound' is whichever of "compile" (including load) or "tick" took longer.
+
+        :returns: Dict with keys 'stages', 'bound', 'phases', 'counters' and
+            'histograms'.
+        :rtype: Dict
+        """
+        stages = self.stage_seconds()
+        compile_seconds = stages["load"] + stages["compile"]
+        return {
+            "stages" : stages,
+            "bound" : "compile" if compile_seconds >= stages["tick"] else "tick",
+            "phases" : {name : {"seconds" : seconds, "calls" : calls}
+                        for name, (seconds, calls) in sorted(self.phases.items())},
+            "counters" : dict(sorted(self.counters.items())),
+            # JSON keys are strings, so the histograms' values are too.
+            "histograms" : {name : {str(value) : count for value, count in sorted(histogram.items())}
+                            for name, histogram in sorted(self.histograms.items())},
+        }
+
+    def write_json(self, file):
+        """Write report() as JSON.
+
+        :param file: Location to save the report to, or a text file object.
+        :type file: String or file object
+        """
+        if isinstance(file, str):
+            with open(file, "w") as f:
+                json.dump(self.report(), f, indent = 2)
+                f.write("\n")
+        else:
+            json.dump(self.report(), file, indent = 2)
+            file.write("\n")
+
+
+class _NullProfiler:
+    """A Profiler that measures nothing, and costs (almost) nothing."""
+    # nullcontext() can be entered any number of times, so share one.
+    _NULL_PHASE = nullcontext()
+
+    def phase(self, name):
+        return self._NULL_PHASE
+
+    def add(self, name, seconds, calls = 1):
+        pass
+
+    def count(self, name, value = 1):
+        pass
+
+    def histogram(self, name, values):
+        pass
+
+
+# Used wherever no profiler was given.
+NULL_PROFILER = _NullProfiler()
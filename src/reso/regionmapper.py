@@ -1,9 +1,7 @@
-import numpy as np
+import tempfile
+from contextlib import nullcontext
 
-# todo:
-# consider making this faster,
-# per https://stackoverflow.com/questions/12321899/
-# this is used in the 'compilation' step
+import numpy as np
 
 # todo: this big docstring isn't necessary...
 
@@ -21,7 +19,10 @@ RegionMapper(image,
              contiguities = {},
              adjacencies = {},
              sparse = True,
-             wrap = False)
+             wrap = False,
+             profiler = None,
+             strip_pixels = None,
+             memmap_dir = None)
     Parameters:
         image: A Numpy array of shape (width, height, n_channels)
             E.g. image[x,y] = [255, 0, 0]
@@ -38,9 +39,14 @@ RegionMapper(image,
         adjacencies: Same format as contiguities. Defines what is considered a neighbour for a given class.
             E.g. adjacencies = {} means (by default) regions of any class will only consider
             other regions to be its neighbour if a pixel of that region is orthogonally adjacent
-        sparse: Boolean. Set True if most of the pixels in the image do not belong to a given class.
+        sparse: Boolean. Ignored; kept for backwards compatibility.
         wrap: Boolean. If True, the image is considered a torus. The top edge is adjacent to the bottom edge,
             and the left edge is adjacent to the right edge.
+        profiler: A profiling.Profiler to time each step with, or None.
+        strip_pixels: If given, label the image in strips of about this many pixels,
+            to bound the memory used on huge images. (Not with wrap.)
+        memmap_dir: If given, keep the class image (and, with strip_pixels, the labels
+            and pixel lists) in memory-mapped temporary files in this directory.
 
     Provides:
     RegionMapper.region_at_pixel(x,y):
@@ -53,6 +59,11 @@ RegionMapper(image,
     RegionMapper.adjacent_regions(region_id):
         Given the ID of a region, return all regions adjacent to it (as defined by
         its entry in the adjacencies dictionary)
+    RegionMapper.region_pixel_indices(region_id), RegionMapper.region_class(region_id),
+    RegionMapper.num_regions(), RegionMapper.labels(), RegionMapper.adjacency():
+        Array-based accessors, for when lists of tuples would be too slow.
+    RegionMapper.apply_patch(x, y, subimage):
+        Paint over part of the image, and map only the regions around it again.
 '''
 
 
@@ -108,6 +119,121 @@ def _value_to_class(class_dict, value):
         raise ValueError
 
 
+def _map_to_classes(class_dict, image, default=0, dtype=None, out=None):
+    """Map every pixel of an image to a class in one vectorized pass.
+
+    This does the same thing as calling _value_to_class on every pixel, but
+    without the per-pixel Python loop. Multi-channel pixels (e.g. RGB) are
+    packed into a single integer key per pixel, and every key is looked up
+    among the (sorted, packed) keys of class_dict with np.searchsorted.
+    Images of 8 or 16 bit integers (e.g. resel maps) are mapped through a
+    lookup table instead.
+
+    The image is processed a chunk of rows at a time, so the temporaries
+    never take more than a few MB, however big the image is.
+
+    :param class_dict: A mapping of tuples of integers (i.e. RGB pixels) or of
+        integers to integers.
+    :type class_dict: dict
+    :param image: Array of shape (w, h, n_channels) or (w, h)
+    :type image: numpy.ndarray
+    :param default: The class given to pixels that are not in class_dict.
+    :type default: Int
+    :param dtype: dtype of the classes. Defaults to the smallest integer
+        dtype that holds every class in class_dict, and the default.
+    :type dtype: numpy.dtype
+    :param out: Array of shape (w, h) to write the classes into, e.g. a
+        np.memmap. (It need not be contiguous.)
+    :type out: numpy.ndarray
+
+    :raises ValueError: If the image does not have 2 or 3 axes.
+
+    :returns: Array of shape (w, h) holding the class of every pixel.
+    :rtype: numpy.ndarray
+
+    >>> _map_to_classes(
+    ...     {(1,2,3) : 5, (3,2,1) : 7},
+    ...     np.array([[[1,2,3], [3,2,1]], [[0,0,0], [1,2,3]]])).tolist()
+    [[5, 7], [0, 5]]
+
+    >>> _map_to_classes({79 : 79, 111 : 79}, np.array([[79, 0, 111]], dtype=np.uint8)).tolist()
+    [[79, 0, 79]]
+    """
+    image = np.asarray(image)
+    if image.ndim == 3:
+        # Only tuple keys with one value per channel can ever match a pixel.
+        items = [(kk, vv) for kk, vv in class_dict.items()
+                 if isinstance(kk, tuple) and len(kk) == image.shape[2]]
+    elif image.ndim == 2:
+        items = [(kk, vv) for kk, vv in class_dict.items() if not isinstance(kk, tuple)]
+    else:
+        raise ValueError
+
+    if dtype is None:
+        dtype = np.result_type(*[np.min_scalar_type(vv) for _, vv in items + [(None, default)]])
+    if out is None:
+        out = np.empty(image.shape[:2], dtype=dtype)
+    if len(items) == 0:
+        out[...] = default
+        return out
+
+    if image.ndim == 2 and image.dtype.kind in 'ub' and image.dtype.itemsize <= 2:
+        # Small integers: just build the whole table.
+        table = np.full(2 ** (8 * image.dtype.itemsize), default, dtype=out.dtype)
+        for kk, vv in items:
+            if 0 <= kk < len(table):
+                table[kk] = vv
+        lookup = table.__getitem__
+    else:
+        if image.ndim == 3:
+            # Pack (c0, c1, c2, ...) into c0*base^(n-1) + c1*base^(n-2) + ...
+            # For 8-bit RGB this is just the familiar 0xRRGGBB integer.
+            n_channels = image.shape[2]
+            base = max(256, int(image.max()) + 1,
+                       max(int(cc) for kk, _ in items for cc in kk) + 1)
+            key_dtype = np.uint32 if base ** n_channels <= 2**32 else np.uint64
+            dict_keys = np.zeros(len(items), dtype=key_dtype)
+            for channel in range(n_channels):
+                dict_keys *= key_dtype(base)
+                dict_keys += np.array([kk[channel] for kk, _ in items], dtype=key_dtype)
+        else:
+            dict_keys = np.array([kk for kk, _ in items])
+
+        # Sort the dictionary keys once, then binary-search every pixel.
+        order = np.argsort(dict_keys, kind='stable')
+        dict_keys = dict_keys[order]
+        # The last slot holds the default, used for every pixel that isn't a key.
+        dict_values = np.array([vv for _, vv in items] + [default]).astype(out.dtype)
+        dict_values = np.concatenate((dict_values[order], dict_values[-1:]))
+
+        def lookup(pixels):
+            if pixels.ndim == 3:
+                # Packed in-place, one channel at a time, to avoid (w, h, n) temporaries.
+                keys = np.zeros(pixels.shape[:2], dtype=key_dtype)
+                for channel in range(n_channels):
+                    keys *= key_dtype(base)
+                    keys += pixels[:, :, channel].astype(key_dtype, copy=False)
+            else:
+                keys = pixels
+            position = np.searchsorted(dict_keys, keys)
+            np.minimum(position, len(dict_keys) - 1, out=position)
+            found = dict_keys[position] == keys
+            position[~found] = len(dict_keys)
+            return dict_values[position]
+
+    rows_per_chunk = max(1, _CHUNK_PIXELS // max(1, image.shape[1]))
+    for x0 in range(0, image.shape[0], rows_per_chunk):
+        out[x0:x0 + rows_per_chunk] = lookup(image[x0:x0 + rows_per_chunk])
+    return out
+
+
+# Number of pixels _map_to_classes works on at a time.
+_CHUNK_PIXELS = 2**20
+
+# Number of pixels a tiled RegionMapper labels at a time, by default.
+_STRIP_PIXELS = 2**22
+
+
 def _class_to_map(nbhd_offsets, value, default=ortho_map):
     """Index a dictionary 'nbhd_offsets' on 'value', returning 'default' if
     'value' is not a valid key.
@@ -190,6 +316,634 @@ def _get_adjacent_pixels(x, y, w, h, nbhd_map = ortho_map, wrap = False):
     return adj_pixels
 
 
+def _offset_views(array, dx, dy, wrap = False):
+    """Pair up every pixel of a 2D array with the pixel at offset (dx, dy).
+
+    This is the vectorized counterpart of _get_adjacent_pixels: rather than
+    listing the neighbours of one pixel, it returns two equally-shaped arrays,
+    'here' and 'there', where there[i,j] is the pixel at offset (dx, dy) from
+    here[i,j]. Pixels whose neighbour falls off the edge of the image are left
+    out, unless wrap is True.
+
+    :param array: Array of shape (w, h)
+    :type array: numpy.ndarray
+    :param dx: Offset along the x axis
+    :type dx: Int
+    :param dy: Offset along the y axis
+    :type dy: Int
+    :param wrap: If True, wrap around the edges of the image.
+    :type wrap: Bool
+
+    :returns: Tuple of arrays (here, there)
+    :rtype: tuple of numpy.ndarray
+
+    >>> here, there = _offset_views(np.arange(6).reshape(2,3), 0, 1)
+    >>> here.tolist(), there.tolist()
+    ([[0, 1], [3, 4]], [[1, 2], [4, 5]])
+
+    >>> here, there = _offset_views(np.arange(6).reshape(2,3), 0, 1, wrap=True)
+    >>> there.tolist()
+    [[1, 2, 0], [4, 5, 3]]
+    """
+    if wrap:
+        return array, np.roll(array, (-dx, -dy), axis=(0, 1))
+
+    w, h = array.shape[:2]
+    x0, x1 = max(0, -dx), max(max(0, -dx), min(w, w - dx))
+    y0, y1 = max(0, -dy), max(max(0, -dy), min(h, h - dy))
+    return array[x0:x1, y0:y1], array[x0 + dx:x1 + dx, y0 + dy:y1 + dy]
+
+
+def _symmetric_offsets(nbhd_map):
+    """Return the set of offsets in nbhd_map, plus their negations.
+
+    Contiguity is a symmetric relation (if a touches b, then b touches a), so
+    the labelling code only needs to look in one of each pair of directions.
+
+    >>> sorted(_symmetric_offsets(((1,0), (0,1))))
+    [(-1, 0), (0, -1), (0, 1), (1, 0)]
+    """
+    offsets = set()
+    for dx, dy in nbhd_map:
+        offsets.add((dx, dy))
+        offsets.add((-dx, -dy))
+    offsets.discard((0, 0))
+    return offsets
+
+
+def _union_find(n_nodes, edges_a, edges_b):
+    """Vectorized union-find over a graph of n_nodes nodes.
+
+    Every round, each edge between two different trees hooks the larger root
+    onto the smaller one, and then pointer-jumping flattens every tree. This
+    repeats until no edge crosses two trees. Because we always hook onto the
+    smaller root, the root of every component is its smallest node.
+
+    :param n_nodes: Number of nodes, numbered 0 to n_nodes-1
+    :type n_nodes: Int
+    :param edges_a: One endpoint of each (undirected) edge
+    :type edges_a: numpy.ndarray
+    :param edges_b: The other endpoint of each edge
+    :type edges_b: numpy.ndarray
+
+    :returns: parent, where parent[node] is the smallest node in its component
+    :rtype: numpy.ndarray
+
+    >>> _union_find(5, np.array([4, 1]), np.array([1, 3])).tolist()
+    [0, 1, 2, 1, 1]
+    """
+    parent = np.arange(n_nodes)
+    while len(edges_a) > 0:
+        root_a = parent[edges_a]
+        root_b = parent[edges_b]
+        crossing = root_a != root_b
+        if not crossing.any():
+            break
+        # Edges already inside one tree stay there; we can drop them.
+        edges_a, edges_b = edges_a[crossing], edges_b[crossing]
+        root_a, root_b = root_a[crossing], root_b[crossing]
+        np.minimum.at(parent, np.maximum(root_a, root_b), np.minimum(root_a, root_b))
+        # Pointer-jumping, until every node points straight at its root.
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+    return parent
+
+
+def _csr_positions(indptr, rows):
+    """Return the positions of all the entries of the given rows of a
+    CSR-style array, i.e. the concatenation of range(indptr[r], indptr[r+1])
+    for every r in rows, without a Python loop.
+
+    :param indptr: CSR row pointers, of length (number of rows + 1)
+    :type indptr: numpy.ndarray
+    :param rows: Rows to gather
+    :type rows: numpy.ndarray
+
+    :returns: Tuple of (positions, row_of_position), where row_of_position
+        says which entry of 'rows' each position came from.
+    :rtype: tuple of numpy.ndarray
+
+    >>> positions, row_of_position = _csr_positions(np.array([0, 2, 2, 5]), np.array([2, 0]))
+    >>> positions.tolist(), row_of_position.tolist()
+    ([2, 3, 4, 0, 1], [0, 0, 0, 1, 1])
+    """
+    rows = np.asarray(rows, dtype=np.intp)
+    starts = indptr[rows]
+    counts = indptr[rows + 1] - starts
+    row_of_position = np.repeat(np.arange(len(rows)), counts)
+    # Position k of row r is starts[r] + (k - the number of positions before r)
+    offsets = np.repeat(starts - (np.cumsum(counts) - counts), counts)
+    return np.arange(len(row_of_position)) + offsets, row_of_position
+
+
+def _splice_csr(indptr, indices, num_rows, rows, row_indptr, row_indices):
+    """Return a CSR-style array of num_rows rows, in which the given rows hold
+    new lists, and every other row holds the same list as before.
+
+    The rows in between the given ones are copied over a run at a time, as
+    slices, so this takes a couple of copies of the arrays, rather than a
+    gather of every entry.
+
+    :param indptr: CSR row pointers of the old array
+    :type indptr: numpy.ndarray
+    :param indices: The entries of the old array, or a tuple of arrays of
+        entries to splice alike (e.g. x and y coordinates).
+    :type indices: numpy.ndarray or tuple of numpy.ndarray
+    :param num_rows: Number of rows after splicing. Any rows past the old
+        ones must be given in rows.
+    :type num_rows: Int
+    :param rows: The rows to replace, in any order
+    :type rows: numpy.ndarray
+    :param row_indptr: CSR row pointers of the new lists, one per entry of rows
+    :type row_indptr: numpy.ndarray
+    :param row_indices: The entries of the new lists (a tuple of arrays, if
+        indices is one)
+    :type row_indices: numpy.ndarray or tuple of numpy.ndarray
+
+    :returns: Tuple of (indptr, indices), spliced (indices being a tuple, if
+        it was given as one).
+    :rtype: tuple
+
+    >>> indptr, indices = _splice_csr(np.array([0, 2, 3, 5]), np.array([1, 2, 0, 3, 4]), 4,
+    ...                               np.array([3, 1]), np.array([0, 1, 1]), np.array([7]))
+    >>> indptr.tolist(), indices.tolist()
+    ([0, 2, 2, 4, 5], [1, 2, 3, 4, 7])
+    """
+    as_tuple = isinstance(indices, tuple)
+    if not as_tuple:
+        indices, row_indices = (indices,), (row_indices,)
+    # Put the new lists in row order.
+    rows = np.asarray(rows, dtype=np.intp)
+    order = np.argsort(rows)
+    positions, _ = _csr_positions(row_indptr, order)
+    rows, sizes = rows[order], (row_indptr[order + 1] - row_indptr[order])
+    row_indices = [np.asarray(new)[positions].astype(old.dtype, copy=False)
+                   for old, new in zip(indices, row_indices)]
+
+    new_indptr = np.zeros(num_rows + 1, dtype=np.intp)
+    pieces = [[] for _ in indices]
+    start, used = 0, 0
+    for row, size in zip(rows.tolist() + [num_rows], sizes.tolist() + [0]):
+        # Copy rows start, ..., row - 1 as they were, then the new list of row.
+        if row > start:
+            new_indptr[start + 1:row + 1] = indptr[start + 1:row + 1] + (new_indptr[start] - indptr[start])
+            for piece, old in zip(pieces, indices):
+                piece.append(old[indptr[start]:indptr[row]])
+        if row < num_rows:
+            new_indptr[row + 1] = new_indptr[row] + size
+            for piece, new in zip(pieces, row_indices):
+                piece.append(new[used:used + size])
+            used += size
+        start = row + 1
+    new_indices = tuple(np.concatenate(piece) if piece else old[:0].copy()
+                        for piece, old in zip(pieces, indices))
+    return new_indptr, (new_indices if as_tuple else new_indices[0])
+
+
+def _touching_pairs(class_image, ids, offsets, wrap = False, skip = ()):
+    """Find the pairs of touching pixels with different IDs, where touching
+    means the same class, at an offset contiguous for that class.
+
+    Contiguity is symmetric, so only one of each pair of opposite offsets is
+    compared (see _symmetric_offsets).
+
+    :param class_image: Array of shape (w, h) of class ints, 0 being no class
+    :type class_image: numpy.ndarray
+    :param ids: Array of shape (w, h), e.g. of runs or of regions, to pair up
+    :type ids: numpy.ndarray
+    :param offsets: Dictionary of every present class --> set of its
+        (symmetric) contiguous offsets
+    :type offsets: Dict
+    :param wrap: If True, pixels touch across the edges of the image.
+    :type wrap: Bool
+    :param skip: Offsets not to compare.
+    :type skip: Iterable of tuple
+
+    :returns: Tuple of arrays (ids_a, ids_b), one entry per touching pair
+    :rtype: tuple of numpy.ndarray
+
+    >>> a, b = _touching_pairs(np.array([[1, 1], [2, 1]]), np.array([[0, 1], [2, 3]]), {1: {(0, 1), (0, -1)}})
+    >>> a.tolist(), b.tolist()
+    ([0], [1])
+    """
+    present = list(offsets)
+    edges_a, edges_b = [], []
+    for dx, dy in sorted(set().union(*offsets.values())):
+        if (dx, dy) < (0, 0) or (dx, dy) in skip:
+            continue
+        contiguous = [cc for cc in present if (dx, dy) in offsets[cc]]
+        class_here, class_there = _offset_views(class_image, dx, dy, wrap)
+        touching = class_here == class_there
+        if len(contiguous) == len(present):
+            touching &= class_here != 0
+        else:
+            touching &= np.isin(class_here, contiguous)
+        id_here, id_there = _offset_views(ids, dx, dy, wrap)
+        edges_a.append(id_here[touching])
+        edges_b.append(id_there[touching])
+    if len(edges_a) == 0:
+        return np.zeros(0, dtype=ids.dtype), np.zeros(0, dtype=ids.dtype)
+    edges_a, edges_b = np.concatenate(edges_a), np.concatenate(edges_b)
+    different = edges_a != edges_b
+    return edges_a[different], edges_b[different]
+
+
+def _label_regions(class_image, contiguities = {}, wrap = False):
+    """Label the contiguous regions of a class image.
+
+    This is a connected-component labelling that works a run at a time:
+     1. Split every row (fixed x, increasing y) into runs of same-class pixels.
+        A run only continues along y if the class is contiguous along y.
+     2. For every other offset in the contiguity maps, compare the image with
+        a shifted copy of itself, giving the pairs of runs that touch.
+     3. Join those runs with a vectorized union-find (_union_find).
+
+    Regions are numbered in the order their first pixel is met when scanning
+    x then y, the same order the old per-pixel flood fill used.
+
+    :param class_image: Array of shape (w, h) of class ints, 0 being no class
+    :type class_image: numpy.ndarray
+    :param contiguities: Dictionary of class int --> list of offsets
+    :type contiguities: Dict
+    :param wrap: If True, regions wrap around the edges of the image.
+    :type wrap: Bool
+
+    :returns: Tuple of (labels, region_classes, pixel_indptr, pixel_indices):
+        labels is an int32 array of shape (w, h) holding the region ID of every
+        pixel (or -1), region_classes holds the class of every region, and the
+        flat (x*h + y) indices of the pixels in region i are
+        pixel_indices[pixel_indptr[i]:pixel_indptr[i+1]].
+    :rtype: tuple of numpy.ndarray
+
+    >>> labels, classes, _, _ = _label_regions(np.array([[1,1,0],[0,2,1]]))
+    >>> labels.tolist(), classes.tolist()
+    ([[0, 0, -1], [-1, 1, 2]], [1, 2, 1])
+    """
+    width, height = class_image.shape
+    n_pixels = width * height
+    classes = class_image.ravel()
+    has_class = classes != 0
+
+    # Each present class, and the offsets it considers contiguous.
+    present = [cc.item() for cc in np.unique(classes[has_class])]
+    offsets = {cc: _symmetric_offsets(_class_to_map(contiguities, cc)) for cc in present}
+
+    # 1. Runs along y. A pixel starts a new run unless the pixel before it
+    #    (same x, y-1) has the same class and that class joins along y.
+    joins_along_y = [cc for cc in present if (0, 1) in offsets[cc]]
+    continues_run = np.zeros(n_pixels, dtype=bool)
+    continues_run[1:] = classes[1:] == classes[:-1]
+    continues_run[::height] = False
+    continues_run &= np.isin(classes, joins_along_y)
+    run_starts = has_class & ~continues_run
+    n_runs = int(np.count_nonzero(run_starts))
+    index_dtype = np.int32 if n_pixels < 2**31 else np.int64
+    # run_of_pixel = np.cumsum(run_starts) - 1, a chunk at a time, to avoid
+    # full-size temporaries. (Pixels before the first run get -1.)
+    run_of_pixel = np.empty(n_pixels, dtype=index_dtype)
+    runs_so_far = -1
+    for start in range(0, n_pixels, _CHUNK_PIXELS):
+        chunk = run_of_pixel[start:start + _CHUNK_PIXELS]
+        np.cumsum(run_starts[start:start + _CHUNK_PIXELS], dtype=index_dtype, out=chunk)
+        chunk += runs_so_far
+        runs_so_far = chunk[-1]
+
+    # 2. Pairs of touching runs, one direction per pair of opposite offsets.
+    #    (Runs along y already join pixels at offset (0, 1), unless wrapping.)
+    edges_a, edges_b = _touching_pairs(
+        classes.reshape(width, height), run_of_pixel.reshape(width, height),
+        offsets, wrap, skip = () if wrap else ((0, 1),))
+
+    # 3. Union-find, then number the regions by their first (root) run.
+    root_of_run = _union_find(n_runs, edges_a, edges_b)
+    is_root = root_of_run == np.arange(n_runs)
+    region_of_root = np.cumsum(is_root, dtype=index_dtype) - 1
+    region_of_run = region_of_root[root_of_run].astype(np.int32)
+    run_start_pixels = np.flatnonzero(run_starts)
+    del run_starts
+    region_classes = classes[run_start_pixels[is_root]]
+    n_regions = len(region_classes)
+
+    # Relabel run_of_pixel in place, a chunk at a time, into the labels.
+    # (Pixels before the first run have run -1, and are reset below.)
+    if n_runs > 0:
+        for start in range(0, n_pixels, _CHUNK_PIXELS):
+            chunk = run_of_pixel[start:start + _CHUNK_PIXELS]
+            chunk[...] = region_of_run[chunk]
+    labels = run_of_pixel.astype(np.int32, copy=False)
+    del run_of_pixel
+    labels[~has_class] = -1
+
+    # Per-region pixel lists, stored CSR-style. Every run is a contiguous
+    # range of pixels, so sorting the (few) runs by region, and then listing
+    # the pixels of every run in that order, sorts the pixels by region.
+    run_ends = has_class.copy()
+    run_ends[:-1] &= ~continues_run[1:]
+    run_lengths = (np.flatnonzero(run_ends) - run_start_pixels + 1).astype(index_dtype)
+    del run_ends, continues_run
+    run_order = np.argsort(region_of_run, kind='stable')
+    run_lengths = run_lengths[run_order]
+    run_offsets = np.cumsum(run_lengths, dtype=index_dtype) - run_lengths
+    pixel_indices = np.arange(int(run_lengths.sum()), dtype=index_dtype)
+    pixel_indices += np.repeat(run_start_pixels[run_order].astype(index_dtype) - run_offsets, run_lengths)
+
+    pixel_indptr = np.zeros(n_regions + 1, dtype=np.intp)
+    np.add.at(pixel_indptr, region_of_run + 1, run_lengths[np.argsort(run_order)])
+    np.cumsum(pixel_indptr, out=pixel_indptr)
+
+    return labels.reshape(width, height), region_classes, pixel_indptr, pixel_indices
+
+
+def _region_adjacency(labels, region_classes, adjacencies = {}, wrap = False):
+    """Build the region adjacency graph of a label array.
+
+    For every offset in the adjacency maps, the label array is compared with a
+    shifted copy of itself. Every pixel whose region's class includes that
+    offset, and whose neighbour at that offset is in another region, gives a
+    (region, neighbour) pair. Duplicate pairs are removed with np.unique.
+
+    Adjacency is directional: region a lists b if b touches a at one of the
+    offsets in the map of a's class.
+
+    :param labels: int32 array of shape (w, h) of region IDs (or -1)
+    :type labels: numpy.ndarray
+    :param region_classes: The class of every region
+    :type region_classes: numpy.ndarray
+    :param adjacencies: Dictionary of class int --> list of offsets
+    :type adjacencies: Dict
+    :param wrap: If True, regions are adjacent across the edges of the image.
+    :type wrap: Bool
+
+    :returns: Tuple of (indptr, indices), where the regions adjacent to region
+        i are indices[indptr[i]:indptr[i+1]], in increasing order.
+    :rtype: tuple of numpy.ndarray
+
+    >>> indptr, indices = _region_adjacency(
+    ...     np.array([[0, 0, -1], [-1, 1, 2]], dtype=np.int32), np.array([1, 2, 1]))
+    >>> indptr.tolist(), indices.tolist()
+    ([0, 1, 3, 4], [1, 0, 2, 1])
+    """
+    pairs = _adjacent_pairs(labels, region_classes, _adjacency_offsets(region_classes, adjacencies), wrap)
+    return _pairs_to_csr(pairs, len(region_classes))
+
+
+def _adjacency_offsets(region_classes, adjacencies):
+    """Return a dictionary of every present class --> set of its adjacency
+    offsets (leaving out (0, 0))."""
+    present = [cc.item() for cc in np.unique(region_classes)]
+    return {cc: {oo for oo in _class_to_map(adjacencies, cc) if oo != (0, 0)} for cc in present}
+
+
+def _adjacent_pairs(labels, region_classes, offsets, wrap = False):
+    """List the (region, neighbour) pairs of a label array, for
+    _region_adjacency, each packed into one int64 as region * n_regions + neighbour.
+
+    :returns: The packed pairs, sorted and without duplicates.
+    :rtype: numpy.ndarray
+    """
+    n_regions = len(region_classes)
+    present = list(offsets)
+    pairs = []
+    for dx, dy in sorted(set().union(*offsets.values())):
+        adjacent_classes = [cc for cc in present if (dx, dy) in offsets[cc]]
+        here, there = _offset_views(labels, dx, dy, wrap)
+        touching = (here != there) & (here >= 0) & (there >= 0)
+        here, there = here[touching], there[touching]
+        if len(adjacent_classes) < len(present):
+            keep = np.isin(region_classes, adjacent_classes)[here]
+            here, there = here[keep], there[keep]
+        # Pack each (here, there) pair into one int64, so np.unique is 1D.
+        pairs.append(np.unique(here.astype(np.int64) * n_regions + there))
+
+    if len(pairs) > 0:
+        return np.unique(np.concatenate(pairs))
+    return np.zeros(0, dtype=np.int64)
+
+
+def _pairs_to_csr(pairs, n_regions):
+    """Turn the packed pairs of _adjacent_pairs into (indptr, indices)."""
+    sources = pairs // max(n_regions, 1)
+    indices = (pairs % max(n_regions, 1)).astype(np.int32)
+    indptr = np.zeros(n_regions + 1, dtype=np.intp)
+    np.cumsum(np.bincount(sources, minlength=n_regions), out=indptr[1:])
+    return indptr, indices
+
+
+def _strip_rows(width, strip_pixels, offsets):
+    """Number of rows (along y) in every strip of a tiled labelling: about
+    strip_pixels pixels, but at least as many as the furthest offset along y,
+    so that pixels only ever touch pixels of the strips next to theirs."""
+    reach = max([abs(dy) for offs in offsets for _, dy in offs] + [1])
+    return max(reach, strip_pixels // max(1, width)), reach
+
+
+def _label_regions_tiled(class_image, contiguities = {}, strip_pixels = _STRIP_PIXELS, memmap_dir = None):
+    """Label the contiguous regions of a class image a strip at a time.
+
+    This gives exactly the same arrays as _label_regions (wrap = False), but
+    only ever works on one strip of rows (a range of y) of the image at once,
+    so the temporaries are bounded by the strip size, however big the image:
+     1. Every strip is labelled on its own with _label_regions, and its labels
+        (offset to be unique across strips) written into the label array.
+     2. Regions that touch across the seam between two strips are found by
+        comparing the rows on either side of it (diagonals included, for
+        classes contiguous along them) with _touching_pairs, and are joined
+        with _union_find.
+     3. The joined regions are numbered by their first pixel (scanning x then
+        y, like _label_regions), and every strip is relabelled, and its pixels
+        sorted into the per-region pixel lists. Regions spanning several strips
+        have their pixel lists sorted last.
+
+    Strips are ranges of y so that, for images stored as the transpose of a
+    (h, w) array (like ResoBoard's memory-mapped resel maps), every strip is
+    one contiguous block of the file.
+
+    :param class_image: Array of shape (w, h) of class ints, 0 being no class.
+        (This may be a np.memmap.)
+    :type class_image: numpy.ndarray
+    :param contiguities: Dictionary of class int --> list of offsets
+    :type contiguities: Dict
+    :param strip_pixels: About how many pixels to label at a time.
+    :type strip_pixels: Int
+    :param memmap_dir: If given, the labels and the pixel lists are
+        memory-mapped from temporary files in this directory (see _empty_array).
+    :type memmap_dir: String
+
+    :returns: Tuple of (labels, region_classes, pixel_indptr, pixel_indices),
+        as _label_regions.
+    :rtype: tuple of numpy.ndarray
+
+    >>> image = np.array([[1,0,0,1],[0,1,1,0],[1,0,0,1]])
+    >>> labels, classes, _, _ = _label_regions_tiled(image, {1: ortho_map + diag_map}, strip_pixels = 1)
+    >>> labels.tolist(), classes.tolist()
+    ([[0, -1, -1, 0], [-1, 0, 0, -1], [0, -1, -1, 0]], [1])
+    """
+    width, height = class_image.shape
+    n_pixels = width * height
+    index_dtype = np.int32 if n_pixels < 2**31 else np.int64
+    offsets = {cc: _symmetric_offsets(offs) for cc, offs in contiguities.items()}
+    strip_rows, reach = _strip_rows(width, strip_pixels, list(offsets.values()) + [ortho_map])
+    strips = [(y0, min(height, y0 + strip_rows)) for y0 in range(0, height, strip_rows)]
+    # Stored transposed, so every strip is contiguous. (See ResoBoard.)
+    labels = _empty_array((height, width), np.int32, memmap_dir).T
+
+    # 1. Label every strip, and 2. find the pairs of regions across every seam.
+    #    'Local' regions are those of the strips, numbered across all strips.
+    local_classes, local_sizes, local_first = [], [], []
+    edges_a, edges_b = [], []
+    n_local = 0
+    for y0, y1 in strips:
+        strip = np.asarray(class_image[:, y0:y1])
+        strip_labels, classes, indptr, indices = _label_regions(strip, contiguities)
+        strip_labels[strip_labels >= 0] += n_local
+        labels[:, y0:y1] = strip_labels
+        local_classes.append(classes)
+        local_sizes.append(np.diff(indptr))
+        # The first pixel of every region, as a flat index into the whole image.
+        first = indices[indptr[:-1]].astype(np.int64)
+        local_first.append(first // (y1 - y0) * height + y0 + first % (y1 - y0))
+        n_local += len(classes)
+        del strip, strip_labels, indices
+
+        if y0 > 0:
+            # The rows either side of the seam. Only offsets along y cross it.
+            top, bottom = y0 - reach, min(y1, y0 + reach)
+            band_classes = np.asarray(class_image[:, top:bottom])
+            present = {cc.item() for cc in np.unique(band_classes[band_classes != 0])}
+            band_offsets = {cc: _symmetric_offsets(_class_to_map(contiguities, cc)) for cc in present}
+            a, b = _touching_pairs(band_classes, np.asarray(labels[:, top:bottom]), band_offsets,
+                                   skip = {oo for offs in band_offsets.values() for oo in offs if oo[1] == 0})
+            edges_a.append(a)
+            edges_b.append(b)
+
+    local_classes = np.concatenate(local_classes) if len(strips) > 0 else np.zeros(0, dtype=class_image.dtype)
+    local_sizes = np.concatenate(local_sizes) if len(strips) > 0 else np.zeros(0, dtype=np.intp)
+    local_first = np.concatenate(local_first) if len(strips) > 0 else np.zeros(0, dtype=np.int64)
+    edges_a = np.concatenate(edges_a) if len(edges_a) > 0 else np.zeros(0, dtype=np.int32)
+    edges_b = np.concatenate(edges_b) if len(edges_b) > 0 else np.zeros(0, dtype=np.int32)
+
+    # 3. Join the local regions, and number them by their first pixel.
+    root = _union_find(n_local, edges_a, edges_b)
+    first = np.full(n_local, n_pixels, dtype=np.int64)
+    np.minimum.at(first, root, local_first)
+    roots = np.flatnonzero(root == np.arange(n_local))
+    roots = roots[np.argsort(first[roots], kind='stable')]
+    region_of_root = np.zeros(n_local, dtype=np.int32)
+    region_of_root[roots] = np.arange(len(roots))
+    region_of_local = region_of_root[root]
+    region_classes = local_classes[roots]
+    n_regions = len(roots)
+
+    region_sizes = np.bincount(region_of_local, weights=local_sizes, minlength=n_regions).astype(np.intp)
+    pixel_indptr = np.zeros(n_regions + 1, dtype=np.intp)
+    np.cumsum(region_sizes, out=pixel_indptr[1:])
+    pixel_indices = _empty_array((int(pixel_indptr[-1]),), index_dtype, memmap_dir)
+
+    # Relabel every strip, and append its pixels to the lists of their regions.
+    filled = pixel_indptr[:-1].copy()
+    for y0, y1 in strips:
+        strip_labels = np.asarray(labels[:, y0:y1])
+        has_region = strip_labels >= 0
+        strip_labels[has_region] = region_of_local[strip_labels[has_region]]
+        labels[:, y0:y1] = strip_labels
+        pixels = np.flatnonzero(has_region)
+        regions = strip_labels.ravel()[pixels]
+        order = np.argsort(regions, kind='stable')
+        pixels, regions = pixels[order], regions[order]
+        present, starts, counts = np.unique(regions, return_index=True, return_counts=True)
+        positions = filled[regions] + np.arange(len(regions)) - np.repeat(starts, counts)
+        pixel_indices[positions] = pixels // (y1 - y0) * height + y0 + pixels % (y1 - y0)
+        filled[present] += counts
+        del strip_labels, has_region, pixels, regions, order, positions
+
+    # Regions spanning several strips got their pixels a strip at a time, so
+    # sort their lists: huge regions in place, one at a time, and the others a
+    # batch of about _CHUNK_PIXELS pixels at a time, every pixel keyed on (its
+    # region's place in the batch, its index).
+    spanning = np.flatnonzero(np.bincount(region_of_local, minlength=n_regions) > 1)
+    for region in spanning[region_sizes[spanning] > _CHUNK_PIXELS]:
+        pixel_indices[pixel_indptr[region]:pixel_indptr[region + 1]].sort()
+    spanning = spanning[region_sizes[spanning] <= _CHUNK_PIXELS]
+    spanning_sizes = region_sizes[spanning]
+    batch_of = (np.cumsum(spanning_sizes) - spanning_sizes) // _CHUNK_PIXELS
+    for batch in np.unique(batch_of):
+        positions, segment = _csr_positions(pixel_indptr, spanning[batch_of == batch])
+        keys = segment.astype(np.int64) * n_pixels + pixel_indices[positions]
+        keys.sort()
+        pixel_indices[positions] = keys - segment * n_pixels
+
+    return labels, region_classes, pixel_indptr, pixel_indices
+
+
+def _region_adjacency_tiled(labels, region_classes, adjacencies = {}, strip_pixels = _STRIP_PIXELS):
+    """Build the region adjacency graph of a label array a strip at a time,
+    with the same result as _region_adjacency (wrap = False).
+
+    Every strip of rows is compared along with the rows either side of it,
+    so that the pairs across its seams are found too. Only the (unique) pairs
+    are kept between strips.
+
+    :param labels: int32 array of shape (w, h) of region IDs (or -1). (This
+        may be a np.memmap.)
+    :type labels: numpy.ndarray
+    :param region_classes: The class of every region
+    :type region_classes: numpy.ndarray
+    :param adjacencies: Dictionary of class int --> list of offsets
+    :type adjacencies: Dict
+    :param strip_pixels: About how many pixels to compare at a time.
+    :type strip_pixels: Int
+
+    :returns: Tuple of (indptr, indices), as _region_adjacency.
+    :rtype: tuple of numpy.ndarray
+    """
+    width, height = labels.shape
+    offsets = _adjacency_offsets(region_classes, adjacencies)
+    strip_rows, reach = _strip_rows(width, strip_pixels, list(offsets.values()))
+    pairs = np.zeros(0, dtype=np.int64)
+    for y0 in range(0, height, strip_rows):
+        block = np.asarray(labels[:, max(0, y0 - reach):min(height, y0 + strip_rows + reach)])
+        pairs = np.union1d(pairs, _adjacent_pairs(block, region_classes, offsets))
+    return _pairs_to_csr(pairs, len(region_classes))
+
+
+def _empty_array(shape, dtype, memmap_dir = None):
+    """Allocate an array, memory-mapped in memmap_dir if it is given."""
+    if memmap_dir is None:
+        return np.empty(shape, dtype=dtype)
+    # The file is deleted as soon as it's closed, but the mapping keeps it alive.
+    with tempfile.TemporaryFile(dir = memmap_dir) as f:
+        return np.memmap(f, dtype=dtype, mode="w+", shape=shape)
+
+
+class _RegionList:
+    """A read-only list of (class, list of pixels), one entry per region.
+
+    RegionMapper used to keep every region as a (class, list of pixels) tuple in
+    RegionMapper._regions. Now the pixels live in flat arrays, and this builds
+    those tuples on demand, so len(RM._regions) and RM._regions[ii] still work.
+
+    :param region_mapper: The RegionMapper whose regions to list.
+    :type region_mapper: RegionMapper
+    """
+    def __init__(self, region_mapper):
+        self._region_mapper = region_mapper
+
+    def __len__(self):
+        return self._region_mapper.num_regions()
+
+    def __getitem__(self, region_id):
+        if not -len(self) <= region_id < len(self):
+            raise IndexError('region ID out of range')
+        return self._region_mapper.regions(region_id % len(self))
+
+    def __iter__(self):
+        for region_id in range(len(self)):
+            yield self._region_mapper.regions(region_id)
+
+
 class RegionMapper:
     """
     Given an image, the goal is to identify contiguous regions of the same color
@@ -225,13 +979,28 @@ class RegionMapper:
     :param adjacencies: Dictionary of class int --> list of coordinates.
         (E.g. One might use 'ortho_map' here.)
     :type adjacencies: Dict
-    :param sparse: If True, use a dictionary instead of an array to map pixels to regions.
-        (This is useful if most of the pixels in the image don't correspond to
-        a class.)
+    :param sparse: Kept for backwards compatibility, and ignored. (This used to
+        choose a dictionary instead of an array to map pixels to regions; the
+        regions are now always labelled into a dense int32 array.)
     :type sparse: Bool
     :param wrap: If True, region adjacencies wrap around the edge of the image.
         (Like a torus, or teleporting through the side of the screen like in Pacman.)
     :type wrap: Bool
+    :param profiler: If given, a profiling.Profiler to time each step of the
+        mapping with ("compile.map_classes", "compile.label_regions" and
+        "compile.adjacency").
+    :type profiler: profiling.Profiler
+    :param strip_pixels: If given, label the image a strip of about this many
+        pixels at a time (see _label_regions_tiled), so that the memory used
+        while mapping is bounded by the strip, not the image. The regions are
+        exactly the same. Doesn't work with wrap.
+    :type strip_pixels: Int
+    :param memmap_dir: If given, the class image is memory-mapped from a
+        temporary file in this directory, rather than held in memory. With
+        strip_pixels, so are the labels and the pixel lists of the regions.
+    :type memmap_dir: String
+
+    :raises ValueError: If strip_pixels is given along with wrap, or is less than 1.
     """
     def __init__(self,
                  image,                 # 2D Numpy Array
@@ -239,124 +1008,363 @@ class RegionMapper:
                  contiguities   = {},   # Dict of class int --> map (like ortho_map)
                  adjacencies    = {},   # Dict of class int --> map (like ortho map)
                  sparse         = True,
-                 wrap           = False):
-
-        # todo: We can split this off into other functions!
-        width, height = image.shape[:2]
+                 wrap           = False,
+                 profiler       = None,
+                 strip_pixels   = None,
+                 memmap_dir     = None):
 
         assert(len(image.shape) == 3 or len(image.shape) == 2), \
             "image should be np array shaped (width, height) or (width, height, number_of_channels_in_image)"
 
         # 1. Create self._image, holding a 2D numpy array of class ints
         #     I.e. Convert an rgb-image (w,h,3) to class-image (w,h)
-        #     todo: this can be vectorized !!!
-        self._image = np.zeros((width, height))
-        for ii in range(width):
-            for jj in range(height):
-                self._image[ii, jj] = _value_to_class(class_dict, image[ii,jj])
-
-        # 2. Mapping of pixel coordinates to region indices.
-        #    If Sparse, self._region_at_pixel this is a dict mapping (x, y) tuples to int
-        #    otherwise, self._region_at_pixel is an *array* mapping [x,y] to int
-        #        (Where the 'int' is a unique integer mapping to the region)
-        #    An ID of -1 means there is no region at this pixel
-        self._regions = []
-        if sparse:
-            self._region_at_pixel = dict()
-        else:
-            self._region_at_pixel = np.zeros((width, height)) - 1
-
-        # _regions_with_class:
-        #   E.g. _regions_with_class[2] = [1,3,4]
-            # Regions 1, 3, and 4 are the ones with class 3
-        #   Basically, we also want a mapping of all regions that have a certain class.
-        self._regions_with_class = dict()
-
-        # The busy work!
-        # 'Region' integer IDs are incremented from 0 up
-        region = 0
-        # if rec[x,y] == True, then this pixel has already been recorded.
-        rec = np.zeros((width, height), dtype=np.bool)
-        for x in range(width):
-         for y in range(height):
-                # Each pixel already has its classed assigned,
-                # where 0 indicates no class
-                region_class = self._image[x,y]
-                if rec[x,y] == False and not region_class == 0:
-                    # An unexplored region with a class!
-                    # Let's explore it, and list all the pixels in it.
-                    list_of_pixels_in_region = []
-
-                    # Here, we fill up Fill up list_of_pixels_in_region using BFS
-                    # contig_map is A list of what we consider "contigous" pixels.
-                    contig_map = _class_to_map(nbhd_offsets = contiguities, value = region_class)
-                    # pixels_under_consideration:
-                    # Every pixel we are looking at but have not computed yet.
-                    pixels_under_consideration = [(x,y)]
-                    rec[x,y] = True
-
-                    while len(pixels_under_consideration) > 0:
-                        # Loop through all our pixels. (BFS starts here.)
-                        # Takes the first element from pixels_under_consideration...
-                        xi, yi = pixels_under_consideration.pop()
-                        list_of_pixels_in_region.append((xi, yi)) # = [..., (x,y)]
-                        self._region_at_pixel[xi, yi] = region
-                        # For each adjacent pixel,
-                        #     if it's the same class,
-                        #     add it to the list of pixels we're going to explore
-                        for xJ, yJ in _get_adjacent_pixels(
-                            x=xi, y=yi, w=width, h=height, nbhd_map = contig_map, wrap = wrap
-                        ):
-                            if self._image[xJ, yJ] == region_class and rec[xJ, yJ] == False:
-                                # if the pixel is inside the region of our origin pixel,
-                                # and if it is not already recorded...
-                                pixels_under_consideration.append((xJ, yJ))
-                                rec[xJ, yJ] = True
-
-                    # we're done! add to our regions our
-                    # (region_class, pixel_pixel_pixel ...)
-                    self._regions.append((region_class, list_of_pixels_in_region))
-
-                    # Add to our mapping of class --> region ID
-                    # (and create the entry for the class index first,
-                    #  if this is our first time seeing it.)
-                    if not (region_class) in self._regions_with_class.keys():
-                        self._regions_with_class[region_class] = [region]
-                    else:
-                        self._regions_with_class[region_class].append(region)
-
-                    # finally, increment our region index
-                    region += 1
+        # (RegionMapper doesn't depend on the rest of reso, so without a
+        #  profiler, phases are plain null contexts.)
+        phase = (lambda name: nullcontext()) if profiler is None else profiler.phase
+        if strip_pixels is not None and strip_pixels < 1:
+            raise ValueError(f"strip_pixels should be at least 1, got {strip_pixels}")
+        if strip_pixels is not None and wrap:
+            raise ValueError("strip_pixels doesn't work with wrap")
+        with phase("compile.map_classes"):
+            out = None
+            if memmap_dir is not None:
+                dtype = np.result_type(*[np.min_scalar_type(vv) for vv in class_dict.values()] + [np.uint8])
+                out = _empty_array(image.shape[:2][::-1], dtype, memmap_dir).T
+            self._image = _map_to_classes(class_dict, image, out = out)
+
+        # 2. Label every contiguous region (see _label_regions).
+        #    self._labels is a dense int32 array mapping [x,y] to region ID,
+        #        where an ID of -1 means there is no region at this pixel.
+        #    self._region_classes[region_id] is the class of that region.
+        #    The flat (x*height + y) indices of the pixels of region i are
+        #        self._pixel_indices[self._pixel_indptr[i]:self._pixel_indptr[i+1]]
+        #    (The 'sparse' flag is kept for backwards compatibility; the labels
+        #     are always stored as an array nowadays.)
+        #    (Tiled, every strip is labelled on its own, then the regions are
+        #     joined across the seams between strips.)
+        with phase("compile.label_regions"):
+            if strip_pixels is None:
+                self._labels, self._region_classes, self._pixel_indptr, self._pixel_indices = \
+                    _label_regions(self._image, contiguities = contiguities, wrap = wrap)
+            else:
+                self._labels, self._region_classes, self._pixel_indptr, self._pixel_indices = \
+                    _label_regions_tiled(self._image, contiguities = contiguities,
+                                         strip_pixels = strip_pixels,
+                                         memmap_dir = memmap_dir)
 
         # We did it, we mapped all our regions!
         # Now it's time to identify adjacent regions.
-        #     self._adjacent_regions[region_id] provides a list of region_ids
-        #     of adjacent regions, as defined by the 'adjacencies'
-        #     associated with that class.
-        self._adjacent_regions = [[] for _ in range(len(self._regions))]
-
-        # ii is region id
-        for ii, (region_class, list_of_pixels) in enumerate(self._regions):
-            # nbhd_map = The list of pixel offsets of what this class considers its neighbours
-            nbhd_map = _class_to_map(nbhd_offsets = adjacencies, value = region_class)
-
-            # For every pixel in region ii,
-            for xi, yi in list_of_pixels:
-                # For every pixel adjacent to that pixel,
-                for xJ, yJ in _get_adjacent_pixels(
-                    x=xi, y=yi, w=width, h=height, nbhd_map=nbhd_map, wrap=wrap
-                ):
-                    # If the neighbour is a valid region (not empty)
-                    if not self._image[xJ,yJ] == 0:
-                        neighbour = self._region_at_pixel[xJ,yJ]
-                        if not (neighbour == ii) and \
-                            not neighbour in self._adjacent_regions[ii]:
-                            # If the neighbour is not us
-                            #    and it's not the same class as us
-                            #    and if we didn't already consider this neighbour...
-                            # (neighbour is the integer ID for that region...)
-                            # Add that neighbour to our list of regions!
-                            self._adjacent_regions[ii].append(neighbour)
+        #     The region_ids of the regions adjacent to region i, as defined by
+        #     the 'adjacencies' associated with its class, are
+        #         self._adjacent_indices[self._adjacent_indptr[i]:self._adjacent_indptr[i+1]]
+        with phase("compile.adjacency"):
+            if strip_pixels is None:
+                self._adjacent_indptr, self._adjacent_indices = _region_adjacency(
+                    self._labels, self._region_classes, adjacencies = adjacencies, wrap = wrap)
+            else:
+                self._adjacent_indptr, self._adjacent_indices = _region_adjacency_tiled(
+                    self._labels, self._region_classes, adjacencies = adjacencies,
+                    strip_pixels = strip_pixels)
+
+        self._index_regions()
+        self._set_maps(class_dict, contiguities, adjacencies, wrap)
+
+
+    # The arrays that describe every region and adjacency. See to_arrays().
+    _ARRAYS = ('labels', 'region_classes', 'pixel_indptr', 'pixel_indices',
+               'adjacent_indptr', 'adjacent_indices')
+
+    @classmethod
+    def from_arrays(cls, class_image, arrays, class_dict = None, contiguities = {},
+                    adjacencies = {}, wrap = False):
+        """Rebuild a RegionMapper from the arrays returned by to_arrays(),
+        without mapping any regions. (Used to load compiled boards from a cache.)
+
+        :param class_image: Array of shape (w, h) of class ints, i.e. the image
+            after class_dict was applied to it.
+        :type class_image: numpy.ndarray
+        :param arrays: Mapping of name --> array, as returned by to_arrays()
+        :type arrays: Dict
+        :param class_dict, contiguities, adjacencies, wrap: As given to the
+            RegionMapper that was saved; only used by apply_patch(). Without a
+            class_dict, patches are taken to be class images already.
+
+        :returns: The RegionMapper
+        :rtype: RegionMapper
+        """
+        region_mapper = cls.__new__(cls)
+        region_mapper._image = class_image
+        for name in cls._ARRAYS:
+            setattr(region_mapper, '_' + name, arrays[name])
+        region_mapper._index_regions()
+        region_mapper._set_maps(class_dict, contiguities, adjacencies, wrap)
+        return region_mapper
+
+
+    def _set_maps(self, class_dict, contiguities, adjacencies, wrap):
+        """Keep what the regions were mapped with, for apply_patch()."""
+        self._class_dict = class_dict
+        self._contiguities = contiguities
+        self._adjacencies = adjacencies
+        self._wrap = wrap
+
+
+    def to_arrays(self):
+        """Return every array describing the mapped regions and their adjacencies,
+        e.g. to save them with np.savez and reload them with from_arrays().
+
+        :returns: Dict of name --> array
+        :rtype: Dict
+        """
+        return {name : getattr(self, '_' + name) for name in self._ARRAYS}
+
+
+    def _index_regions(self):
+        """Set up _regions from the region arrays. (_regions_with_class is
+        only built from them once it's used, by regions_with_class().)"""
+        self._regions = _RegionList(self)
+        self._regions_with_class = None
+
+
+    def apply_patch(self, x, y, subimage):
+        """Paint subimage over the image at (x, y), and map the regions again,
+        but only around the patch.
+
+        Only the regions within reach (of the contiguity maps) of the patch
+        can change, so only their pixels, and the pixels of the patch, are
+        labelled again, with the same union-find as _label_regions, on just
+        those pixels. The new regions take the IDs of the old ones, and the
+        adjacency graph keeps every pair that doesn't involve them. Only the
+        lists of the regions next to them are rebuilt; the others are copied
+        over a run of regions at a time. So the work done is about the size of
+        the regions touching the patch, plus copying the arrays over.
+
+        Every other region keeps its pixels and adjacencies, and (mostly) its
+        ID. New regions reuse the IDs of the old ones first; if there are fewer
+        new regions, the regions with the highest IDs are moved down into the
+        gaps, and if there are more, they get IDs at the end. (So, after a
+        patch, regions are no longer numbered in the order of their first pixel.)
+
+        :param x: x-index of the top-left pixel of the patch
+        :type x: Int
+        :param y: y-index of the top-left pixel of the patch
+        :type y: Int
+        :param subimage: The patch, shaped like the image, i.e. (w, h) or
+            (w, h, n_channels), mapped through class_dict like the image was.
+        :type subimage: numpy.ndarray
+
+        :raises ValueError: If the patch doesn't fit inside the image.
+
+        :returns: Tuple of (new_id_of_old, new_regions, adjacent_changed):
+            new_id_of_old[i] is the new ID of old region i, or -1 if it was
+            mapped again (or gone), new_regions holds the IDs of the regions
+            that were mapped again, and adjacent_changed the IDs of the regions
+            whose adjacent regions changed (other than by changing IDs): the
+            new regions, and every region that listed an old one or lists a
+            new one. (Every other region lists the same regions as before.)
+        :rtype: tuple of numpy.ndarray
+        """
+        width, height = self._labels.shape
+        subimage = np.asarray(subimage)
+        if self._class_dict is None:
+            patch = subimage
+        else:
+            patch = _map_to_classes(self._class_dict, subimage, dtype=self._image.dtype)
+        patch_width, patch_height = patch.shape[:2]
+        if not (0 <= x and 0 <= y and x + patch_width <= width and y + patch_height <= height):
+            raise ValueError(f"A patch of shape {patch.shape[:2]} at ({x}, {y}) doesn't fit "
+                             f"inside an image of shape {(width, height)}")
+        n_regions = self.num_regions()
+        offsets = {cc: _symmetric_offsets(offs) for cc, offs in self._contiguities.items()}
+        reach = max([max(abs(dx), abs(dy)) for offs in offsets.values() for dx, dy in offs] + [1])
+
+        # 1. The old regions within reach of the patch: only they can change.
+        xs = np.arange(x - reach, x + patch_width + reach)
+        ys = np.arange(y - reach, y + patch_height + reach)
+        if self._wrap:
+            xs, ys = np.unique(xs % width), np.unique(ys % height)
+        else:
+            xs, ys = xs[(xs >= 0) & (xs < width)], ys[(ys >= 0) & (ys < height)]
+        old_regions = np.unique(self._labels[np.ix_(xs, ys)])
+        old_regions = old_regions[old_regions >= 0]
+
+        # 2. Paint the patch, and gather every pixel to label again: the old
+        #    regions' pixels, and the patch's.
+        self._image[x:x + patch_width, y:y + patch_height] = patch
+        old_positions, _ = _csr_positions(self._pixel_indptr, old_regions)
+        patch_x, patch_y = np.meshgrid(np.arange(x, x + patch_width), np.arange(y, y + patch_height),
+                                       indexing='ij')
+        pixels = np.unique(np.concatenate((
+            np.asarray(self._pixel_indices[old_positions], dtype=np.int64),
+            (patch_x * height + patch_y).ravel().astype(np.int64))))
+        # (Every pixel the old regions had, for step 7.)
+        all_pixels = pixels
+        pixel_x, pixel_y = pixels // height, pixels % height
+        self._labels[pixel_x, pixel_y] = -1
+        classes = np.asarray(self._image[pixel_x, pixel_y])
+        has_class = classes != 0
+        pixels, pixel_x, pixel_y, classes = pixels[has_class], pixel_x[has_class], pixel_y[has_class], classes[has_class]
+
+        # 3. Join those pixels: for every offset, look up each pixel's
+        #    neighbour among them. (Pixels outside them can't be contiguous with
+        #    them, or they would have been in one of the old regions.)
+        present = [cc.item() for cc in np.unique(classes)]
+        pixel_offsets = {cc: _symmetric_offsets(_class_to_map(self._contiguities, cc)) for cc in present}
+        edges_a, edges_b = [], []
+        for dx, dy in sorted(set().union(*pixel_offsets.values())):
+            if (dx, dy) < (0, 0):
+                continue
+            there_x, there_y = pixel_x + dx, pixel_y + dy
+            if self._wrap:
+                there_x, there_y = there_x % width, there_y % height
+                inside = np.ones(len(pixels), dtype=bool)
+            else:
+                inside = (there_x >= 0) & (there_x < width) & (there_y >= 0) & (there_y < height)
+            there = np.searchsorted(pixels, there_x * height + there_y)
+            np.minimum(there, max(len(pixels) - 1, 0), out=there)
+            touching = inside & (pixels[there] == there_x * height + there_y) & (classes[there] == classes)
+            touching &= np.isin(classes, [cc for cc in present if (dx, dy) in pixel_offsets[cc]])
+            edges_a.append(np.flatnonzero(touching))
+            edges_b.append(there[touching])
+        root = _union_find(len(pixels),
+                           np.concatenate(edges_a) if edges_a else np.zeros(0, dtype=np.intp),
+                           np.concatenate(edges_b) if edges_b else np.zeros(0, dtype=np.intp))
+        # The root of every region is its first pixel, so this is scan order.
+        roots = np.flatnonzero(root == np.arange(len(pixels)))
+        region_of_root = np.zeros(len(pixels), dtype=np.intp)
+        region_of_root[roots] = np.arange(len(roots))
+        region_of_pixel = region_of_root[root]
+
+        # 4. Give the new regions IDs, reusing the old ones, and moving the
+        #    highest IDs down into any gaps left over.
+        n_old, n_new = len(old_regions), len(roots)
+        new_id_of_old = np.arange(n_regions)
+        new_id_of_old[old_regions] = -1
+        if n_new <= n_old:
+            new_regions = old_regions[:n_new]
+            n_regions_after = n_regions - (n_old - n_new)
+            gaps = old_regions[n_new:]
+            gaps = gaps[gaps < n_regions_after]
+            moved = np.setdiff1d(np.arange(n_regions_after, n_regions), old_regions)
+            new_id_of_old[moved] = gaps
+        else:
+            new_regions = np.concatenate((old_regions, np.arange(n_regions, n_regions + n_new - n_old)))
+            n_regions_after = n_regions + n_new - n_old
+            moved = np.zeros(0, dtype=np.intp)
+        new_regions = new_regions.astype(np.intp)
+        moved_to = new_id_of_old[moved]
+
+        # 5. Relabel the new regions' pixels, and the moved regions' pixels.
+        self._labels[pixel_x, pixel_y] = new_regions[region_of_pixel]
+        moved_positions, moved_of_position = _csr_positions(self._pixel_indptr, moved)
+        moved_pixels = np.asarray(self._pixel_indices[moved_positions], dtype=np.int64)
+        self._labels[moved_pixels // height, moved_pixels % height] = moved_to[moved_of_position]
+
+        region_classes = np.zeros(n_regions_after, dtype=self._region_classes.dtype)
+        n_copied = min(n_regions, n_regions_after)
+        region_classes[:n_copied] = self._region_classes[:n_copied]
+        region_classes[moved_to] = self._region_classes[moved]
+        region_classes[new_regions] = classes[roots]
+
+        # 6. Splice the pixel lists: the new regions' lists, and the moved
+        #    regions' (as they were), go in their rows, and every other row is
+        #    copied over as it is.
+        # (Sorting by region keeps each region's pixels in increasing order.)
+        order = np.argsort(region_of_pixel, kind='stable')
+        row_sizes = np.concatenate((np.bincount(region_of_pixel, minlength=n_new),
+                                    self._pixel_indptr[moved + 1] - self._pixel_indptr[moved]))
+        pixel_indptr, pixel_indices = _splice_csr(
+            self._pixel_indptr, self._pixel_indices, n_regions_after,
+            np.concatenate((new_regions, moved_to)), np.concatenate(([0], np.cumsum(row_sizes))),
+            np.concatenate((pixels[order], moved_pixels)))
+
+        # 7. Splice the adjacency graph. Only the regions next to the pixels
+        #    of the old and moved regions can list one of them (or a new
+        #    region), so look no further. (Every offset any class can be
+        #    adjacent at, to find them, and then the offsets of their classes.)
+        all_offsets = _symmetric_offsets(set(ortho_map).union(*self._adjacencies.values()))
+        near_pixels = np.concatenate((all_pixels, moved_pixels))
+        near_x, near_y = near_pixels // height, near_pixels % height
+        near = []
+        for dx, dy in sorted(all_offsets):
+            there_x, there_y = near_x + dx, near_y + dy
+            if self._wrap:
+                there_x, there_y = there_x % width, there_y % height
+            else:
+                inside = (there_x >= 0) & (there_x < width) & (there_y >= 0) & (there_y < height)
+                there_x, there_y = there_x[inside], there_y[inside]
+            near.append(self._labels[there_x, there_y])
+        near = np.unique(np.concatenate(near + [new_regions]))
+        near = near[near >= 0]
+        adjacency_offsets = _adjacency_offsets(region_classes[near], self._adjacencies)
+        adjacent_classes = {}
+        for oo in set().union(*adjacency_offsets.values()):
+            adjacent_classes[oo] = [cc for cc, offs in adjacency_offsets.items() if oo in offs]
+
+        #    First, the pairs of the new regions, found from both of their sides.
+        here = new_regions[region_of_pixel]
+        new_sources, new_targets = [], []
+        for dx, dy in sorted(_symmetric_offsets(list(adjacent_classes))):
+            there_x, there_y = pixel_x + dx, pixel_y + dy
+            if self._wrap:
+                there_x, there_y = there_x % width, there_y % height
+                inside = np.ones(len(pixels), dtype=bool)
+            else:
+                inside = (there_x >= 0) & (there_x < width) & (there_y >= 0) & (there_y < height)
+            there = np.full(len(pixels), -1, dtype=np.intp)
+            there[inside] = self._labels[there_x[inside], there_y[inside]]
+            touching = (there >= 0) & (there != here)
+            # here -> there, if (dx, dy) is adjacent for here's class, and
+            # there -> here, if (-dx, -dy) is adjacent for there's class.
+            forward = touching & np.isin(region_classes[here], adjacent_classes.get((dx, dy), []))
+            backward = touching & np.isin(region_classes[np.maximum(there, 0)],
+                                          adjacent_classes.get((-dx, -dy), []))
+            new_sources += [here[forward], there[backward]]
+            new_targets += [there[forward], here[backward]]
+        new_sources = np.concatenate(new_sources) if new_sources else np.zeros(0, dtype=np.intp)
+        new_targets = np.concatenate(new_targets) if new_targets else np.zeros(0, dtype=np.intp)
+
+        #    Then, the kept regions nearby that list an old region, or a moved
+        #    one. Their lists are rebuilt, from their old pairs (with the new
+        #    IDs, leaving out the old regions) and any new ones, as are the
+        #    lists of the moved regions, and of the regions with new pairs.
+        def old_ids(regions):
+            # The old IDs of kept regions (which are the same, unless moved).
+            regions = regions.copy()
+            is_moved = np.isin(regions, moved_to)
+            regions[is_moved] = moved[np.searchsorted(moved_to, regions[is_moved])]
+            return regions
+        kept = near[~np.isin(near, new_regions)]
+        positions, kept_of_position = _csr_positions(self._adjacent_indptr, old_ids(kept))
+        listed = self._adjacent_indices[positions]
+        lists_old = np.zeros(len(kept), dtype=bool)
+        lists_old[kept_of_position[np.isin(listed, old_regions)]] = True
+        lists_moved = np.zeros(len(kept), dtype=bool)
+        lists_moved[kept_of_position[np.isin(listed, moved)]] = True
+        rows = np.unique(np.concatenate((new_regions, kept[lists_old | lists_moved], moved_to, new_sources)))
+        rebuilt = rows[~np.isin(rows, new_regions)]
+        positions, rebuilt_of_position = _csr_positions(self._adjacent_indptr, old_ids(rebuilt))
+        sources = rebuilt[rebuilt_of_position]
+        targets = new_id_of_old[self._adjacent_indices[positions]]
+        pairs = np.unique(np.concatenate((
+            sources[targets >= 0].astype(np.int64) * n_regions_after + targets[targets >= 0],
+            new_sources.astype(np.int64) * n_regions_after + new_targets)))
+        pair_sources = pairs // max(n_regions_after, 1)
+        # (Every pair's source is one of the rows, and both are sorted, so
+        # this is each row's list, in order.)
+        row_indptr = np.searchsorted(pair_sources, np.concatenate((rows, [n_regions_after])))
+        self._adjacent_indptr, self._adjacent_indices = _splice_csr(
+            self._adjacent_indptr, self._adjacent_indices, n_regions_after,
+            rows, row_indptr, pairs % max(n_regions_after, 1))
+
+        self._region_classes = region_classes
+        self._pixel_indptr, self._pixel_indices = pixel_indptr, pixel_indices
+        self._index_regions()
+        # The regions whose adjacent regions changed, other than by changing
+        # IDs: the new regions, and the regions that listed an old one, or
+        # list a new one.
+        adjacent_changed = np.unique(np.concatenate((new_regions, kept[lists_old], new_sources)))
+        return new_id_of_old, new_regions, adjacent_changed
 
 
     # Helper functions from here on.
@@ -371,13 +1379,7 @@ class RegionMapper:
         :returns: The class at pixel (x,y), or -1 if such a class does not exist.
         :rtype: Int
         """
-        # todo: What was I thinking with this design?
-        # What was I thinking in 2018?
-        # If you see this, don't judge me~
-        if self._image[x,y] == 0:
-            return -1
-        else:
-            return self._region_at_pixel[x,y]
+        return int(self._labels[x,y])
 
 
     def regions(self, region_id):
@@ -394,7 +1396,53 @@ class RegionMapper:
         :returns: Tuple of (class) and (list of pixel indices) in that region.
         :rtype: Tuple
         """
-        return self._regions[region_id]
+        xs, ys = np.unravel_index(self.region_pixel_indices(region_id), self._labels.shape)
+        return self._region_classes[region_id], list(zip(xs.tolist(), ys.tolist()))
+
+
+    def region_pixel_indices(self, region_id):
+        """Given the ID of a region, return the flat indices of its pixels.
+
+        This is the array-based counterpart to regions(). The flat index of
+        pixel (x,y) is x*height + y, i.e. np.ravel_multi_index((x,y), shape).
+
+        :param region_id: Integer that maps to a region.
+        :type region_id: Int
+
+        :returns: Flat indices of the pixels in that region, in increasing order.
+        :rtype: numpy.ndarray
+        """
+        return self._pixel_indices[self._pixel_indptr[region_id]:self._pixel_indptr[region_id+1]]
+
+
+    def region_class(self, region_id):
+        """Given the ID of a region, return its class.
+
+        :param region_id: Integer that maps to a region.
+        :type region_id: Int
+
+        :returns: The class of that region.
+        :rtype: Int
+        """
+        return self._region_classes[region_id]
+
+
+    def num_regions(self):
+        """Return the number of regions that were mapped.
+
+        :returns: The number of regions. Region IDs run from 0 to this, exclusive.
+        :rtype: Int
+        """
+        return len(self._region_classes)
+
+
+    def labels(self):
+        """Return the array of region IDs, i.e. region_at_pixel for every pixel.
+
+        :returns: int32 array of shape (w, h), holding -1 where there is no region.
+        :rtype: numpy.ndarray
+        """
+        return self._labels
 
 
     def regions_with_class(self, class_number):
@@ -411,6 +1459,15 @@ class RegionMapper:
         :returns: List of region IDs that have a given class number.
         :rtype: List of int
         """
+        if self._regions_with_class is None:
+            # _regions_with_class:
+            #   E.g. _regions_with_class[2] = [1,3,4]
+                # Regions 1, 3, and 4 are the ones with class 3
+            #   Basically, we also want a mapping of all regions that have a certain class.
+            self._regions_with_class = dict()
+            for region_class in np.unique(self._region_classes):
+                self._regions_with_class[region_class.item()] = \
+                    np.flatnonzero(self._region_classes == region_class).tolist()
         return self._regions_with_class[class_number]
 
     def adjacent_regions(self,region_id):
@@ -423,4 +1480,16 @@ class RegionMapper:
         :returns: List of all region IDs of regions adjacent to a given region ID.
         :rtype: List of int (or empty list)
         """
-        return self._adjacent_regions[region_id]
+        start, end = self._adjacent_indptr[region_id], self._adjacent_indptr[region_id+1]
+        return self._adjacent_indices[start:end].tolist()
+
+    def adjacency(self):
+        """Return the whole region adjacency graph, stored CSR-style.
+
+        The regions adjacent to region i are indices[indptr[i]:indptr[i+1]],
+        in increasing order. This is what adjacent_regions reads from.
+
+        :returns: Tuple of (indptr, indices)
+        :rtype: tuple of numpy.ndarray
+        """
+        return self._adjacent_indptr, self._adjacent_indices
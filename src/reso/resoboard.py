@@ -9,24 +9,122 @@ This code does the heavy lifting! Some important concepts:
    A  'board' is a grid of Reso elements (called **resels**).
 '''
 
+import hashlib
+import os
+from time import perf_counter
+
 import numpy as np
 from PIL import Image
 
-from .regionmapper import ortho_map, diag_map, RegionMapper
-from reso.palette import get, resel_to_rgb, rgb_to_resel,
-    pR, pY, pG, pC, pB, pM, \
-    pr, py, pg, pc, pb, pm, \
-    pO, pL, pT, pS, pP, pV, \
-    po, pl, pt, ps, pp, pv
+from .regionmapper import ortho_map, diag_map, RegionMapper, _map_to_classes, _empty_array, _STRIP_PIXELS, \
+    _splice_csr
+from .cache import board_key
+from .netlist import Netlist, EventSimulator, pack_lanes, unpack_lanes, _csr_positions
+from .jit import JitSimulator
+from .profiling import NULL_PROFILER
+from reso.palette import resel_to_rgb, rgb_to_resel, \
+    pO, pL, pT, pS, pP, \
+    po, pl, pt, ps, pp
 # Note: It's safe to do `from reso.palette import *` if you prefer.
 
 
+def load_image(filename, memmap_dir = None):
+    """Load an image as a uint8 array of shape (w, h, 3), indexed (x,y).
+    
+    The image is copied out of PIL a band of rows at a time, so the only
+    full-size copies are PIL's own (freed when this returns) and the returned
+    array. (np.array(Image.open(...)) would make an RGBA copy, and slicing
+    off the alpha would keep all of it alive.)
+    
+    :param filename: Location of the image.
+    :type filename: String
+    :param memmap_dir: If given, the array is a np.memmap of an anonymous
+        temporary file in this directory, rather than held in memory. This lets
+        the OS page it out, for images larger than RAM.
+    :type memmap_dir: String
+    
+    :returns: The RGB image, as a (possibly memory-mapped) view of shape (w, h, 3)
+    :rtype: numpy.ndarray
+    """
+    with Image.open(filename) as pil_image:
+        width, height = pil_image.size
+        image = _empty_array((height, width, 3), np.uint8, memmap_dir)
+        rows_per_band = max(1, _BAND_PIXELS // max(1, width))
+        for top in range(0, height, rows_per_band):
+            bottom = min(height, top + rows_per_band)
+            band = pil_image.crop((0, top, width, bottom))
+            if band.mode not in ("RGB", "RGBA"):
+                band = band.convert("RGB")
+            image[top:bottom] = np.asarray(band)[:, :, :3]
+    return np.swapaxes(image, 0, 1)
+
+
+# Number of pixels load_image copies out of PIL at a time.
+_BAND_PIXELS = 2**20
+
+
+def load_indexed_image(filename, rgb_to_resel = rgb_to_resel, dtype = np.uint8, memmap_dir = None):
+    """Load a palette-indexed image (i.e. mode 'P', like most GIFs, and PNGs
+    saved with save_png(..., palette = ...)) straight into resels.
+    
+    Every pixel of such an image is an index into its palette of at most 256
+    colors, so only the palette is mapped to resels (see
+    regionmapper._map_to_classes), and every pixel is one lookup of its index.
+    The RGB image is one lookup of the palette, too. (Like load_image, both
+    are filled a band of rows at a time.)
+    
+    :param filename: Location of the image.
+    :type filename: String
+    :param rgb_to_resel: Mapping of RGB tuples to resels.
+    :type rgb_to_resel: dict
+    :param dtype: dtype of the resel map.
+    :type dtype: numpy.dtype
+    :param memmap_dir: If given, both arrays are np.memmaps of anonymous
+        temporary files in this directory (see load_image).
+    :type memmap_dir: String
+    
+    :returns: None if the image isn't palette-indexed. Otherwise, a tuple of
+        the RGB image, as a view of shape (w, h, 3), and the resel map, as a
+        view of shape (w, h).
+    :rtype: Tuple of numpy.ndarray, or None
+    """
+    with Image.open(filename) as pil_image:
+        if pil_image.mode != "P":
+            return None
+        width, height = pil_image.size
+        # The palette, padded to 256 colors (indices past it are black), and
+        # the resel of every color in it.
+        palette = np.zeros((256, 3), dtype=np.uint8)
+        colors = np.array(pil_image.getpalette()[:768], dtype=np.uint8).reshape(-1, 3)
+        palette[:len(colors)] = colors
+        resel_of_index = _map_to_classes(rgb_to_resel, palette[:, None, :], dtype = dtype)[:, 0]
+        
+        image = _empty_array((height, width, 3), np.uint8, memmap_dir)
+        resel_map = _empty_array((height, width), dtype, memmap_dir)
+        rows_per_band = max(1, _BAND_PIXELS // max(1, width))
+        for top in range(0, height, rows_per_band):
+            bottom = min(height, top + rows_per_band)
+            indices = np.asarray(pil_image.crop((0, top, width, bottom)))
+            image[top:bottom] = palette[indices]
+            resel_map[top:bottom] = resel_of_index[indices]
+    return np.swapaxes(image, 0, 1), resel_map.T
+
+
 # Wire and Node classes used below to hold data about the state during iteration
+#
+# A board keeps the state of every region in NumPy arrays indexed by region ID
+# (ResoBoard._state and ResoBoard._next_state), rather than in one object per
+# region. Wire() and Node() objects are now just views into those arrays, made
+# on demand, so they cost nothing unless you ask for them. (__slots__ keeps each
+# view small: no per-instance __dict__.)
 class Wire:
     """ A class representing a wire. It can be on or off (controlled by 'state'),
     and extra information is stored in 'next_state' during
     
-    (This could be a dataclass! But I want to be backwards-compatible.)
+    A Wire made directly (e.g. Wire(3, True)) holds its own state. ResoBoard
+    makes Wires that view its state arrays instead, so setting wire.state
+    changes the board (on every engine: the board is told, through on_set,
+    to bring its engine's copy of the wire states up to date.)
     
     :param regionid: The integer representing the unique ID of the region that
         is this wire.
@@ -37,16 +135,52 @@ class Wire:
         iterations.
     :type next_state: Bool or Int
     """
+    __slots__ = ("regionid", "_states", "_next_states", "_index", "_on_set")
+    
     def __init__(self, regionid, state = False, next_state = False):
         self.regionid = regionid
-        self.state = state
-        self.next_state = next_state
+        self._states = np.array([state], dtype=np.int8)
+        self._next_states = np.array([next_state], dtype=bool)
+        self._index = 0
+        self._on_set = None
+    
+    @classmethod
+    def _view(cls, regionid, states, next_states, on_set = None):
+        """Make a Wire viewing states[regionid] and next_states[regionid].
+        on_set, if given, is called after setting its state.
+        """
+        wire = cls.__new__(cls)
+        wire.regionid = regionid
+        wire._states = states
+        wire._next_states = next_states
+        wire._index = regionid
+        wire._on_set = on_set
+        return wire
+    
+    @property
+    def state(self):
+        return bool(self._states[self._index])
+    
+    @state.setter
+    def state(self, state):
+        self._states[self._index] = state
+        if self._on_set is not None:
+            self._on_set()
+    
+    @property
+    def next_state(self):
+        return bool(self._next_states[self._index])
+    
+    @next_state.setter
+    def next_state(self, next_state):
+        self._next_states[self._index] = next_state
 
 
 class Node:
     """Representing all other nodes, which are static and hold no other info.
     
-    (This could be a dataclass! But I want to be backwards-compatible.)
+    Like Wire, a Node made directly holds its own state, and ResoBoard makes
+    Nodes that view its state array.
     
     :param regionid: The integer representing the unique ID of the region that
         is this wire.
@@ -56,11 +190,60 @@ class Node:
     :type state: Bool or Int
     """
     # Node is everything that is not a wire
+    # For 'and' nodes, state starts at False,
+    # and state locks to -1 if connected to an off wire.
+    __slots__ = ("regionid", "_states", "_index")
+    
     def __init__(self, regionid, state = False):
         self.regionid = regionid
-        self.state = state # Remains false between iterations
-        # For 'and' nodes, state starts at False,
-        # and state locks to -1 if connected to an off wire.
+        self._states = np.array([state], dtype=np.int8) # Remains false between iterations
+        self._index = 0
+    
+    @classmethod
+    def _view(cls, regionid, states):
+        """Make a Node viewing states[regionid]."""
+        node = cls.__new__(cls)
+        node.regionid = regionid
+        node._states = states
+        node._index = regionid
+        return node
+    
+    @property
+    def state(self):
+        # An int rather than a bool, since 'and' nodes can be -1.
+        return int(self._states[self._index])
+    
+    @state.setter
+    def state(self, state):
+        self._states[self._index] = state
+
+
+# The engines that can run ResoBoard.iterate() (see the ResoBoard docstring)
+ENGINES = ("object", "numpy", "event", "parallel", "jit")
+
+# paint_wires() table that paints every resel as itself, for the resel map.
+_RESEL_IDENTITY = np.arange(256)
+
+# The (off, on) resels of a wire, by its class, for _wire_colors.
+_WIRE_COLORS = np.zeros((256, 2), dtype=np.uint8)
+_WIRE_COLORS[[pO, pS, pL]] = [(po, pO), (ps, pS), (pl, pL)]
+
+# The most wire states that ResoBoard.run(..., detect_cycles = True) remembers.
+MAX_CYCLE_STATES = 2**18
+
+
+def _view_property(name):
+    """A ResoBoard attribute holding Wire()/Node() views, e.g. _wires, that is
+    built the first time it's used. (See ResoBoard._views.)
+    """
+    return property(lambda self: self._views()[name])
+
+
+def _state_hash(packed_state):
+    """Hash a bit-packed state of wires, for cycle detection.
+    (128 bits, so that two different states practically never collide.)
+    """
+    return hashlib.blake2b(packed_state.tobytes(), digest_size = 16).digest()
 
 
 # todo: ResoBoard has wire colors hard-coded into it (pR, pr, pB, pb, etc.)
@@ -86,6 +269,46 @@ class ResoBoard:
     :param rgb_to_resel: Dict mapping pixel values (i.e. RGB 3-tuples) to 'resel'
         enums.
     :type rgb_to_resel: Dict
+    :param engine: Which engine runs iterate(). "object" (the default) walks
+        the regions one at a time through the adjacency dicts. "numpy"
+        runs the compiled Netlist instead, which is much faster for large
+        boards and gives bit-for-bit identical results. With the "numpy"
+        engine, _wire_state holds the state of the board, and _state is
+        updated to match it after every iteration. "event" is
+        like "numpy", but event-driven: it only propagates changes through the
+        fan-out of the wires that changed (see netlist.EventSimulator), which
+        is fastest when only a small fraction of wires toggle each tick.
+        "parallel" is like "numpy", but splits the board into strips, and
+        simulates each strip on its own worker process (see parallel.py), for
+        huge boards. The processes are started on the first tick, and stopped
+        by close(). "jit" is like "numpy", but runs the ticks in one fused
+        loop compiled by Numba (see jit.py), many ticks per call. Without
+        Numba installed, it falls back to stepping the Netlist like "numpy".
+    :type engine: String
+    :param memmap_dir: If given, the image (when loaded from a file) and the
+        resel map are memory-mapped from temporary files in this directory, so
+        that boards larger than RAM can be loaded. (See load_image.) The
+        regions are then mapped a strip at a time, with their labels and pixel
+        lists memory-mapped too (see RegionMapper's strip_pixels).
+    :type memmap_dir: String
+    :param cache: If given, a cache.BoardCache to load the compiled board from
+        (skipping the region mapping), or to save it to after compiling it.
+        Boards are looked up by a hash of the image and of rgb_to_resel.
+    :type cache: cache.BoardCache
+    :param profiler: If given, a profiling.Profiler to time every phase of
+        loading, compiling, iterating and painting the board with. The
+        number of regions of every class, the number of edges and the
+        fan-out of every kind of element are counted into it once compiled.
+    :type profiler: profiling.Profiler
+    :param processes: Number of worker processes of the "parallel" engine.
+        Defaults to the number of CPUs.
+    :type processes: Int
+    :param optimize: If True (the default), the "numpy", "event", "parallel"
+        and "jit" engines (and run_vectors) simulate the Netlist after
+        Netlist.optimize(), which drops the logic no wire reads, merges
+        outputs driving the same wires and collapses input -> output chains.
+        The wire states are exactly the same either way.
+    :type optimize: Bool
     
     Note that resel_to_rgb and rgb_to_resel form a bidict, i.e.
         resel_to_rgb[rgb_to_resel[x]] = x, and
@@ -93,13 +316,26 @@ class ResoBoard:
     
     Member variables:
     _image: RGB image, numpy array, shape (w, h, 3)
-    _resel_map: Grid of resel values, i.e. numpy array of shape (w, h)
+    _resel_map: Grid of resel values, i.e. numpy array of shape (w, h), one
+        byte per resel for the default palette.
     _RM: The RegionMapper object that actually maps regions of pixels/resels to 
         'regions'.
+    _state: int8 array of the state of every region, indexed by region ID.
+        1 or 0 for wires; nodes only use it during a tick, and are 0 between
+        ticks.
+    _next_state: Boolean array of the next state of every wire, indexed by
+        region ID. Only used during a tick.
+    _region_classes: The class of every region, indexed by region ID (e.g. pO
+        for any orange wire, pp for inputs.)
+    
+    The following lists and dicts of Wire() and Node() objects are built the
+    first time they are used, and are views of _state and _next_state. I.e.
+    setting RB._wires[0].state sets _state. (Nothing else uses them.)
     _resel_objects: List of Wire() or Node() objects, indexed by their unique
         region IDs.
     _orange_wires, _sapphire_wires, _lime_wires
         Lists of Wire() objects, pointing to the same objects as in _resel_objects
+    _wires: All the Wire() objects, i.e. orange, then sapphire, then lime.
      _inputs, _outputs, _ands, _xors:
         Lists of Node() objects, pointing to the same objects as in _resel_objects.
     
@@ -111,44 +347,87 @@ class ResoBoard:
     _adj_ands: Indexed by ID of an input node
     _adj_outputs: Indexed by ID of an input node, an XOR node, or an AND node.
     _adj_wires: Indexed by ID of output nodes.
+    
+    _netlist: The compiled Netlist of the board. Its wires are in _wires order,
+        until apply_patch() puts new wires in the places of the ones it removes.
+    _optimized: The Netlist the "numpy", "event", "parallel" and "jit" engines step,
+        i.e. _netlist.optimize() (or _netlist, if optimize is False). It has
+        the same wires as _netlist.
+    _wire_state: Boolean array of the state of every wire, in _netlist order.
+        Only kept up-to-date by the "numpy", "event" and "jit" engines.
+    _events: The netlist.EventSimulator used by the "event" engine.
+    _jit: The jit.JitSimulator used by the "jit" engine.
+    _parallel: The parallel.ParallelSimulator used by the "parallel" engine,
+        once started.
     """
     def __init__(self,
         image,
         resel_to_rgb = resel_to_rgb,
-        rgb_to_resel = rgb_to_resel
+        rgb_to_resel = rgb_to_resel,
+        engine = "object",
+        cache = None,
+        memmap_dir = None,
+        profiler = None,
+        processes = None,
+        optimize = True
     ):
         """
         Initialization (1) Grabs the image, (2) converts it to self._resel_map,
         (3) identifies the different regions (wires, inputs, etc.) in
         self._resel map, (4) Sets up associations between those regions so that
-        they can be quickly accessed, and (5) initializes Wire and Node objects
-        corresponding to each region.
+        they can be quickly accessed, and (5) initializes the state arrays
+        holding the state of each region.
         
         
         """
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine {engine!r}; expected one of {ENGINES}")
+        self._engine = engine
+        self._profiler = NULL_PROFILER if profiler is None else profiler
+        self._processes = processes
+        self._optimize = optimize
+        self._parallel = None
+        # True once a Wire() view has set a state (see _sync_wire_views).
+        self._wire_views_set = False
+        phase = self._profiler.phase
+        
         # First step: Load the image and convert it to _resel_map.
         # Here, the 'image' can be a string (which will be loaded)
         # or a prepared numpy array (of shape (w, h, 3).)
+        resel_dtype = np.result_type(*[np.min_scalar_type(resel) for resel in rgb_to_resel.values()] + [np.uint8])
+        indexed_resel_map = None
         if isinstance(image, str):
-            image = np.swapaxes(np.array(Image.open(image)), 0, 1)[:,:,:3]
+            with phase("load.decode"):
+                # Palette-indexed images come with their resel map (see
+                # load_indexed_image); anything else is loaded as RGB.
+                indexed = load_indexed_image(image, rgb_to_resel, resel_dtype, memmap_dir = memmap_dir)
+                if indexed is None:
+                    image = load_image(image, memmap_dir = memmap_dir)
+                else:
+                    image, indexed_resel_map = indexed
         # else: assume image is of format (width, height, 3), indexed (x,y)
         self._image = image
+        compile_start = perf_counter()
         
         # Now convert our image to a resel_map (e.g. (255,0,0) becomes pR).
-        width = self._image.shape[0]
-        height = self._image.shape[1]
-        self._resel_map = np.zeros((width, height))
-        # Yeah I'm nesting for-loops rather than vectorizing this through a GPU.
-        # whatcha gonna do about it?!?
-        # (msubmit a patch? please? i don't know how to do these things on GPU
-        #  using Python, to be perfectly honest...)
-        for ii in range(width):
-            for jj in range(height):
-                self._resel_map[ii,jj] = get(rgb_to_resel, tuple(self._image[ii,jj]))
+        # This is one vectorized lookup over the whole image (see
+        # regionmapper._map_to_classes), rather than a loop over every pixel.
+        # Resels fit in a byte, so this takes one byte per pixel.
+        # (Like the image, it's stored transposed, i.e. as the view of a
+        #  (h, w) array, so memory-mapped files are in the usual row order.)
+        with phase("compile.palette"):
+            if indexed_resel_map is not None:
+                self._resel_map = indexed_resel_map
+            else:
+                resel_map = _empty_array(self._image.shape[:2][::-1], resel_dtype, memmap_dir)
+                self._resel_map = _map_to_classes(rgb_to_resel, self._image, out = resel_map.T)
         
         # Identify the different regions, giving us our self._RM (RegionMapper)
         # First, we note that 'on' wires and 'off' wires **are the same class!**
         # So, for our regionmapper, we need them to map to the same class.
+        # The reserved colors (pR, pr, pG, ... pV, pv) aren't part of any
+        # circuit, so they're left out, and mapped like the background: they
+        # never become regions, and nothing is adjacent to them.
         class_dict = { 
             pO : pO, po : pO,    # pO is also used to denote orange wires
             pS : pS, ps : pS,    # pS is also used to denote sapphire wires
@@ -156,14 +435,6 @@ class ResoBoard:
             
             pP : pP, pp : pp,   # Every other color maps to itself
             pT : pT, pt : pt,
-            
-            pR : pR, pr : pr,
-            pG : pG, pg : pg,
-            pB : pB, pb : pb,
-            pC : pC, pc : pc,
-            pY : pY, py : py,
-            pM : pM, pm : pm, 
-            pV : pV, pv : pv
         }
         
         # Wires are diagonally contiguous (to make it easier for them to 'cross')
@@ -174,122 +445,103 @@ class ResoBoard:
             pL : ortho_map + diag_map
         } # Wires are diagonally contiguous
         
+        # If this board was compiled before, load the regions, their
+        # adjacencies and the initial wire states from the cache instead.
+        compiled = None
+        if cache is not None:
+            with phase("compile.cache_load"):
+                cache_key = board_key(self._image, rgb_to_resel)
+                compiled = cache.load(cache_key)
+                if compiled is not None and not set(RegionMapper._ARRAYS + ("wire_state",)) <= compiled.keys():
+                    compiled = None
+        
         # Now we use our RegionMapper helper to identify all the distinct,
         # contiguous regions that form the 'elements' of our circuit!
-        self._RM = RegionMapper( self._resel_map,             
-                                 class_dict     = class_dict,           
-                                 contiguities   = contiguities,
-                                 sparse         = True)
+        if compiled is None:
+            self._RM = RegionMapper( self._resel_map,             
+                                     class_dict     = class_dict,           
+                                     contiguities   = contiguities,
+                                     sparse         = True,
+                                     profiler       = profiler,
+                                     strip_pixels   = None if memmap_dir is None else _STRIP_PIXELS,
+                                     memmap_dir     = memmap_dir)
+        else:
+            with phase("compile.map_classes"):
+                class_image = _empty_array(self._resel_map.shape[::-1], self._resel_map.dtype, memmap_dir).T
+                self._RM = RegionMapper.from_arrays(
+                    _map_to_classes(class_dict, self._resel_map, out = class_image), compiled,
+                    class_dict = class_dict, contiguities = contiguities)
         # As a reminder, self._RM (RegionMapper) provides:
         #   self._RM.region_at_pixel(x,y)
         #   self._RM.regions(id)
         #   self._RM.regions_with_class(class)
         #   self._RM.adjacent_regions(region_id)
         
-        # Now, we need to set up a Wire()/Node() object for each region.
-        # We need lists of all such objects (self._orange_wires, etc...),
-        # and the regionid -> Wire()/Node() list self._resel_objects.
-        # This code is redundant in space, but we save time :)
-        # (... todo: this can be cleaned up? We can just use
-        # self._RM.regions_with_class(pO), right? It'll be uglier but who cares?)
-        
-        self._resel_objects = [None]*len(self._RM._regions)
-        # # One entry in self._resel_objects for each region we have.
-        self._orange_wires   = []
-        self._sapphire_wires = []
-        self._lime_wires     = []
-        self._inputs         = []
-        self._outputs        = []
-        self._ands           = []
-        self._xors           = []
-        
-        # Now we loop over all our regions, and their associated class type.
-        for regionid, (classid, _) in enumerate(self._RM._regions):
-            if classid == pO or classid == pS or classid == pL:
-                # Recall that off wires and on wires were both mapped to the same class.
-                new_object = Wire(regionid)
-                if classid == pO:
-                    self._orange_wires.append(new_object)
-                elif classid == pS:
-                    self._sapphire_wires.append(new_object)
-                elif classid == pL:
-                    self._lime_wires.append(new_object)
-                else:
-                    raise ValueError('Check wire mapping loop. This shouldn\'t be possible to see!')
-            else:
-                # It's not a wire, we have a node instead!
-                # We need to add it to the correct list of elements.
-                new_object = Node(regionid)
-                if classid == pp:
-                    self._inputs.append(new_object)
-                elif classid == pP:
-                    self._outputs.append(new_object)
-                elif classid == pt:
-                    self._ands.append(new_object)
-                elif classid == pT:
-                    self._xors.append(new_object)
-                elif classid in (
-                    pR, pr, pG, pg, pB, pb, pC, pc, pY, py, pM, pm, pV, pv
-                ):
-                    # List of all reserved but not-yet-used colors
-                    pass
-                else:
-                    # This should never happen!
-                    # Our region mapper should not have been able to get to this state...
-                    print("Unrecognized classid", classid)
-                    raise ValueError('Somehow, we mapped a class outside the palette. Shouldn\'t be possible!')
+        # Now, we need to set up the state of every region.
+        # Rather than a Wire()/Node() object for each region, the state lives
+        # in arrays indexed by region ID (see the Wire class), so it takes a
+        # couple of bytes per region:
+        #   _state[region] is the state of a wire (0 or 1), or the scratch
+        #       state of a node during a tick (0, 1, or -1 for a locked 'and').
+        #   _next_state[region] is the next state of a wire, during a tick.
+        #   _region_classes[region] is the class of the region (pO, pp, ...).
+        # The old lists and dicts of Wire()/Node() objects (_wires,
+        # _adj_inputs, ...) are still there, but only built if used.
+        with phase("compile.state"):
+            self._region_classes = self._RM._region_classes
+            num_regions = self._RM.num_regions()
+            self._state = np.zeros(num_regions, dtype=np.int8)
+            self._next_state = np.zeros(num_regions, dtype=bool)
+            self._view_cache = None
             
-            # We also want whatever object we create to be stored in our list
-            # of all _resel_objects.
-            # (todo... can't we, at the end of this loop, add all our other lists
-            #  together to make one big list?)
-            self._resel_objects[regionid] = new_object
-        
-        # region), then that whole wire should be considered on.
-        # So, loop over every wire, and if any pixel is 'on', then turn it on!
-        for wires in (self._orange_wires, self._sapphire_wires, self._lime_wires): 
-            for wire in wires:
-                wire_is_on = False
-                pixels_in_wire = self._RM.regions(wire.regionid)[1]
-                for ii, jj in pixels_in_wire:
-                    if self._resel_map[ii, jj] in (pO, pS, pL):
-                        wire_is_on = True
-                        break
-                wire.state = wire_is_on
-
-        # Now we set up adjacency dictionaries.
-        # For each of these, dict[region_id] -> Wire()/Node() object
-        # _adj_inputs[]  for wire_id, 
-        # _adj_xors[]    for all input cells
-        # _adj_ands[]    for all input cells
-        # _adj_outputs[] for all input cells and all logic nodes
-        # _adj_wires[]   for all output cells
-        
-        self._adj_inputs    = dict()
-        self._adj_xors      = dict()
-        self._adj_ands      = dict()
-        self._adj_outputs   = dict()
-        self._adj_wires     = dict()
-
-        # Loop over the following:
-        # For every region in _orange_wires, create an entry in self._adj_xors[region]
-        # for every *adjacent* region having a class in classids
-        for from_list, to_dict, classids in \
-            [((self._orange_wires + self._sapphire_wires + self._lime_wires),
-              self._adj_inputs, (pp,)),
-             (self._inputs, self._adj_xors, (pT,)),
-             (self._inputs, self._adj_ands, (pt,)),
-             (self._inputs, self._adj_outputs, (pP,)),
-             (self._xors, self._adj_outputs, (pP,)),
-             (self._ands, self._adj_outputs, (pP,)),
-             (self._outputs, self._adj_wires, (pO, pS, pL))]:
-             
-             for resel in from_list:
-                to_dict[resel.regionid] = []
-                for adj_reg_id in self._RM.adjacent_regions(resel.regionid):
-                    adj_reg_class = self._RM.regions(adj_reg_id)[0]
-                    if adj_reg_class in classids:
-                        to_dict[resel.regionid].append(self._resel_objects[adj_reg_id])
+            # Anything but a wire or node means the region mapper got to a
+            # state it shouldn't be able to.
+            if not np.isin(self._region_classes, (pO, pS, pL, pp, pP, pt, pT)).all():
+                raise ValueError('Somehow, we mapped a class outside the palette. Shouldn\'t be possible!')
+            
+            # If any pixel of a wire is 'on' (i.e. pO rather than po, for an orange
+            # region), then that whole wire should be considered on.
+            # So, find the regions of every 'on' pixel, and turn those wires on!
+            # (Cached boards already know which wires are on.)
+            # (A strip of rows at a time, as the board may be memory-mapped.)
+            if compiled is None:
+                labels = self._RM.labels()
+                rows = max(1, _STRIP_PIXELS // max(1, self._resel_map.shape[0]))
+                for y0 in range(0, self._resel_map.shape[1], rows):
+                    on_pixels = np.isin(self._resel_map[:, y0:y0 + rows], (pO, pS, pL))
+                    self._state[np.unique(labels[:, y0:y0 + rows][on_pixels])] = True
+            else:
+                self._state[np.asarray(compiled["wire_state"], dtype=bool)] = True
+        
+        self._resel_rgb = np.zeros((256, 3), dtype=self._image.dtype)
+        for resel, rgb in resel_to_rgb.items():
+            self._resel_rgb[resel] = rgb
+        # The (transient length, period) found by the last run(), if any.
+        self._cycle = None
+        # The wire states last painted onto the resel map and image.
+        # (None means nothing has been painted yet, so paint everything.)
+        self._painted_resel_state = None
+        self._painted_image_state = None
+        
+        # The pixels of every wire, and the compiled Netlist.
+        self._compile_wires("compile")
+        
+        if cache is not None and compiled is None:
+            with phase("compile.cache_save"):
+                # wire_state is indexed by region ID here, so that it doesn't
+                # depend on the order of _wires.
+                wire_state = np.zeros(self._RM.num_regions(), dtype=bool)
+                wire_state[self._netlist.wire_regions] = self._wire_state
+                cache.save(cache_key, dict(self._RM.to_arrays(), wire_state = wire_state))
+        
+        # The "object" engine walks the regions through adjacency lists.
+        if self._engine == "object":
+            with phase("compile.objects"):
+                self._adjacency = self._adjacency_lists()
+        
+        self._profiler.add("compile", perf_counter() - compile_start)
+        if profiler is not None:
+            self._count_elements()
         
         # Finally,  we want our cheap bidict for converting resels to pixels
         # and  vice-versa
@@ -297,45 +549,286 @@ class ResoBoard:
         self.resel_to_rgb = resel_to_rgb
     
     
-    def _update(self, resel_map = False, update_image = True):
+    def _compile_wires(self, stage):
+        """Set up everything that follows from the regions and _state: the
+        pixels of every wire (to paint them), and the compiled and optimized
+        Netlists (and the state of the "numpy" and "event" engines). Run by
+        __init__; apply_patch() splices all of these instead.
+        
+        :param stage: The stage to time the phases under, e.g. "compile"
+            (i.e. "compile.wire_pixels", "compile.netlist" and
+            "compile.optimize").
+        :type stage: String
+        """
+        # The wires, orange, then sapphire, then lime, each in region order.
+        # Recall that off wires and on wires were both mapped to the same class.
+        wire_regions_by_color = [np.flatnonzero(self._region_classes == classid)
+                                 for classid in (pO, pS, pL)]
+        wire_regionids = np.concatenate(wire_regions_by_color).astype(np.intp)
+        
+        # Precompute, for painting wires in _update(), the pixels of every wire:
+        #   The pixels of wire ii (in _wires order) are
+        #   (_wire_pixel_x[k], _wire_pixel_y[k]) for k in
+        #   range(_wire_pixel_indptr[ii], _wire_pixel_indptr[ii+1]), and
+        #   _wire_of_pixel[k] = ii.
+        #   _wire_colors[ii] is the (off, on) resel pair of wire ii, and
+        #   _resel_rgb[resel] is the RGB pixel of a resel.
+        wire_pixels_start = perf_counter()
+        wire_pixels, self._wire_of_pixel = _csr_positions(self._RM._pixel_indptr, wire_regionids)
+        self._wire_pixel_x, self._wire_pixel_y = np.unravel_index(
+            self._RM._pixel_indices[wire_pixels], self._resel_map.shape)
+        self._wire_pixel_indptr = np.zeros(len(wire_regionids) + 1, dtype=np.intp)
+        np.cumsum(np.diff(self._RM._pixel_indptr)[wire_regionids], out=self._wire_pixel_indptr[1:])
+        self._wire_colors = np.repeat(np.array([(po, pO), (ps, pS), (pl, pL)], dtype=np.uint8),
+                                      [len(regions) for regions in wire_regions_by_color], axis=0)
+        self._profiler.add(f"{stage}.wire_pixels", perf_counter() - wire_pixels_start)
+        
+        # Compile the board down to flat index arrays, for the "numpy" and
+        # "event" engines.
+        with self._profiler.phase(f"{stage}.netlist"):
+            indptr, indices = self._RM.adjacency()
+            self._netlist = Netlist(self._RM._region_classes, indptr, indices, wire_regionids)
+        
+        # Then cut it down to what the wires depend on, for simulating.
+        with self._profiler.phase(f"{stage}.optimize"):
+            self._optimized = self._netlist.optimize() if self._optimize else self._netlist
+            self._start_simulators()
+    
+    def _start_simulators(self):
+        """Set up the wire states of the "numpy", "event" and "jit" engines
+        from _state, and the simulators of the last two, for _optimized."""
+        self._wire_state = self._state[self._netlist.wire_regions] != 0
+        # (These simulators update _wire_state in place.)
+        if self._engine == "event":
+            self._events = EventSimulator(self._optimized, self._wire_state, self._profiler)
+        elif self._engine == "jit":
+            self._jit = JitSimulator(self._optimized, self._wire_state)
+    
+    def apply_patch(self, x, y, subimage):
+        """Paint an RGB image over part of the board, and recompile only what
+        it touches, rather than the whole board.
+        
+        The board is painted in its current state first, then the patch is
+        painted over it. Only the regions within reach of the patch are
+        mapped again (see RegionMapper.apply_patch); every other wire keeps
+        its state. Like when compiling, a new wire is on if any of its pixels
+        is (so drawing an 'on' pixel onto a wire turns it on), and is then
+        repainted in that state.
+        
+        The Netlist is spliced too (see Netlist.patched): wires keep their
+        places in get_wire_states(), except that new wires take the places of
+        the ones that are gone, and then the last wires are moved down into
+        any places left over. Only the part of the optimized Netlist that the
+        changed wires depend on is optimized again (see Netlist.reoptimized),
+        and only the pixels of the new and moved wires are looked up again.
+        The adjacency lists of the "object" engine are only rebuilt for the
+        regions next to the patch, the "event" and "jit" engines set up their
+        simulators again, and the "parallel" engine restarts its workers on
+        the next tick.
+        
+        :param x: x-index of the top-left pixel of the patch
+        :type x: Int
+        :param y: y-index of the top-left pixel of the patch
+        :type y: Int
+        :param subimage: RGB image of shape (w, h, 3), indexed (x,y) like the
+            image of the board.
+        :type subimage: numpy.ndarray
+        
+        :raises ValueError: If subimage isn't an RGB image, or doesn't fit on the board.
+        """
+        subimage = np.asarray(subimage)
+        width, height = self._resel_map.shape
+        if subimage.ndim != 3 or subimage.shape[2] != 3:
+            raise ValueError(f"subimage should have shape (w, h, 3), got {subimage.shape}")
+        patch_width, patch_height = subimage.shape[:2]
+        if not (0 <= x and 0 <= y and x + patch_width <= width and y + patch_height <= height):
+            raise ValueError(f"A patch of shape {subimage.shape[:2]} at ({x}, {y}) doesn't fit "
+                             f"on a board of shape {(width, height)}")
+        phase = self._profiler.phase
+        
+        with phase("patch"):
+            self.close()
+            self._cycle = None
+            self._update(resel_map = True, update_image = True)
+            resel_patch = _map_to_classes(self.rgb_to_resel, subimage, dtype = self._resel_map.dtype)
+            self._image[x:x + patch_width, y:y + patch_height] = subimage
+            self._resel_map[x:x + patch_width, y:y + patch_height] = resel_patch
+            
+            old_adjacency = self._RM.adjacency()
+            with phase("patch.regions"):
+                new_id_of_old, new_regions, adjacent_changed = self._RM.apply_patch(x, y, resel_patch)
+            
+            # Carry over the state of every region that was kept, and turn on
+            # the new wires with any 'on' pixel. (Regions only move down from
+            # the end, into the places of the ones that are gone.)
+            with phase("patch.state"):
+                self._region_classes = self._RM._region_classes
+                num_regions = self._RM.num_regions()
+                moved_from = num_regions + np.flatnonzero(new_id_of_old[num_regions:] >= 0)
+                state = np.zeros(num_regions, dtype=np.int8)
+                num_kept = min(num_regions, len(self._state))
+                state[:num_kept] = self._state[:num_kept]
+                state[new_id_of_old[moved_from]] = self._state[moved_from]
+                state[new_regions] = 0
+                positions, region_of_position = _csr_positions(self._RM._pixel_indptr, new_regions)
+                pixels = self._RM._pixel_indices[positions]
+                on_pixels = np.isin(self._resel_map[pixels // height, pixels % height], (pO, pS, pL))
+                state[new_regions[np.unique(region_of_position[on_pixels])]] = True
+                self._state = state
+                self._next_state = np.zeros(num_regions, dtype=bool)
+                self._view_cache = None
+            
+            # Splice the Netlist, rather than compiling it again.
+            with phase("patch.netlist"):
+                indptr, indices = self._RM.adjacency()
+                self._netlist, renumberings, touched = self._netlist.patched(
+                    self._region_classes, indptr, indices, new_id_of_old, new_regions, adjacent_changed)
+                wires = renumberings["wire"]
+            
+            # The pixels (and colors) of the new wires, and of the wires that
+            # were moved down, in their new places.
+            with phase("patch.wire_pixels"):
+                rows = np.concatenate((wires.added, wires.moved_to))
+                row_regions = self._netlist.wire_regions[rows]
+                positions, row_of_position = _csr_positions(self._RM._pixel_indptr, row_regions)
+                pixel_x, pixel_y = np.unravel_index(self._RM._pixel_indices[positions], self._resel_map.shape)
+                row_indptr = np.zeros(len(rows) + 1, dtype=np.intp)
+                np.cumsum(np.diff(self._RM._pixel_indptr)[row_regions], out=row_indptr[1:])
+                self._wire_pixel_indptr, (self._wire_pixel_x, self._wire_pixel_y, self._wire_of_pixel) = _splice_csr(
+                    self._wire_pixel_indptr, (self._wire_pixel_x, self._wire_pixel_y, self._wire_of_pixel),
+                    wires.num_after, rows, row_indptr, (pixel_x, pixel_y, rows[row_of_position]))
+                self._wire_colors = wires.rearranged(
+                    self._wire_colors, _WIRE_COLORS[self._region_classes[self._netlist.wire_regions[wires.added]]])
+            
+            # Then optimize only what the changed wires depend on.
+            with phase("patch.optimize"):
+                if self._optimize:
+                    self._optimized = self._netlist.reoptimized(self._optimized, renumberings, touched,
+                                                                new_id_of_old)
+                else:
+                    self._optimized = self._netlist
+                self._start_simulators()
+            
+            if self._engine == "object":
+                with phase("patch.objects"):
+                    self._splice_adjacency_lists(new_id_of_old, new_regions, old_adjacency)
+            
+            # Paint the new wires (the patch may have drawn them half on).
+            state = self.get_wire_states()
+            self.paint_wires(self._resel_map, _RESEL_IDENTITY, wires = wires.added, state = state)
+            self.paint_wires(self._image, self._resel_rgb, wires = wires.added, state = state)
+            self._painted_resel_state = self._painted_image_state = state
+    
+    def _splice_adjacency_lists(self, new_id_of_old, new_regions, old_adjacency):
+        """Update the adjacency dicts of the "object" engine after a patch
+        (see apply_patch), rebuilding only the entries of the regions that
+        changed, were moved, or are next to one that did.
+        
+        :param new_id_of_old: New region ID of every old region, or -1
+        :type new_id_of_old: numpy.ndarray
+        :param new_regions: IDs of the regions that were mapped again
+        :type new_regions: numpy.ndarray
+        :param old_adjacency: The (indptr, indices) adjacency graph from
+            before the patch.
+        :type old_adjacency: Tuple of numpy.ndarray
+        """
+        def neighbours(indptr, indices, regions):
+            # Regions listing any of these regions, and the regions they list.
+            sources = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+            positions, _ = _csr_positions(indptr, regions)
+            return np.concatenate((sources[np.isin(indices, regions)], indices[positions]))
+        
+        old_ids = np.arange(len(new_id_of_old))
+        gone = old_ids[new_id_of_old < 0]
+        moved = old_ids[(new_id_of_old >= 0) & (new_id_of_old != old_ids)]
+        changed = np.concatenate((new_regions, new_id_of_old[moved]))
+        old_neighbours = new_id_of_old[neighbours(*old_adjacency, gone)]
+        touched = np.unique(np.concatenate((
+            changed, neighbours(*self._RM.adjacency(), changed), old_neighbours[old_neighbours >= 0])))
+        stale = set(gone.tolist()) | set(moved.tolist()) | set(touched.tolist())
+        for adjacent, rebuilt in zip(self._adjacency, self._adjacency_lists(touched)):
+            for regionid in stale.intersection(adjacent):
+                del adjacent[regionid]
+            adjacent.update(rebuilt)
+    
+    def _update(self, resel_map = False, update_image = True, only_changed = True):
         """Update the values in resel map and in the image.
         This updates the "externally visible" parts of a ResoBoard.
         
         For speed, this isn't necessary to do every time! None of the information
         updated in this function is necessary for the logic, only the output.
+        
+        Every wire pixel is painted in one fancy-indexed assignment, using the
+        pixel index arrays precomputed in __init__. By default, only the wires
+        whose state changed since the last time the resel map (or image) was
+        painted are repainted.
                 
         :param resel_map: If True, update our _resel_map of classes
         :type resel_map: bool
         :param image: If True, update our RGB _image
         :type image: bool
+        :param only_changed: If False, repaint every wire.
+        :type only_changed: bool
         """
-        # Only loop if we have something we want to update!
-        if resel_map or update_image:
-            for oncolor, offcolor, wires in (
-                (pO, po, self._orange_wires),
-                (pS, ps, self._sapphire_wires),
-                (pL, pl, self._lime_wires)
-            ):
-                # "oncolor" refers to 'saturated red' and 'saturated blue'
-                # "offcolor" refers to 'dark red' and 'dark blue'
-                # and 'wires' are the list of all wires that we have
-                for wire in wires:
-                    # Get the RGB color (color_tuple) the set the pixel to
-                    color = oncolor if wire.state else offcolor
-                    color_tuple = np.array(self.resel_to_rgb[color])
-                    # Get every pixel in the region
-                    # (RegionMapper.regions(regionid)[1] is the list of pixels)
-                    regionid = wire.regionid
-                    pixel_list = self._RM.regions(regionid)[1]
-                    
-                    for ii, jj in pixel_list:
-                        if resel_map:
-                            # 'color' is one of pO, po, pS, ps, pL, pl
-                            self._resel_map[ii,jj] = color
-                        if update_image:
-                            # 'color_tuple' is the RGB tuple
-                            self._image[ii,jj] = color_tuple
-                
+        # Only paint if we have something we want to update!
+        if not (resel_map or update_image):
+            return
+        
+        state = self.get_wire_states()
+        for target, table, painted_attr in (
+            (self._resel_map if resel_map else None, _RESEL_IDENTITY, "_painted_resel_state"),
+            (self._image if update_image else None, self._resel_rgb, "_painted_image_state")
+        ):
+            if target is None:
+                continue
+            painted_state = getattr(self, painted_attr)
+            if painted_state is None or not only_changed:
+                # Paint every pixel of every wire.
+                self.paint_wires(target, table, state = state)
+            else:
+                changed_wires = np.flatnonzero(state != painted_state)
+                if len(changed_wires) == 0:
+                    continue
+                self.paint_wires(target, table, wires = changed_wires, state = state)
+            setattr(self, painted_attr, state)
+    
+    def paint_wires(self, target, table, wires = None, state = None):
+        """Paint the pixels of some wires onto an array, e.g. an image.
+        
+        Every wire pixel (x,y) is set to table[resel], where resel is the
+        resel of that wire in its current state (one of pO, po, pS, ps, pL, pl).
+        This is how _update() paints the resel map and the image, and it can be
+        used to keep any other per-pixel view of the board up to date, e.g.
+        a palette-indexed image.
+        
+        :param target: Array of shape (w, h, ...) to paint onto, indexed (x,y)
+        :type target: numpy.ndarray
+        :param table: Array indexed by resel, holding the value to paint
+        :type table: numpy.ndarray
+        :param wires: Indices of the wires to paint, in get_wire_states() order.
+            Defaults to every wire.
+        :type wires: numpy.ndarray
+        :param state: The wire states to paint, from get_wire_states(). Defaults
+            to the current state.
+        :type state: numpy.ndarray
+        
+        :returns: Tuple of (x indices, y indices) of the pixels painted.
+        :rtype: Tuple of numpy.ndarray
+        """
+        if state is None:
+            state = self.get_wire_states()
+        with self._profiler.phase("render"):
+            if wires is None:
+                pixels = slice(None)
+                wire_of_pixel = self._wire_of_pixel
+            else:
+                pixels, _ = _csr_positions(self._wire_pixel_indptr, np.asarray(wires, dtype=np.intp))
+                wire_of_pixel = self._wire_of_pixel[pixels]
+            # 'colors' are resels, i.e. one of pO, po, pS, ps, pL, pl
+            colors = self._wire_colors[wire_of_pixel, state[wire_of_pixel].astype(np.intp)]
+            xs, ys = self._wire_pixel_x[pixels], self._wire_pixel_y[pixels]
+            target[xs, ys] = table[colors]
+        return xs, ys
     
     def get_resel_map(self):
         """Return the Numpy array representing the Reso board
@@ -346,6 +839,16 @@ class ResoBoard:
         # 
         return self._resel_map
     
+    def get_resel_palette(self):
+        """Return the RGB color of every resel, e.g. to save the resel map as
+        a palette-indexed PNG (see output.save_png). Pixels that aren't resels
+        (0 in the resel map) are black.
+        
+        :returns: uint8 array of shape (largest resel + 1, 3), indexed by resel.
+        :rtype: numpy.ndarray
+        """
+        return self._resel_rgb[:max(self.resel_to_rgb) + 1].copy()
+    
     def get_image(self):
         """Return the Numpy array containing the underlying image.
         
@@ -354,8 +857,32 @@ class ResoBoard:
         """
         return self._image
     
+    def get_wire_states(self):
+        """Return the state of every wire, as a boolean array.
+        
+        The wires are in _wires order (orange, then sapphire, then lime) until
+        apply_patch() moves some, and get_wire_regions() gives the region ID
+        of each.
+        
+        :returns: Boolean array of shape (number of wires,)
+        :rtype: numpy.ndarray
+        """
+        if self._engine == "object":
+            return self._state[self._netlist.wire_regions] != 0
+        self._sync_wire_views()
+        return self._wire_state.copy()
+    
+    def get_wire_regions(self):
+        """Return the region ID of every wire, in the same order as
+        get_wire_states().
+        
+        :returns: Integer array of shape (number of wires,)
+        :rtype: numpy.ndarray
+        """
+        return self._netlist.wire_regions
+    
     def iterate(self, update_resels = True, update_image = True):
-        """Iterate the board, updating every Wire() object.
+        """Iterate the board, updating the state of every wire.
         This is the 'main logic' of updating a Reso circuit.
         
         Also updates the resels if update_resels is True,
@@ -387,52 +914,473 @@ class ResoBoard:
         :param image: If True, update our RGB _image
         :type image: bool
         """
-        
-        # Update all the 'input' nodes connected to wires
-        # and then update every connected logic node ('xor', 'and')
-        for wire in (self._orange_wires + self._sapphire_wires + self._lime_wires):
-            # For each input connected to that wire,
-            for inputnode in self._adj_inputs[wire.regionid]:
-                # Update the internal states of adjacent xor, and, outputs
-                for xornode in self._adj_xors[inputnode.regionid]:
-                    xornode.state = xornode.state ^ wire.state
-                
-                for andnode in self._adj_ands[inputnode.regionid]:
-                    if not (andnode.state == -1):
-                        if wire.state == False:
-                            andnode.state = -1
-                        else:
-                            andnode.state = True
-                for outnode in self._adj_outputs[inputnode.regionid]:
-                    outnode.state = outnode.state or wire.state
-        
-        # For each 'xor' logical element,
-        # update the state of connected output nodes
-        for xornode in self._xors:
-            for outnode in self._adj_outputs[xornode.regionid]:
-                outnode.state = outnode.state or xornode.state
-        
-        # For each 'and' logical element,
-        # update the state of connected output nodes
-        for andnode in self._ands:
-            if andnode.state == True:
-                for outnode in self._adj_outputs[andnode.regionid]:
-                    outnode.state = outnode.state or andnode.state
-        
-        # For each output node, update the state of connected wires.
-        for outnode in self._outputs:
-            # Update the next_state of each adjacent wire
-            for wire in self._adj_wires[outnode.regionid]:
-                 wire.next_state = wire.next_state or outnode.state
-        
-        # Finally, reset the states of every wire.
-        # We used 'next_state' just as a placeholder during iteration
-        for wire in (self._orange_wires + self._sapphire_wires + self._lime_wires):
-            wire.state = wire.next_state
-            wire.next_state = False
-
-        for node in self._xors + self._ands + self._inputs + self._outputs:
-            node.state = False
+        self._sync_wire_views()
+        with self._profiler.phase("tick"):
+            if self._engine == "numpy":
+                self._iterate_netlist()
+            elif self._engine == "event":
+                self._iterate_events()
+            elif self._engine == "parallel":
+                self._iterate_parallel()
+            elif self._engine == "jit":
+                self._iterate_jit()
+            else:
+                self._iterate_objects()
         
         # By default, also updates the resels and the image
         self._update(update_resels, update_image)
+    
+    def run(self, n, record = False, update_resels = True, update_image = True,
+            detect_cycles = False):
+        """Iterate the board n times in one call.
+        
+        This is the same as calling iterate() n times, except that the resels
+        and image are only updated once, at the end, and the "numpy",
+        "event", "parallel" and "jit" engines only update _state once, at the
+        end. (Without record or detect_cycles, the "parallel" and "jit"
+        engines run all n ticks in one go, without stopping in between.)
+        
+        If record is set, the state of every wire after every tick is written
+        into a bit-packed array of shape (n, ceil(number of wires / 8)), i.e.
+        record[t] = np.packbits(wire states after t+1 ticks). Use
+        np.unpackbits(record, axis=1, count=number of wires) to unpack it. The
+        wires are in the same order as get_wire_states().
+        
+        If detect_cycles is set, the state of the wires is hashed after every
+        tick. As soon as a state repeats, the board is known to be periodic
+        from then on (every tick only depends on the tick before), so whole
+        periods are skipped and only the last (n - t) % period ticks are
+        simulated. A fixed point is just a period of 1. The transient length
+        and period found are available from get_cycle() afterwards. At most
+        MAX_CYCLE_STATES hashes are kept; past that, the table is cleared and
+        detection starts over (so periods longer than that are not found).
+        
+        :param n: Number of ticks to iterate the board.
+        :type n: Int
+        :param record: False to not record anything, True to record into a new
+            array, or a preallocated uint8 array of the shape above to record
+            into (e.g. a np.memmap, for very long traces).
+        :type record: Bool or numpy.ndarray
+        :param update_resels: If True, update our _resel_map of classes at the end
+        :type update_resels: bool
+        :param update_image: If True, update our RGB _image at the end
+        :type update_image: bool
+        :param detect_cycles: If True, look for a cycle and skip over it.
+        :type detect_cycles: bool
+        
+        :raises ValueError: If record is an array of the wrong shape.
+        
+        :returns: The record array, or None if record is False
+        :rtype: numpy.ndarray
+        """
+        packed_width = (self._netlist.num_wires + 7) // 8
+        if record is True:
+            record = np.zeros((n, packed_width), dtype=np.uint8)
+        elif record is False or record is None:
+            record = None
+        elif record.shape != (n, packed_width):
+            raise ValueError(f"record has shape {record.shape}, expected {(n, packed_width)}")
+        
+        # How to advance the board by one tick, and read the state of its wires.
+        # The "numpy", "event", "parallel" and "jit" engines only sync _state at the end.
+        self._sync_wire_views()
+        initial_state = self.get_wire_states()
+        if self._engine == "numpy":
+            def engine_step():
+                self._wire_state = self._optimized.step(self._wire_state, self._profiler)
+            current_state = lambda: self._wire_state
+        elif self._engine == "event":
+            engine_step = self._events.step
+            current_state = lambda: self._wire_state
+        elif self._engine == "parallel":
+            parallel = self._parallel_simulator()
+            engine_step = parallel.run
+            current_state = parallel.get_state
+        elif self._engine == "jit":
+            engine_step = self._jit.run
+            current_state = lambda: self._wire_state
+        else:
+            engine_step = self._iterate_objects
+            current_state = self.get_wire_states
+        if self._profiler is NULL_PROFILER:
+            step = engine_step
+        else:
+            def step():
+                with self._profiler.phase("tick"):
+                    engine_step()
+        
+        # seen maps the hash of every state since tick window_start to its tick.
+        seen = {_state_hash(np.packbits(initial_state)) : 0} if detect_cycles else None
+        window_start = 0
+        self._cycle = None
+        tick = 0
+        if self._engine in ("parallel", "jit") and record is None and seen is None:
+            # Nothing is looked at between ticks, so run them all at once.
+            start = perf_counter()
+            (parallel if self._engine == "parallel" else self._jit).run(n)
+            self._profiler.add("tick", perf_counter() - start, calls = n)
+            tick = n
+        while tick < n:
+            step()
+            tick += 1
+            if record is None and seen is None:
+                continue
+            packed = np.packbits(current_state())
+            if record is not None:
+                record[tick - 1] = packed
+            if seen is None:
+                continue
+            
+            key = _state_hash(packed)
+            first_seen = seen.get(key)
+            if first_seen is None:
+                if len(seen) >= MAX_CYCLE_STATES:
+                    seen.clear()
+                    window_start = tick
+                seen[key] = tick
+                continue
+            
+            # The state after tick is the same as after first_seen, so the board
+            # repeats with this period from first_seen on.
+            period = tick - first_seen
+            if first_seen > window_start or window_start == 0:
+                transient = first_seen
+            else:
+                # The cycle may have started before the table was last cleared.
+                transient = self._netlist_transient(initial_state, period)
+            self._cycle = (transient, period)
+            skipped = (n - tick) // period * period
+            if record is not None and skipped > 0:
+                record[tick : tick + skipped] = np.tile(record[tick - period : tick], (skipped // period, 1))
+            tick += skipped
+            seen = None
+        
+        if self._engine == "parallel":
+            self._wire_state = parallel.get_state()
+        if self._engine != "object":
+            self._state[self._netlist.wire_regions] = self._wire_state
+        self._update(update_resels, update_image)
+        return record
+    
+    def get_cycle(self):
+        """Return the cycle found by the last run(..., detect_cycles = True).
+        
+        The transient length t and period p are such that the state of the
+        wires after tick k + p is the same as after tick k, for every k >= t
+        (and t and p are the smallest such numbers). I.e. a board that has
+        settled at tick t has the cycle (t, 1).
+        
+        :returns: Tuple of (transient length, period), or None if no cycle was
+            found in the last run.
+        :rtype: Tuple of int
+        """
+        return self._cycle
+    
+    def _netlist_transient(self, initial_state, period):
+        """Find the transient length of a board with a known period by
+        simulating the Netlist from initial_state. (The second phase of
+        Brent's algorithm: walk two states, period ticks apart, until they meet.)
+        """
+        netlist = self._optimized
+        behind, ahead = initial_state, initial_state
+        for _ in range(period):
+            ahead = netlist.step(ahead)
+        transient = 0
+        while not np.array_equal(behind, ahead):
+            behind, ahead = netlist.step(behind), netlist.step(ahead)
+            transient += 1
+        return transient
+    
+    def run_vectors(self, states, n = 1):
+        """Simulate many independent copies of this board, each starting from
+        its own wire states, for n ticks. The board itself is not changed.
+        
+        The simulations are bit-packed into 64-bit lanes, so each tick of up to
+        64 simulations costs about as much as one tick of the "numpy" engine.
+        This is useful e.g. to exhaustively test a circuit over all its inputs.
+        
+        :param states: Boolean array of shape (number of simulations, number of
+            wires), the initial state of every wire in every simulation. The wires
+            are in the same order as get_wire_states().
+        :type states: numpy.ndarray
+        :param n: Number of ticks to iterate every simulation.
+        :type n: Int
+        
+        :raises ValueError: If states has the wrong shape.
+        
+        :returns: Boolean array of the same shape, the final states.
+        :rtype: numpy.ndarray
+        """
+        states = np.asarray(states, dtype=bool)
+        if states.ndim != 2 or states.shape[1] != self._netlist.num_wires:
+            raise ValueError(f"states has shape {states.shape}, expected (number of simulations, {self._netlist.num_wires})")
+        
+        lanes = pack_lanes(states)
+        for tick in range(n):
+            lanes = self._optimized.step_lanes(lanes)
+        return unpack_lanes(lanes, states.shape[0])
+    
+    def _count_elements(self):
+        """Count the regions of every class, the edges between them and the
+        fan-out of every kind of element into the profiler.
+        (E.g. 'fanout.wire_input' is a histogram of how many inputs each
+        wire touches.)
+        """
+        profiler = self._profiler
+        class_names = {pO : "orange_wire", pS : "sapphire_wire", pL : "lime_wire",
+                       pp : "input", pP : "output", pT : "xor", pt : "and"}
+        region_classes, counts = np.unique(self._RM._region_classes, return_counts=True)
+        for region_class, count in zip(region_classes.tolist(), counts.tolist()):
+            profiler.count(f"regions.{class_names.get(region_class, chr(region_class))}", count)
+        profiler.count("regions.total", self._RM.num_regions())
+        profiler.count("pixels.total", self._resel_map.size)
+        profiler.count("pixels.wires", len(self._wire_of_pixel))
+        profiler.count("edges.adjacency", len(self._RM.adjacency()[1]))
+        
+        nl = self._netlist
+        for kind, num_sources in (
+            ("wire_input", nl.num_wires), ("input_xor", nl.num_inputs),
+            ("input_and", nl.num_inputs), ("input_output", nl.num_inputs),
+            ("xor_output", nl.num_xors), ("and_output", nl.num_ands),
+            ("output_wire", nl.num_outputs)
+        ):
+            sources = getattr(nl, kind + "_src")
+            profiler.count(f"edges.{kind}", len(sources))
+            profiler.histogram(f"fanout.{kind}", np.bincount(sources, minlength=num_sources))
+        
+        # What's left to simulate, after Netlist.optimize().
+        optimized = self._optimized
+        profiler.count("optimized.nodes", optimized.num_inputs + optimized.num_xors +
+                                          optimized.num_ands + optimized.num_outputs)
+        profiler.count("optimized.edges", optimized.num_edges)
+    
+    def _adjacency_lists(self, regions = None):
+        """Build the adjacency dicts the "object" engine walks, from the netlist.
+        
+        :param regions: If given, only build the entries of these region IDs.
+        :type regions: numpy.ndarray
+        
+        :returns: Tuple of dicts (adj_inputs, adj_xors, adj_ands, adj_outputs,
+            adj_wires), each mapping the region ID of an element to the list
+            of region IDs adjacent to it. (Like the _adj_* dicts of the
+            ResoBoard docstring, but holding region IDs rather than objects.)
+        :rtype: Tuple of Dict
+        """
+        nl = self._netlist
+        
+        def adjacency(kind, from_regions, to_regions):
+            # Sort the edges by source (stably, keeping the targets of each
+            # source in region order), then slice out the targets of each source.
+            sources, targets = getattr(nl, kind + "_src"), getattr(nl, kind + "_dst")
+            listed = np.arange(len(from_regions))
+            if regions is not None:
+                wanted = np.isin(from_regions, regions)
+                sources, targets = sources[wanted[sources]], targets[wanted[sources]]
+                listed = listed[wanted]
+            order = np.argsort(sources, kind="stable")
+            targets = to_regions[targets[order]].tolist()
+            indptr = np.concatenate(([0], np.cumsum(np.bincount(sources, minlength=len(from_regions))))).tolist()
+            return {from_regions[ii].item() : targets[indptr[ii]:indptr[ii+1]]
+                    for ii in listed.tolist()}
+        
+        adj_outputs = adjacency("input_output", nl.input_regions, nl.output_regions)
+        adj_outputs.update(adjacency("xor_output", nl.xor_regions, nl.output_regions))
+        adj_outputs.update(adjacency("and_output", nl.and_regions, nl.output_regions))
+        return (adjacency("wire_input", nl.wire_regions, nl.input_regions),
+                adjacency("input_xor", nl.input_regions, nl.xor_regions),
+                adjacency("input_and", nl.input_regions, nl.and_regions),
+                adj_outputs,
+                adjacency("output_wire", nl.output_regions, nl.wire_regions))
+    
+    def _views(self):
+        """Return the Wire()/Node() views of the board, building them the first
+        time they're needed. (See _view_property.)
+        
+        :returns: Dict of attribute name (e.g. '_wires') --> list or dict of views
+        :rtype: Dict
+        """
+        if self._view_cache is not None:
+            return self._view_cache
+        
+        # One view for every region, shared by all the lists and dicts.
+        is_wire = np.isin(self._region_classes, (pO, pS, pL)).tolist()
+        resel_objects = [
+            Wire._view(regionid, self._state, self._next_state, self._wire_view_set) if is_wire[regionid]
+            else Node._view(regionid, self._state)
+            for regionid in range(len(is_wire))
+        ]
+        views = {"_resel_objects" : resel_objects}
+        for name, classid in (("_orange_wires", pO), ("_sapphire_wires", pS), ("_lime_wires", pL),
+                              ("_inputs", pp), ("_outputs", pP), ("_ands", pt), ("_xors", pT)):
+            views[name] = [resel_objects[regionid]
+                           for regionid in np.flatnonzero(self._region_classes == classid).tolist()]
+        views["_wires"] = views["_orange_wires"] + views["_sapphire_wires"] + views["_lime_wires"]
+        views["_nodes"] = views["_xors"] + views["_ands"] + views["_inputs"] + views["_outputs"]
+        
+        adjacency = self._adjacency if self._engine == "object" else self._adjacency_lists()
+        for name, adjacent in zip(("_adj_inputs", "_adj_xors", "_adj_ands", "_adj_outputs", "_adj_wires"),
+                                  adjacency):
+            views[name] = {regionid : [resel_objects[adj_reg_id] for adj_reg_id in adj_reg_ids]
+                           for regionid, adj_reg_ids in adjacent.items()}
+        self._view_cache = views
+        return views
+    
+    # The old Wire()/Node() object attributes, as views of _state (see the
+    # ResoBoard docstring). Nothing is built until one of them is used.
+    _resel_objects  = _view_property("_resel_objects")
+    _orange_wires   = _view_property("_orange_wires")
+    _sapphire_wires = _view_property("_sapphire_wires")
+    _lime_wires     = _view_property("_lime_wires")
+    _wires          = _view_property("_wires")
+    _inputs         = _view_property("_inputs")
+    _outputs        = _view_property("_outputs")
+    _ands           = _view_property("_ands")
+    _xors           = _view_property("_xors")
+    _nodes          = _view_property("_nodes")
+    _adj_inputs     = _view_property("_adj_inputs")
+    _adj_xors       = _view_property("_adj_xors")
+    _adj_ands       = _view_property("_adj_ands")
+    _adj_outputs    = _view_property("_adj_outputs")
+    _adj_wires      = _view_property("_adj_wires")
+    
+    def _iterate_objects(self):
+        """Iterate the board by walking the regions through the adjacency
+        lists, one at a time. (The "object" engine. See iterate() for the
+        description.)
+        """
+        phase = self._profiler.phase
+        adj_inputs, adj_xors, adj_ands, adj_outputs, adj_wires = self._adjacency
+        nl = self._netlist
+        # Lists are much quicker than arrays to index one element at a time,
+        # so walk copies of _state and _next_state, and write them back after.
+        state = self._state.tolist()
+        next_state = self._next_state.tolist()
+        
+        with phase("tick.logic"):
+            # Update all the 'input' nodes connected to wires
+            # and then update every connected logic node ('xor', 'and')
+            for wire in nl.wire_regions.tolist():
+                wire_state = state[wire]
+                # For each input connected to that wire,
+                for inputnode in adj_inputs[wire]:
+                    # Update the internal states of adjacent xor, and, outputs
+                    for xornode in adj_xors[inputnode]:
+                        state[xornode] = state[xornode] ^ wire_state
+                
+                    for andnode in adj_ands[inputnode]:
+                        if not (state[andnode] == -1):
+                            if wire_state == False:
+                                state[andnode] = -1
+                            else:
+                                state[andnode] = True
+                    for outnode in adj_outputs[inputnode]:
+                        state[outnode] = state[outnode] or wire_state
+        
+        with phase("tick.outputs"):
+            # For each 'xor' logical element,
+            # update the state of connected output nodes
+            for xornode in nl.xor_regions.tolist():
+                for outnode in adj_outputs[xornode]:
+                    state[outnode] = state[outnode] or state[xornode]
+        
+            # For each 'and' logical element,
+            # update the state of connected output nodes
+            for andnode in nl.and_regions.tolist():
+                if state[andnode] == True:
+                    for outnode in adj_outputs[andnode]:
+                        state[outnode] = state[outnode] or state[andnode]
+        
+        with phase("tick.wires"):
+            # For each output node, update the state of connected wires.
+            for outnode in nl.output_regions.tolist():
+                # Update the next_state of each adjacent wire
+                for wire in adj_wires[outnode]:
+                     next_state[wire] = next_state[wire] or state[outnode]
+        
+            # Finally, reset the states of every wire.
+            # We used 'next_state' just as a placeholder during iteration.
+            # (Only wires have a next_state, so this resets every node to False.)
+            self._state[:] = next_state
+            self._next_state[:] = False
+    
+    def _iterate_netlist(self):
+        """Iterate the board using the compiled Netlist (the "numpy" engine),
+        then copy the new wire states into _state.
+        """
+        self._wire_state = self._optimized.step(self._wire_state, self._profiler)
+        self._state[self._netlist.wire_regions] = self._wire_state
+    
+    def _wire_view_set(self):
+        """Called by the Wire() views after setting a state in _state."""
+        self._wire_views_set = True
+    
+    def _sync_wire_views(self):
+        """Once a Wire() view has set a state, copy _state into the wire states
+        the "numpy", "event", "parallel" and "jit" engines step (and restart
+        the event simulator's counts from it), before they're used again.
+        """
+        if not self._wire_views_set:
+            return
+        self._wire_views_set = False
+        if self._engine == "object":
+            return
+        # In place, as the event and jit simulators hold on to _wire_state.
+        self._wire_state[:] = self._state[self._netlist.wire_regions] != 0
+        if self._engine == "event":
+            self._events = EventSimulator(self._optimized, self._wire_state, self._profiler)
+        if self._parallel is not None:
+            self._parallel.set_state(self._wire_state)
+    
+    def _parallel_simulator(self):
+        """Return the ParallelSimulator of the "parallel" engine, starting it
+        (from _wire_state) if it isn't running yet.
+        """
+        if self._parallel is None:
+            # (Imported here, as multiprocessing.shared_memory needs Python 3.8.)
+            from .parallel import ParallelSimulator, partition_wires
+            # Strips of the board: sort the wires by their first pixel, by row
+            # and then by column.
+            first_pixels = self._wire_pixel_indptr[:-1]
+            parts = partition_wires(
+                self._optimized, (os.cpu_count() or 1) if self._processes is None else self._processes,
+                positions = (self._wire_pixel_y[first_pixels], self._wire_pixel_x[first_pixels]))
+            self._parallel = ParallelSimulator(self._optimized, self._wire_state, parts = parts)
+        return self._parallel
+    
+    def _iterate_parallel(self):
+        """Iterate the board on the worker processes of the ParallelSimulator
+        (the "parallel" engine), then copy the new wire states into _state.
+        """
+        parallel = self._parallel_simulator()
+        parallel.run(1)
+        self._wire_state = parallel.get_state()
+        self._state[self._netlist.wire_regions] = self._wire_state
+    
+    def close(self):
+        """Stop the worker processes of the "parallel" engine, if any. (Any
+        later tick starts them again.) Boards can also be used in a with
+        statement, to close them at the end.
+        """
+        if self._parallel is not None:
+            self._parallel.close()
+            self._parallel = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    def _iterate_jit(self):
+        """Iterate the board using the JitSimulator (the "jit" engine), then
+        copy the new wire states into _state.
+        """
+        self._jit.run(1)
+        self._state[self._netlist.wire_regions] = self._wire_state
+    
+    def _iterate_events(self):
+        """Iterate the board using the EventSimulator (the "event" engine),
+        then copy the states of the wires that changed into _state.
+        """
+        changed = self._events.step()
+        self._state[self._netlist.wire_regions[changed]] = self._wire_state[changed]
@@ -0,0 +1,329 @@
+'''stream.py
+
+Watch a simulation live, over a local socket.
+
+tick_stream is an async generator over the ticks of a board: every tick runs on
+a worker thread (so the event loop carries on), and it yields the IDs of the
+wires that changed, i.e. indices into ResoBoard.get_wire_states():
+
+    async for tick, changed in tick_stream(board, 1000):
+        ...
+
+TickServer runs a board and pushes those changes to every client connected to
+a Unix socket (or a localhost TCP port), as lines of JSON:
+
+    {"tick": 0, "wires": 5120, "on": [3, 17, ...]}       on connecting
+    {"tick": 7, "changed": [17, 40], "dropped": 2}       after that
+    {"tick": 1000, "done": true}                          at the end
+
+The simulation never waits for a client. Every client has a mask of the wires
+that changed since the last message it was sent; each tick flips the changed
+wires in it. A client is sent at most max_fps messages per second, and only
+once it has read the last one, so the ticks in between are 'dropped' (and
+counted), merged into the next message. The wires that flipped back and forth
+cancel out, so every client's picture of the board is always right as of the
+tick it was last sent, however slow it is, and the memory a client takes is
+one byte per wire.
+
+From the command line,
+    python -m reso board.png -n 100000 --serve /tmp/reso.sock --tick-rate 60
+and, e.g. from another process,
+    async for message in subscribe(path = "/tmp/reso.sock"):
+        ...
+'''
+
+import asyncio
+import json
+import os
+from time import monotonic
+
+import numpy as np
+
+
+# Messages sent to a client per second, at most, by default.
+DEFAULT_MAX_FPS = 30.0
+
+
+async def tick_stream(board, n = None, ticks_per_second = None, executor = None):
+    """Iterate a board, yielding the wires that changed every tick.
+
+    Every tick runs in an executor, so other tasks (e.g. the clients of a
+    TickServer) run in the meantime. The board isn't touched while the
+    consumer holds a tick, so it's safe to look at it then.
+
+    The resel map and image aren't painted; call board.run(0) to bring them
+    up to date.
+
+    :param board: The board to iterate.
+    :type board: resoboard.ResoBoard
+    :param n: Number of ticks, or None to run forever.
+    :type n: Int
+    :param ticks_per_second: If given, run at most this many ticks a second.
+    :type ticks_per_second: Float
+    :param executor: The executor to tick in. Defaults to the event loop's.
+    :type executor: concurrent.futures.Executor
+
+    :raises ValueError: If ticks_per_second isn't positive.
+
+    :yields: (tick, changed): The number of ticks run, from 1, and an integer
+        array of the IDs of the wires that changed (as in get_wire_states()).
+    :rtype: Tuple of (Int, numpy.ndarray)
+    """
+    if ticks_per_second is not None and ticks_per_second <= 0:
+        raise ValueError(f"ticks_per_second should be positive, got {ticks_per_second}")
+    interval = 0.0 if ticks_per_second is None else 1 / ticks_per_second
+    loop = asyncio.get_running_loop()
+
+    def step():
+        board.iterate(update_resels = False, update_image = False)
+        return board.get_wire_states()
+
+    state = board.get_wire_states()
+    tick = 0
+    next_time = monotonic()
+    while n is None or tick < n:
+        next_state = await loop.run_in_executor(executor, step)
+        tick += 1
+        changed = np.flatnonzero(next_state != state)
+        state = next_state
+        yield tick, changed
+        if interval > 0:
+            # Keep to the rate on average, without catching up after a stall.
+            next_time = max(next_time + interval, monotonic())
+            await asyncio.sleep(next_time - monotonic())
+
+
+class _Client:
+    """One connection to a TickServer: the wires that changed since its last
+    message, and the task sending it messages.
+    """
+    def __init__(self, writer, num_wires):
+        self.writer = writer
+        self.pending = np.zeros(num_wires, dtype=bool)
+        # Ticks since the last message
+        self.ticks = 0
+        self.wake = asyncio.Event()
+        self.task = None
+
+
+class TickServer:
+    """Serve the ticks of a board to any number of local clients, as lines of
+    JSON (see the top of stream.py), without ever waiting for them.
+
+    Listens on a Unix socket if path is given, and on a localhost TCP port
+    otherwise.
+
+        async with TickServer(board, path = "/tmp/reso.sock") as server:
+            await server.run(1000, ticks_per_second = 60)
+
+    :param board: The board to simulate.
+    :type board: resoboard.ResoBoard
+    :param path: Location of the Unix socket to listen on.
+    :type path: String
+    :param host: Host to listen on, without a path.
+    :type host: String
+    :param port: TCP port to listen on, without a path. 0 picks a free one
+        (see address).
+    :type port: Int
+    :param max_fps: Messages per second to send each client, at most. The
+        ticks in between are merged into the next message.
+    :type max_fps: Float
+
+    :raises ValueError: If max_fps isn't positive.
+
+    Member variables:
+    tick: The number of ticks run so far.
+    address: The path, or (host, port), listened on once started.
+    """
+    def __init__(self, board, path = None, host = "127.0.0.1", port = 0,
+                 max_fps = DEFAULT_MAX_FPS):
+        if max_fps <= 0:
+            raise ValueError(f"max_fps should be positive, got {max_fps}")
+        self.board = board
+        self.path = path
+        self.host = host
+        self.port = port
+        self.max_fps = max_fps
+        self.tick = 0
+        self.address = None
+        # The state of every wire, as of self.tick. (Kept here, rather than
+        # read from the board, which may be mid-tick on another thread.)
+        self._state = board.get_wire_states()
+        self._clients = set()
+        self._server = None
+        self._done = False
+
+    async def start(self):
+        """Start listening for clients."""
+        if self.path is not None:
+            self._server = await asyncio.start_unix_server(self._connect, path = self.path)
+            self.address = self.path
+        else:
+            self._server = await asyncio.start_server(self._connect, self.host, self.port)
+            self.address = self._server.sockets[0].getsockname()[:2]
+
+    async def run(self, n = None, ticks_per_second = None, executor = None):
+        """Run the board (see tick_stream), pushing every tick to the clients.
+        Then tell every client it's done.
+
+        :param n: Number of ticks, or None to run forever.
+        :type n: Int
+        :param ticks_per_second: If given, run at most this many ticks a second.
+        :type ticks_per_second: Float
+        :param executor: The executor to tick in. Defaults to the event loop's.
+        :type executor: concurrent.futures.Executor
+        """
+        async for tick, changed in tick_stream(self.board, n, ticks_per_second, executor):
+            self.publish(tick, changed)
+        self._done = True
+        for client in self._clients:
+            client.wake.set()
+
+    def publish(self, tick, changed):
+        """Record a tick, and wake up the clients. Never waits.
+
+        :param tick: The number of ticks run.
+        :type tick: Int
+        :param changed: IDs of the wires that changed.
+        :type changed: numpy.ndarray
+        """
+        self.tick = tick
+        self._state[changed] ^= True
+        for client in self._clients:
+            client.pending[changed] ^= True
+            client.ticks += 1
+            client.wake.set()
+
+    async def _connect(self, reader, writer):
+        """Send a new client the whole state, then its changes until done."""
+        client = _Client(writer, len(self._state))
+        client.task = asyncio.current_task()
+        self._clients.add(client)
+        try:
+            await self._send(client, {"tick" : self.tick, "wires" : len(self._state),
+                                      "on" : np.flatnonzero(self._state).tolist()})
+            interval = 1 / self.max_fps
+            while True:
+                sent = monotonic()
+                if not self._done:
+                    await client.wake.wait()
+                    client.wake.clear()
+                # Wait out the rest of the interval; ticks keep piling up.
+                await asyncio.sleep(max(0.0, sent + interval - monotonic()))
+                if client.ticks > 0:
+                    changed = np.flatnonzero(client.pending)
+                    client.pending[changed] = False
+                    message = {"tick" : self.tick, "changed" : changed.tolist(),
+                               "dropped" : client.ticks - 1}
+                    client.ticks = 0
+                    await self._send(client, message)
+                if self._done:
+                    await self._send(client, {"tick" : self.tick, "done" : True})
+                    break
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._clients.discard(client)
+            writer.close()
+
+    async def _send(self, client, message):
+        """Write a message to a client, waiting until it's read (so that only
+        this client waits for a slow reader).
+        """
+        client.writer.write(json.dumps(message).encode() + b"\n")
+        await client.writer.drain()
+
+    async def wait_clients(self, timeout = None):
+        """Wait until every client has been sent the last tick (after run()).
+
+        :param timeout: If given, stop waiting after this many seconds.
+        :type timeout: Float
+        """
+        tasks = [client.task for client in self._clients]
+        if tasks:
+            await asyncio.wait(tasks, timeout = timeout)
+
+    async def close(self):
+        """Stop listening, and disconnect every client."""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+            if self.path is not None:
+                try:
+                    os.unlink(self.path)
+                except FileNotFoundError:
+                    pass
+        for client in list(self._clients):
+            client.task.cancel()
+        await self.wait_clients()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+
+async def subscribe(path = None, host = "127.0.0.1", port = None):
+    """Connect to a TickServer, and yield its messages (see the top of
+    stream.py) until it's done.
+
+    :param path: Location of the server's Unix socket.
+    :type path: String
+    :param host: The server's host, without a path.
+    :type host: String
+    :param port: The server's TCP port, without a path.
+    :type port: Int
+
+    :yields: Every message, as a dict.
+    :rtype: Dict
+    """
+    if path is not None:
+        reader, writer = await asyncio.open_unix_connection(path)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            message = json.loads(line)
+            yield message
+            if message.get("done"):
+                break
+    finally:
+        writer.close()
+
+
+async def serve_board(board, n = None, path = None, host = "127.0.0.1", port = 0,
+                      ticks_per_second = None, max_fps = DEFAULT_MAX_FPS, messages = None):
+    """Serve a board with a TickServer until n ticks have run, and every
+    client has been sent the last one (or 5 seconds have passed). (What the
+    CLI's --serve runs.)
+
+    :param board: The board to simulate.
+    :type board: resoboard.ResoBoard
+    :param n: Number of ticks, or None to run forever.
+    :type n: Int
+    :param path: Location of the Unix socket to listen on, or None for a
+        localhost TCP port.
+    :type path: String
+    :param host: Host to listen on, without a path.
+    :type host: String
+    :param port: TCP port to listen on, without a path.
+    :type port: Int
+    :param ticks_per_second: If given, run at most this many ticks a second.
+    :type ticks_per_second: Float
+    :param max_fps: Messages per second to send each client, at most.
+    :type max_fps: Float
+    :param messages: If given, a text file (e.g. sys.stdout) to print the
+        address to once listening.
+    :type messages: file object
+    """
+    async with TickServer(board, path = path, host = host, port = port, max_fps = max_fps) as server:
+        if messages is not None:
+            print(f"Serving ticks on {server.address}", file = messages, flush = True)
+        await server.run(n, ticks_per_second)
+        await server.wait_clients(timeout = 5)
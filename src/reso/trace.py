@@ -0,0 +1,309 @@
+'''trace.py
+
+A compact format for saving every tick of a simulation.
+
+Only wire pixels ever change color, so instead of a full image per tick, a
+trace stores the board's image and the pixels of every wire once, and then
+only the state of every wire, bit-packed, for every tick. Any frame can be
+rebuilt from that by painting the wires onto the image.
+
+The file layout is:
+    MAGIC
+    header length (uint64, little-endian), then the header: an .npz holding
+        'image'        The RGB image of the board before the first tick, (w, h, 3)
+        'wire_indptr', 'wire_x', 'wire_y'
+                       The pixels of wire i are (wire_x[k], wire_y[k]) for k
+                       in range(wire_indptr[i], wire_indptr[i+1])
+        'wire_rgb'     The (off, on) RGB colors of every wire, (number of wires, 2, 3)
+        'compressed'   Whether the blocks below are compressed
+    Blocks, until the end of the file. Each is
+        number of frames, payload length (both uint32, little-endian),
+        then the payload: the packed wire states (np.packbits) of every frame
+        in the block, one row per frame. If compressed, every row but the first
+        is XORed with the row before it (so wires that didn't change are zero
+        bits), and the whole payload is zlib-compressed.
+
+Frame 0 is the board before the first tick. Frames are appended one block at a
+time, so a trace can be read while it's being written, and a truncated trace
+loses at most its last block. Reading frame N only decompresses one block.
+
+To rebuild frames from a trace on the command line:
+    python -m reso.trace run.trace 0 100 1000 -s frame_
+saves frame_0.png, frame_100.png and frame_1000.png.
+'''
+
+import argparse
+import io
+import struct
+import zlib
+
+import numpy as np
+from PIL import Image
+
+
+MAGIC = b"RESOTRACE\x00\x01\x00"
+
+# Frames per block. Bigger blocks compress better; smaller blocks are
+# quicker to seek into.
+DEFAULT_BLOCK_SIZE = 1024
+
+_BLOCK_HEADER = struct.Struct("<II")
+
+
+class TraceWriter:
+    """Write a trace of a board, one tick at a time.
+
+    Usually, write_trace() is all you need. Otherwise, write the state of the
+    board before the first tick, then after every tick:
+
+        with TraceWriter("run.trace", board) as trace:
+            trace.write(board.get_wire_states())
+            for _ in range(100):
+                board.iterate()
+                trace.write(board.get_wire_states())
+
+    :param path: Location to save the trace to.
+    :type path: String
+    :param board: The board being traced. Its image and wires are saved in the
+        header, so create the writer before iterating the board.
+    :type board: resoboard.ResoBoard
+    :param compress: If True, delta- and zlib-compress the wire states.
+    :type compress: Bool
+    :param block_size: Number of frames per block.
+    :type block_size: Int
+    :param compress_level: zlib compression level, from 0 to 9.
+    :type compress_level: Int
+    """
+    def __init__(self, path, board, compress = True, block_size = DEFAULT_BLOCK_SIZE,
+                 compress_level = 6):
+        if block_size < 1:
+            raise ValueError(f"block_size should be at least 1, got {block_size}")
+        self.block_size = block_size
+        self._compress = compress
+        self._compress_level = compress_level
+        self._num_wires = len(board.get_wire_regions())
+        self._pending = []
+        self._num_pending = 0
+
+        header = io.BytesIO()
+        np.savez_compressed(header,
+            image = board.get_image(),
+            wire_indptr = board._wire_pixel_indptr,
+            wire_x = board._wire_pixel_x,
+            wire_y = board._wire_pixel_y,
+            wire_rgb = board._resel_rgb[board._wire_colors],
+            compressed = np.array(compress))
+        self._file = open(path, "wb")
+        self._file.write(MAGIC + struct.pack("<Q", len(header.getvalue())))
+        self._file.write(header.getvalue())
+
+    def write(self, state):
+        """Append one frame.
+
+        :param state: Boolean array of the state of every wire, e.g. from
+            ResoBoard.get_wire_states()
+        :type state: numpy.ndarray
+        """
+        self.write_packed(np.packbits(state)[np.newaxis])
+
+    def write_packed(self, rows):
+        """Append many frames at once.
+
+        :param rows: uint8 array of shape (number of frames, ceil(number of
+            wires / 8)), the packed wire states, e.g. from ResoBoard.run(n, record = True)
+        :type rows: numpy.ndarray
+        """
+        rows = np.asarray(rows, dtype=np.uint8)
+        if rows.ndim != 2 or rows.shape[1] != (self._num_wires + 7) // 8:
+            raise ValueError(f"rows has shape {rows.shape}, expected (n, {(self._num_wires + 7) // 8})")
+        while len(rows) > 0:
+            take = min(len(rows), self.block_size - self._num_pending)
+            self._pending.append(rows[:take].copy())
+            self._num_pending += take
+            rows = rows[take:]
+            if self._num_pending == self.block_size:
+                self.flush()
+
+    def flush(self):
+        """Write out the frames appended so far as a block, even if it isn't full."""
+        if self._num_pending == 0:
+            return
+        rows = np.concatenate(self._pending)
+        if self._compress:
+            delta = rows.copy()
+            delta[1:] ^= rows[:-1]
+            payload = zlib.compress(delta.tobytes(), self._compress_level)
+        else:
+            payload = rows.tobytes()
+        self._file.write(_BLOCK_HEADER.pack(len(rows), len(payload)))
+        self._file.write(payload)
+        self._file.flush()
+        self._pending = []
+        self._num_pending = 0
+
+    def close(self):
+        """Write any pending frames and close the file."""
+        if not self._file.closed:
+            self.flush()
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def write_trace(board, n, path, compress = True, block_size = DEFAULT_BLOCK_SIZE):
+    """Iterate a board n times, saving a trace of the n + 1 frames.
+
+    The board is iterated with ResoBoard.run(), a block at a time, and its
+    resels and image are not updated.
+
+    :param board: The board to iterate. It is iterated in place.
+    :type board: resoboard.ResoBoard
+    :param n: Number of ticks to iterate the board.
+    :type n: Int
+    :param path: Location to save the trace to.
+    :type path: String
+    :param compress: If True, delta- and zlib-compress the wire states.
+    :type compress: Bool
+    :param block_size: Number of frames per block.
+    :type block_size: Int
+    """
+    with TraceWriter(path, board, compress = compress, block_size = block_size) as trace:
+        trace.write(board.get_wire_states())
+        remaining = n
+        while remaining > 0:
+            ticks = min(remaining, block_size)
+            trace.write_packed(board.run(ticks, record = True, update_resels = False, update_image = False))
+            remaining -= ticks
+
+
+class TraceReader:
+    """Read the frames of a trace, in any order.
+
+    :param path: Location of the trace.
+    :type path: String
+
+    :raises ValueError: If the file is not a trace.
+
+    Member variables:
+    num_frames: Number of frames in the trace.
+    num_wires: Number of wires on the board.
+    """
+    def __init__(self, path):
+        self._file = open(path, "rb")
+        magic = self._file.read(len(MAGIC))
+        if magic != MAGIC:
+            self._file.close()
+            raise ValueError(f"{path} is not a Reso trace (or is from another version)")
+        header_length, = struct.unpack("<Q", self._file.read(8))
+        with np.load(io.BytesIO(self._file.read(header_length)), allow_pickle = False) as header:
+            self._image = header["image"]
+            self._wire_x = header["wire_x"]
+            self._wire_y = header["wire_y"]
+            self._wire_rgb = header["wire_rgb"]
+            self._compressed = bool(header["compressed"])
+            wire_indptr = header["wire_indptr"]
+        self.num_wires = len(wire_indptr) - 1
+        self._wire_of_pixel = np.repeat(np.arange(self.num_wires), np.diff(wire_indptr))
+
+        # Index the blocks: the first frame, file offset and size of each.
+        first_frames, offsets, sizes = [], [], []
+        self.num_frames = 0
+        self._file.seek(0, io.SEEK_END)
+        file_size = self._file.tell()
+        offset = len(MAGIC) + 8 + header_length
+        while offset + _BLOCK_HEADER.size <= file_size:
+            self._file.seek(offset)
+            block_frames, payload_size = _BLOCK_HEADER.unpack(self._file.read(_BLOCK_HEADER.size))
+            if offset + _BLOCK_HEADER.size + payload_size > file_size:
+                # A block that was still being written.
+                break
+            first_frames.append(self.num_frames)
+            offsets.append(offset + _BLOCK_HEADER.size)
+            sizes.append(payload_size)
+            self.num_frames += block_frames
+            offset += _BLOCK_HEADER.size + payload_size
+        self._block_first_frames = np.array(first_frames, dtype=np.int64)
+        self._block_offsets = offsets
+        self._block_sizes = sizes
+        # The last block read, as (block number, unpacked rows)
+        self._cached_block = None
+
+    def __len__(self):
+        return self.num_frames
+
+    def _block(self, block):
+        """Read, and cache, the packed rows of a block."""
+        if self._cached_block is None or self._cached_block[0] != block:
+            self._file.seek(self._block_offsets[block])
+            payload = self._file.read(self._block_sizes[block])
+            if self._compressed:
+                payload = zlib.decompress(payload)
+            rows = np.frombuffer(payload, dtype=np.uint8).reshape(-1, (self.num_wires + 7) // 8)
+            if self._compressed:
+                rows = np.bitwise_xor.accumulate(rows, axis=0)
+            self._cached_block = (block, rows)
+        return self._cached_block[1]
+
+    def state(self, frame):
+        """Return the state of every wire in a frame.
+
+        :param frame: Frame number, from 0 (before the first tick) to num_frames - 1
+        :type frame: Int
+
+        :raises IndexError: If there is no such frame.
+
+        :returns: Boolean array of shape (number of wires,), in the same order as
+            ResoBoard.get_wire_states()
+        :rtype: numpy.ndarray
+        """
+        if not 0 <= frame < self.num_frames:
+            raise IndexError(f"frame {frame} is out of range; the trace has {self.num_frames} frames")
+        block = int(np.searchsorted(self._block_first_frames, frame, side="right")) - 1
+        row = self._block(block)[frame - self._block_first_frames[block]]
+        return np.unpackbits(row, count = self.num_wires).astype(bool)
+
+    def frame(self, frame):
+        """Rebuild the image of a frame.
+
+        :param frame: Frame number, from 0 (before the first tick) to num_frames - 1
+        :type frame: Int
+
+        :raises IndexError: If there is no such frame.
+
+        :returns: Array of shape (w, h, 3), like ResoBoard.get_image()
+        :rtype: numpy.ndarray
+        """
+        state = self.state(frame)
+        image = self._image.copy()
+        image[self._wire_x, self._wire_y] = \
+            self._wire_rgb[self._wire_of_pixel, state[self._wire_of_pixel].astype(np.intp)]
+        return image
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Rebuild frames from a Reso trace.")
+    parser.add_argument("trace", help="Location of the trace.", type=str, nargs=1)
+    parser.add_argument("frames", help="Frame numbers to rebuild. 0 is before the first tick.",
+                        type=int, nargs="*")
+    parser.add_argument("--save", "-s", help="Prefix to save images to. Defaults to 'frame_'.",
+                        type=str, nargs=1)
+    args = parser.parse_args()
+
+    save_prefix = "frame_" if args.save is None else args.save[0]
+    with TraceReader(args.trace[0]) as trace:
+        print(f"{args.trace[0]}: {trace.num_frames} frames of {trace.num_wires} wires.")
+        for frame in args.frames:
+            Image.fromarray(np.swapaxes(trace.frame(frame), 0, 1)).save(f"{save_prefix}{frame}.png")
@@ -1,14 +1,30 @@
 from PIL import Image
+import asyncio
+import io
+import os
+import tempfile
 import unittest as ut
 import numpy as np
 
 # Note: It's safe to do `from reso.palette import *` if you prefer.
-from reso.palette import get, resel_to_rgb, rgb_to_resel,
+from reso.palette import resel_to_rgb, rgb_to_resel, \
     pR, pY, pG, pC, pB, pM, \
     pr, py, pg, pc, pb, pm, \
     pO, pL, pT, pS, pP, pV, \
-    po, pl, pt, ps, pp, pv
-from reso.resoboard import ResoBoard
+    po, pt, ps, pp, pv
+from reso.resoboard import ResoBoard, Wire, Node, load_image, load_indexed_image
+from reso.cache import BoardCache, board_key
+from reso.output import PNGWriterPool, save_png, IndexedFrames, GIFWriter, APNGWriter, RawWriter
+from reso.stream import tick_stream, TickServer, subscribe
+from reso.trace import TraceWriter, TraceReader, write_trace
+from reso.profiling import Profiler
+from reso.parallel import ParallelSimulator, partition_wires
+from reso.jit import JitSimulator, fanin_arrays, _run_ticks
+from reso.netlist import Netlist
+from reso.__main__ import main
+from reso.batch import expand_boards, board_prefixes, run_batch
+from reso.benchmark import GENERATORS, adder_array, clock_rings, gate_chains, benchmark, scaling, compare
+import json
 
 class DefaultPaletteTests(ut.TestCase):
     def setUp(self):
@@ -85,6 +101,15 @@ class ResoBoardInitTest(ut.TestCase):
         self.assertEqual(len(RB._RM.regions_with_class(pS)), 2)
         self.assertEqual(len(RB._RM.adjacent_regions(RB._RM.region_at_pixel(4,3))), 2)
         
+    def test_reserved_colors_are_not_regions(self):
+        # Every color of the palette is drawn here, but only wires and nodes
+        # become regions.
+        RB = ResoBoard("../examples/palette.png")
+        self.assertTrue(np.isin(RB._RM._region_classes, (pO, pS, pL, pp, pP, pt, pT)).all())
+        reserved = np.isin(RB.get_resel_map(), (pR, pr, pG, pg, pB, pb, pC, pc, pY, py, pM, pm, pV, pv))
+        self.assertTrue(reserved.any())
+        self.assertTrue(np.all(RB._RM.labels()[reserved] == -1))
+        
     # todo - from here down
 
     def test_object_lists(self):
@@ -161,6 +186,25 @@ class ResoBoardInitTest(ut.TestCase):
         
         self.assertEqual(RB._orange_wires[0].state, RB._resel_objects[regionid].state)
 
+    def test_state_arrays(self):
+        RB = ResoBoard("testing/test_02_new-palette.png")
+        # No Wire()/Node() objects exist until they're asked for
+        self.assertIsNone(RB._view_cache)
+        self.assertEqual(RB._state.dtype, np.int8)
+        self.assertEqual(len(RB._state), RB._RM.num_regions())
+        wire = RB._orange_wires[0]
+        self.assertEqual(RB._state[wire.regionid], 1)
+        self.assertFalse(hasattr(wire, "__dict__"))
+        # The objects are views of the state arrays
+        wire.state = False
+        self.assertEqual(RB._state[wire.regionid], 0)
+        self.assertFalse(RB.get_wire_states()[list(RB.get_wire_regions()).index(wire.regionid)])
+        # Wires and nodes made by hand hold their own state
+        wire, node = Wire(3, True), Node(4)
+        self.assertEqual((wire.regionid, wire.state, wire.next_state), (3, True, False))
+        node.state = -1
+        self.assertEqual(node.state, -1)
+    
     def test_sanity_01(self):
         # Make sure a number of the new functions run:
         RB = ResoBoard("testing/test_02_new-palette.png")
@@ -188,6 +232,17 @@ class ResoBoardInitTest(ut.TestCase):
         im3 = ResoBoard("testing/test_03_alloff.png").get_image()
         self.assertTrue(np.array_equal(im1, im3))
         
+    def test_update_only_changed(self):
+        # Repainting only the changed wires should give the same image and
+        # resel map as repainting every wire.
+        RB = ResoBoard("testing/test_05_01.png")
+        for _ in range(4):
+            RB.iterate()
+            image, resel_map = RB.get_image().copy(), RB.get_resel_map().copy()
+            RB._update(resel_map = True, update_image = True, only_changed = False)
+            self.assertTrue(np.array_equal(image, RB.get_image()))
+            self.assertTrue(np.array_equal(resel_map, RB.get_resel_map()))
+        
     def test_iterate_1(self):
         # Test a simple clock
         # Should swap back and forth...
@@ -281,8 +336,865 @@ class ResoBoardInitTest(ut.TestCase):
         self.assertTrue(np.array_equal(im4, RB.get_image()))
 
 
+class ResoBoardEngineTest(ut.TestCase):
+    def setUp(self):
+        self.filenames = ["testing/test_02_new-palette.png",
+                          "testing/test_03_01.png",
+                          "testing/test_04.png",
+                          "testing/test_05_01.png"]
+    
+    def tearDown(self):
+        pass
+    
+    def test_bad_engine(self):
+        with self.assertRaises(ValueError):
+            ResoBoard("testing/test_02_new-palette.png", engine="abacus")
+    
+    def test_netlist(self):
+        RB = ResoBoard("testing/test_02_new-palette.png")
+        netlist = RB._netlist
+        self.assertEqual(netlist.num_wires, 4)
+        self.assertEqual(netlist.num_inputs, 4)
+        self.assertEqual(netlist.num_outputs, 4)
+        # Every wire touches exactly one input, and every output one wire
+        self.assertEqual(sorted(netlist.wire_input_src.tolist()), [0, 1, 2, 3])
+        self.assertEqual(sorted(netlist.output_wire_src.tolist()), [0, 1, 2, 3])
+    
+    def test_engines_match_object_engine(self):
+        for engine in ("numpy", "event", "jit"):
+            for fn in self.filenames:
+                RB_object = ResoBoard(fn, engine="object")
+                RB_other = ResoBoard(fn, engine=engine)
+                for _ in range(8):
+                    RB_object.iterate()
+                    RB_other.iterate()
+                    self.assertTrue(np.array_equal(RB_object.get_image(), RB_other.get_image()))
+                    self.assertEqual([wire.state for wire in RB_object._wires],
+                                     [wire.state for wire in RB_other._wires])
+
+    
+    def test_views_set_state_on_every_engine(self):
+        # Setting a wire through its view changes the board the same way on
+        # every engine, whether the next ticks are iterated or run.
+        fn = "testing/test_02_new-palette.png"
+        RB_object = ResoBoard(fn, engine="object")
+        RB_object._wires[0].state = not RB_object._wires[0].state
+        RB_object.iterate()
+        RB_object.iterate()
+        for engine in ("numpy", "event", "parallel", "jit"):
+            for use_run in (False, True):
+                RB = ResoBoard(fn, engine=engine, processes=2)
+                RB._wires[0].state = not RB._wires[0].state
+                self.assertEqual(RB.get_wire_states()[0], RB._wires[0].state)
+                if use_run:
+                    RB.run(2)
+                else:
+                    RB.iterate()
+                    RB.iterate()
+                self.assertEqual([wire.state for wire in RB._wires],
+                                 [wire.state for wire in RB_object._wires])
+                if RB._parallel is not None:
+                    RB._parallel.close()
+
+    def test_optimized_netlist(self):
+        # Every wire of test_02_new-palette goes through an input straight
+        # into an output, so the optimized netlist is just wires.
+        RB = ResoBoard("testing/test_02_new-palette.png", engine="numpy")
+        optimized = RB._optimized
+        self.assertEqual((optimized.num_inputs, optimized.num_outputs), (0, 0))
+        self.assertEqual(optimized.num_edges, 4)
+        self.assertTrue(np.array_equal(optimized.wire_regions, RB._netlist.wire_regions))
+        
+        # From any state, the optimized netlist steps exactly like the compiled one.
+        rng = np.random.default_rng(0)
+        for fn in self.filenames + ["../examples/adders.png", "../examples/clocks.png"]:
+            RB = ResoBoard(fn, engine="numpy")
+            self.assertLessEqual(RB._optimized.num_edges, RB._netlist.num_edges)
+            state = rng.random((64, RB._netlist.num_wires)) < 0.5
+            compiled, optimized = state.copy(), state.copy()
+            for _ in range(4):
+                compiled = np.array([RB._netlist.step(wires) for wires in compiled])
+                optimized = np.array([RB._optimized.step(wires) for wires in optimized])
+                self.assertTrue(np.array_equal(compiled, optimized))
+    
+    def test_optimize_off(self):
+        for engine in ("numpy", "event"):
+            RB_optimized = ResoBoard("../examples/adders.png", engine=engine)
+            RB_compiled = ResoBoard("../examples/adders.png", engine=engine, optimize=False)
+            self.assertIs(RB_compiled._optimized, RB_compiled._netlist)
+            RB_optimized.run(10)
+            RB_compiled.run(10)
+            self.assertTrue(np.array_equal(RB_optimized.get_image(), RB_compiled.get_image()))
+
+
+class JitTest(ut.TestCase):
+    def test_kernel(self):
+        # The kernel, run as plain Python, is Netlist.step() (on the compiled
+        # netlist, and on the optimized one, with its wire -> wire edges).
+        rng = np.random.default_rng(0)
+        for fn in ("testing/test_04.png", "testing/test_05_01.png", "../examples/adders.png"):
+            RB = ResoBoard(fn, engine="numpy")
+            for netlist in (RB._netlist, RB._optimized):
+                state = rng.random(netlist.num_wires) < 0.5
+                for n in (1, 2, 5):
+                    expected = state
+                    for _ in range(n):
+                        expected = netlist.step(expected)
+                    result = state.copy()
+                    _run_ticks(n, result, np.zeros_like(result), *fanin_arrays(netlist),
+                               np.zeros(netlist.num_inputs, dtype=np.int64),
+                               np.zeros(netlist.num_xors, dtype=bool),
+                               np.zeros(netlist.num_ands, dtype=bool),
+                               np.zeros(netlist.num_outputs, dtype=bool))
+                    self.assertTrue(np.array_equal(result, expected))
+    
+    def test_simulator(self):
+        # Compiled (if Numba is installed) or not, the same as stepping the netlist.
+        RB = ResoBoard("../examples/clocks.png", engine="numpy")
+        expected = RB.get_wire_states()
+        for _ in range(7):
+            expected = RB._optimized.step(expected)
+        for use_numba in (True, False):
+            state = RB.get_wire_states()
+            simulator = JitSimulator(RB._optimized, state, use_numba = use_numba)
+            if not use_numba:
+                self.assertFalse(simulator.compiled)
+            simulator.run(3)
+            simulator.run(4)
+            self.assertTrue(np.array_equal(state, expected))
+    
+    def test_jit_engine(self):
+        RB_object = ResoBoard("../examples/adders.png")
+        RB_jit = ResoBoard("../examples/adders.png", engine="jit")
+        RB_object.run(9)
+        RB_jit.run(9)
+        self.assertTrue(np.array_equal(RB_object.get_image(), RB_jit.get_image()))
+        # One tick at a time (e.g. when recording), too.
+        self.assertTrue(np.array_equal(RB_object.run(5, record=True), RB_jit.run(5, record=True)))
+        self.assertTrue(np.array_equal(RB_object.get_image(), RB_jit.get_image()))
+
+
+class ResoBoardRunTest(ut.TestCase):
+    def setUp(self):
+        pass
+    
+    def tearDown(self):
+        pass
+    
+    def test_run_matches_iterate(self):
+        for engine in ("object", "numpy", "event"):
+            RB_iterate = ResoBoard("testing/test_05_01.png", engine=engine)
+            RB_run = ResoBoard("testing/test_05_01.png", engine=engine)
+            for _ in range(5):
+                RB_iterate.iterate()
+            self.assertIsNone(RB_run.run(5))
+            self.assertTrue(np.array_equal(RB_iterate.get_image(), RB_run.get_image()))
+            self.assertTrue(np.array_equal(RB_iterate.get_wire_states(), RB_run.get_wire_states()))
+    
+    def test_run_record(self):
+        for engine in ("object", "numpy", "event"):
+            RB_iterate = ResoBoard("testing/test_05_01.png", engine=engine)
+            RB_run = ResoBoard("testing/test_05_01.png", engine=engine)
+            num_wires = len(RB_run.get_wire_states())
+            record = RB_run.run(6, record=True)
+            self.assertEqual(record.shape, (6, (num_wires + 7) // 8))
+            states = np.unpackbits(record, axis=1, count=num_wires).astype(bool)
+            for tick in range(6):
+                RB_iterate.iterate()
+                self.assertTrue(np.array_equal(states[tick], RB_iterate.get_wire_states()))
+    
+    def test_run_record_preallocated(self):
+        RB = ResoBoard("testing/test_02_new-palette.png", engine="numpy")
+        record = np.zeros((4, 1), dtype=np.uint8)
+        self.assertIs(RB.run(4, record=record), record)
+        # A clock: the wires swap back and forth
+        self.assertEqual(record[0,0], record[2,0])
+        self.assertNotEqual(record[0,0], record[1,0])
+        with self.assertRaises(ValueError):
+            RB.run(3, record=record)
+
+    def test_run_vectors(self):
+        # 100 random starting states, checked one at a time against the netlist
+        RB = ResoBoard("testing/test_05_01.png", engine="numpy")
+        num_wires = len(RB.get_wire_states())
+        rng = np.random.default_rng(0)
+        states = rng.random((100, num_wires)) < 0.5
+        final = RB.run_vectors(states, n=3)
+        self.assertEqual(final.shape, states.shape)
+        for initial, result in zip(states, final):
+            state = initial
+            for _ in range(3):
+                state = RB._netlist.step(state)
+            self.assertTrue(np.array_equal(state, result))
+        with self.assertRaises(ValueError):
+            RB.run_vectors(states[:, 1:])
+    
+    def test_run_detect_cycles(self):
+        # test_05_01 settles after 5 ticks; test_03_01 blinks after 1 tick
+        for fname, cycle in (("testing/test_05_01.png", (5, 1)),
+                             ("testing/test_03_01.png", (1, 2))):
+            for engine in ("object", "numpy", "event"):
+                RB = ResoBoard(fname, engine=engine)
+                RB_cycles = ResoBoard(fname, engine=engine)
+                record = RB.run(20, record=True)
+                record_cycles = RB_cycles.run(20, record=True, detect_cycles=True)
+                self.assertEqual(RB_cycles.get_cycle(), cycle)
+                self.assertTrue(np.array_equal(record, record_cycles))
+                self.assertTrue(np.array_equal(RB.get_image(), RB_cycles.get_image()))
+                self.assertTrue(np.array_equal(RB.get_wire_states(), RB_cycles.get_wire_states()))
+        
+        # No cycle is found before the board repeats
+        RB = ResoBoard("testing/test_05_01.png")
+        RB.run(3, detect_cycles=True)
+        self.assertIsNone(RB.get_cycle())
+
+
+class ResoBoardCacheTest(ut.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.cache = BoardCache(self.cache_dir.name)
+    
+    def tearDown(self):
+        self.cache_dir.cleanup()
+    
+    def test_cached_board_matches(self):
+        for fname in ("testing/test_05_01.png", "testing/test_02_new-palette.png"):
+            RB_uncached = ResoBoard(fname)
+            RB_miss = ResoBoard(fname, cache=self.cache)
+            key = board_key(RB_uncached.get_image(), rgb_to_resel)
+            self.assertTrue(os.path.exists(self.cache.path(key)))
+            RB_hit = ResoBoard(fname, cache=self.cache, engine="numpy")
+            self.assertEqual(RB_hit._RM._adjacent_indices.tolist(), RB_uncached._RM._adjacent_indices.tolist())
+            for _ in range(4):
+                for RB in (RB_uncached, RB_miss, RB_hit):
+                    RB.iterate()
+                self.assertTrue(np.array_equal(RB_uncached.get_image(), RB_miss.get_image()))
+                self.assertTrue(np.array_equal(RB_uncached.get_image(), RB_hit.get_image()))
+    
+    def test_key(self):
+        image = ResoBoard("testing/test_05_01.png").get_image()
+        changed = image.copy()
+        changed[0, 0] = 255 - changed[0, 0]
+        self.assertEqual(board_key(image, rgb_to_resel), board_key(image.copy(), rgb_to_resel))
+        self.assertNotEqual(board_key(image, rgb_to_resel), board_key(changed, rgb_to_resel))
+        self.assertNotEqual(board_key(image, rgb_to_resel), board_key(image, {(0,0,0) : 1}))
+    
+    def test_bad_entry_is_a_miss(self):
+        os.makedirs(self.cache.path("broken"))
+        with open(os.path.join(self.cache.path("broken"), "labels.npy"), "wb") as f:
+            f.write(b"not an npy file")
+        self.assertIsNone(self.cache.load("broken"))
+        self.assertIsNone(self.cache.load("missing"))
+    
+    def test_eviction(self):
+        arrays = {"a" : np.zeros(1000, dtype=np.uint8)}
+        self.cache.save("first", arrays)
+        entry_size = self.cache.entries()[0][1]
+        # Make sure "first" is the least recently used, however coarse the mtimes.
+        os.utime(self.cache.path("first"), (0, 0))
+        self.cache.max_bytes = entry_size
+        self.cache.save("second", arrays)
+        self.assertIsNone(self.cache.load("first"))
+        self.assertIsNotNone(self.cache.load("second"))
+        self.cache.clear()
+        self.assertEqual(self.cache.entries(), [])
+    
+    def test_large_entries(self):
+        # Entries are memory-mapped, and one larger than the whole cache isn't
+        # saved (rather than evicting every other entry).
+        self.cache.save("small", {"a" : np.arange(10)})
+        self.assertIsInstance(self.cache.load("small")["a"], np.memmap)
+        self.cache.max_bytes = 1000
+        self.assertFalse(self.cache.save("large", {"a" : np.zeros(1001, dtype=np.uint8)}))
+        self.assertIsNone(self.cache.load("large"))
+        self.assertIsNotNone(self.cache.load("small"))
+    
+    def test_key_of_memmapped_image(self):
+        # Hashed a strip at a time, a memory-mapped image has the same key.
+        image = ResoBoard("testing/test_05_01.png").get_image()
+        with tempfile.TemporaryDirectory() as memmap_dir:
+            RB = ResoBoard("testing/test_05_01.png", memmap_dir=memmap_dir)
+            self.assertEqual(board_key(RB.get_image(), rgb_to_resel), board_key(image, rgb_to_resel))
+            del RB
+
+
+class LargeBoardLoadingTest(ut.TestCase):
+    def test_load_image(self):
+        for fname in ("testing/test_05_01.png", "testing/test_02_new-palette.png"):
+            expected = np.swapaxes(np.array(Image.open(fname).convert("RGB")), 0, 1)
+            self.assertTrue(np.array_equal(load_image(fname), expected))
+            with tempfile.TemporaryDirectory() as memmap_dir:
+                self.assertTrue(np.array_equal(load_image(fname, memmap_dir=memmap_dir), expected))
+    
+    def test_memmapped_board_matches(self):
+        RB = ResoBoard("testing/test_05_01.png")
+        self.assertEqual(RB._resel_map.dtype, np.uint8)
+        with tempfile.TemporaryDirectory() as memmap_dir:
+            RB_mapped = ResoBoard("testing/test_05_01.png", memmap_dir=memmap_dir)
+            self.assertTrue(np.array_equal(RB._resel_map, RB_mapped._resel_map))
+            # The regions were mapped in memory-mapped strips, to the same labels.
+            self.assertTrue(np.array_equal(RB._RM.labels(), RB_mapped._RM.labels()))
+            for _ in range(4):
+                RB.iterate()
+                RB_mapped.iterate()
+                self.assertTrue(np.array_equal(RB.get_image(), RB_mapped.get_image()))
+            del RB_mapped
+
+
+class ResoBoardPatchTest(ut.TestCase):
+    def test_same_as_recompiling(self):
+        # Patch a running board, here with a copy of another part of it, and
+        # there with random colors, then compare it to compiling the result.
+        rng = np.random.default_rng(3)
+        colors = np.array(list(resel_to_rgb.values()) + [(0, 0, 0)], dtype=np.uint8)
+        for engine in ("object", "numpy", "event"):
+            RB = ResoBoard("../examples/adders.png", engine=engine)
+            width, height = RB.get_resel_map().shape
+            for ii in range(4):
+                RB.run(2)
+                x, y = int(rng.integers(0, width - 8)), int(rng.integers(0, height - 8))
+                if ii % 2 == 0:
+                    patch = RB.get_image()[y:y + 8, x:x + 8].copy()
+                else:
+                    patch = colors[rng.integers(0, len(colors), (8, 8))]
+                RB.apply_patch(x, y, patch)
+                RB_compiled = ResoBoard(RB.get_image().copy(), engine=engine)
+                self.assertTrue(np.array_equal(RB.get_image(), RB_compiled.get_image()))
+                RB.run(3)
+                RB_compiled.run(3)
+                self.assertTrue(np.array_equal(RB.get_image(), RB_compiled.get_image()))
+                self.assertTrue(np.array_equal(RB.get_resel_map(), RB_compiled.get_resel_map()))
+    
+    def test_netlist_same_as_compiling(self):
+        # The spliced Netlist has the edges of compiling it again (with the
+        # same wire order), and the partly reoptimized one steps like optimize().
+        rng = np.random.default_rng(5)
+        colors = np.array(list(resel_to_rgb.values()) + [(0, 0, 0)], dtype=np.uint8)
+        RB = ResoBoard("../examples/basic_gates.png")
+        width, height = RB.get_resel_map().shape
+        for ii in range(6):
+            size = int(rng.integers(1, 40))
+            x, y = int(rng.integers(0, width - size)), int(rng.integers(0, height - size))
+            RB.apply_patch(x, y, colors[rng.integers(0, len(colors), (size, size))])
+            netlist = RB._netlist
+            indptr, indices = RB._RM.adjacency()
+            compiled = Netlist(RB._RM._region_classes, indptr, indices, netlist.wire_regions)
+            for kinds in ("wire_input", "input_xor", "input_and", "input_output",
+                          "xor_output", "and_output", "output_wire"):
+                src_kind, dst_kind = kinds.split("_")
+                def edges(nl):
+                    return sorted(zip(getattr(nl, src_kind + "_regions")[getattr(nl, kinds + "_src")].tolist(),
+                                      getattr(nl, dst_kind + "_regions")[getattr(nl, kinds + "_dst")].tolist()))
+                self.assertEqual(edges(netlist), edges(compiled))
+            optimized = netlist.optimize()
+            for state in rng.random((10, netlist.num_wires)) < 0.5:
+                self.assertTrue(np.array_equal(RB._optimized.step(state), optimized.step(state)))
+
+    def test_keeps_wire_states(self):
+        # Drawing over an empty corner leaves the states of the other wires alone.
+        RB = ResoBoard("../examples/clocks.png")
+        RB.run(5)
+        states = RB.get_wire_states()
+        RB.apply_patch(0, 0, np.zeros((1, 1, 3), dtype=np.uint8))
+        self.assertTrue(np.array_equal(RB.get_wire_states(), states))
+        # An 'on' pixel drawn onto an 'off' wire turns it on.
+        wire = int(np.flatnonzero(~states)[0])
+        x, y = RB._wire_pixel_x[RB._wire_pixel_indptr[wire]], RB._wire_pixel_y[RB._wire_pixel_indptr[wire]]
+        on_color = resel_to_rgb[RB._wire_colors[wire, 1]]
+        RB.apply_patch(int(x), int(y), np.array([[on_color]], dtype=np.uint8))
+        region = RB._RM.region_at_pixel(x, y)
+        self.assertEqual(RB._state[region], 1)
+        self.assertTrue(np.all(RB.get_image()[RB._RM.labels() == region] == on_color))
+    
+    def test_bad_patches(self):
+        RB = ResoBoard("testing/test_05_01.png")
+        with self.assertRaises(ValueError):
+            RB.apply_patch(0, 0, np.zeros((2, 2), dtype=np.uint8))
+        with self.assertRaises(ValueError):
+            RB.apply_patch(-1, 0, np.zeros((2, 2, 3), dtype=np.uint8))
+
+
+class PNGWriterPoolTest(ut.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.TemporaryDirectory()
+    
+    def tearDown(self):
+        self.output_dir.cleanup()
+    
+    def test_frames_are_snapshots(self):
+        for workers in (0, 1, 3):
+            RB = ResoBoard("testing/test_02_new-palette.png")
+            expected = []
+            with PNGWriterPool(workers=workers, compress_level=1, max_pending=2) as writer:
+                for ii in range(6):
+                    expected.append(RB.get_image().copy())
+                    writer.submit(RB.get_image(), os.path.join(self.output_dir.name, f"{workers}_{ii}.png"))
+                    RB.iterate()
+            for ii, image in enumerate(expected):
+                saved = np.swapaxes(np.array(Image.open(os.path.join(self.output_dir.name, f"{workers}_{ii}.png"))), 0, 1)
+                self.assertTrue(np.array_equal(saved, image))
+    
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            PNGWriterPool(compress_level=10)
+        writer = PNGWriterPool(workers=1)
+        writer.submit(np.zeros((2, 2, 3), dtype=np.uint8), os.path.join(self.output_dir.name, "missing", "x.png"))
+        with self.assertRaises(OSError):
+            writer.close()
+
+
+class IndexedImageTest(ut.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.TemporaryDirectory()
+    
+    def tearDown(self):
+        self.output_dir.cleanup()
+    
+    def test_round_trip(self):
+        # A board saved as a palette PNG (or GIF) loads straight back into
+        # the same resels, and simulates the same.
+        self.assertIsNone(load_indexed_image("../examples/adders.png"))
+        RB = ResoBoard("../examples/adders.png")
+        palette = RB.get_resel_palette()
+        png_path = os.path.join(self.output_dir.name, "board.png")
+        gif_path = os.path.join(self.output_dir.name, "board.gif")
+        save_png(RB.get_resel_map().T.copy(), png_path, palette = palette)
+        with Image.open(png_path) as saved:
+            saved.save(gif_path)
+        for path in (png_path, gif_path):
+            with Image.open(path) as saved:
+                self.assertEqual(saved.mode, "P")
+            image, resel_map = load_indexed_image(path)
+            self.assertTrue(np.array_equal(resel_map, RB.get_resel_map()))
+            self.assertTrue(np.array_equal(image, palette[RB.get_resel_map()]))
+            RB_indexed = ResoBoard(path)
+            RB_rgb = ResoBoard(palette[RB.get_resel_map()])
+            self.assertTrue(np.array_equal(RB_indexed.get_image(), RB_rgb.get_image()))
+            RB_indexed.run(4)
+            RB_rgb.run(4)
+            self.assertTrue(np.array_equal(RB_indexed.get_wire_states(), RB_rgb.get_wire_states()))
+            self.assertTrue(np.array_equal(RB_indexed.get_image(), RB_rgb.get_image()))
+    
+    def test_writer_pool(self):
+        RB = ResoBoard("testing/test_05_01.png")
+        path = os.path.join(self.output_dir.name, "frame.png")
+        with PNGWriterPool(workers=1) as writer:
+            writer.submit(RB.get_resel_map(), path, palette = RB.get_resel_palette())
+        with Image.open(path) as saved:
+            self.assertEqual(saved.mode, "P")
+            self.assertTrue(np.array_equal(np.array(saved).T, RB.get_resel_map()))
+            self.assertTrue(np.array_equal(np.swapaxes(np.array(saved.convert("RGB")), 0, 1),
+                                           RB.get_resel_palette()[RB.get_resel_map()]))
+        with self.assertRaises(ValueError):
+            save_png(np.zeros((2, 2, 3), dtype=np.uint8), path, palette = RB.get_resel_palette())
+    
+    def test_main_indexed(self):
+        # The CLI's --indexed saves the same boards as RGB PNGs, as resels.
+        fname = "testing/test_05_01.png"
+        rgb_prefix = os.path.join(self.output_dir.name, "rgb_")
+        indexed_prefix = os.path.join(self.output_dir.name, "indexed_")
+        main(fname, rgb_prefix, 3, writer = PNGWriterPool(workers = 0))
+        main(fname, indexed_prefix, 3, writer = PNGWriterPool(workers = 0), indexed = True)
+        for ii in range(4):
+            resel_map = ResoBoard(f"{rgb_prefix}{ii}.png").get_resel_map()
+            self.assertTrue(np.array_equal(ResoBoard(f"{indexed_prefix}{ii}.png").get_resel_map(), resel_map))
+
+
+class AnimationOutputTest(ut.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.TemporaryDirectory()
+    
+    def tearDown(self):
+        self.output_dir.cleanup()
+    
+    def expected_frames(self, fname, n):
+        RB = ResoBoard(fname)
+        frames = [np.swapaxes(RB.get_image(), 0, 1).copy()]
+        for _ in range(n):
+            RB.iterate()
+            frames.append(np.swapaxes(RB.get_image(), 0, 1).copy())
+        return frames
+    
+    def test_indexed_frames(self):
+        expected = self.expected_frames("testing/test_03_01.png", 4)
+        frames = IndexedFrames(ResoBoard("testing/test_03_01.png"), 4)
+        previous = None
+        for ii, (frame, box) in enumerate(frames):
+            self.assertTrue(np.array_equal(frames.palette[frame], expected[ii]))
+            if previous is not None:
+                # Nothing changes outside of the box
+                changed = np.argwhere(frame != previous)
+                if box is None:
+                    self.assertEqual(len(changed), 0)
+                else:
+                    left, top, right, bottom = box
+                    self.assertTrue(np.all((changed[:, 0] >= top) & (changed[:, 0] < bottom)))
+                    self.assertTrue(np.all((changed[:, 1] >= left) & (changed[:, 1] < right)))
+            previous = frame.copy()
+        self.assertEqual(ii, 4)
+    
+    def test_animations(self):
+        fname = "testing/test_05_01.png"
+        expected = self.expected_frames(fname, 8)
+        frames = IndexedFrames(ResoBoard(fname), 8)
+        height, width = expected[0].shape[:2]
+        gif_path = os.path.join(self.output_dir.name, "out.gif")
+        apng_path = os.path.join(self.output_dir.name, "out.png")
+        raw = io.BytesIO()
+        with GIFWriter(gif_path, frames.palette, width, height) as gif, \
+             APNGWriter(apng_path, frames.palette, width, height) as apng, \
+             RawWriter(raw, frames.palette) as raw_writer:
+            for frame, box in frames:
+                for writer in (gif, apng, raw_writer):
+                    writer.write_frame(frame, box)
+        
+        raw_frames = np.frombuffer(raw.getvalue(), dtype=np.uint8).reshape(-1, height, width, 3)
+        self.assertTrue(np.array_equal(raw_frames, np.array(expected)))
+        for path in (gif_path, apng_path):
+            with Image.open(path) as animation:
+                self.assertEqual(animation.n_frames, len(expected))
+                for ii, image in enumerate(expected):
+                    animation.seek(ii)
+                    self.assertTrue(np.array_equal(np.array(animation.convert("RGB")), image))
+
+
+class StreamTest(ut.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.TemporaryDirectory()
+    
+    def tearDown(self):
+        self.output_dir.cleanup()
+    
+    def test_tick_stream(self):
+        async def collect(board):
+            return [(tick, changed) async for tick, changed in tick_stream(board, 6)]
+        RB = ResoBoard("../examples/clocks.png")
+        RB_expected = ResoBoard("../examples/clocks.png")
+        state = RB_expected.get_wire_states()
+        for ii, (tick, changed) in enumerate(asyncio.run(collect(RB))):
+            RB_expected.iterate()
+            self.assertEqual(tick, ii + 1)
+            state[changed] ^= True
+            self.assertTrue(np.array_equal(state, RB_expected.get_wire_states()))
+        self.assertEqual(tick, 6)
+    
+    def test_server(self):
+        # A fast and a slow client both end up with the right state, and the
+        # slow one is sent fewer messages, covering every tick between them.
+        async def follow(slow, **address):
+            state, ticks, messages = None, 0, 0
+            async for message in subscribe(**address):
+                if "on" in message:
+                    state = np.zeros(message["wires"], dtype=bool)
+                    state[message["on"]] = True
+                elif "changed" in message:
+                    state[message["changed"]] ^= True
+                    ticks += message["dropped"] + 1
+                    messages += 1
+                if slow:
+                    await asyncio.sleep(0.05)
+            return state, message["tick"], ticks, messages
+        
+        async def serve(**address):
+            async with TickServer(RB, max_fps = 200, **address) as server:
+                address = dict(path = server.address) if "path" in address else dict(port = server.address[1])
+                clients = [asyncio.ensure_future(follow(slow, **address)) for slow in (False, True)]
+                while len(server._clients) < 2:
+                    await asyncio.sleep(0.01)
+                await server.run(100)
+                return [await client for client in clients]
+        
+        RB_expected = ResoBoard("../examples/clocks.png")
+        RB_expected.run(200)
+        for address in (dict(path = os.path.join(self.output_dir.name, "reso.sock")), dict(port = 0)):
+            RB = ResoBoard("../examples/clocks.png", engine = "numpy")
+            RB.run(100)
+            (fast_state, fast_tick, fast_ticks, fast_messages), \
+                (slow_state, slow_tick, slow_ticks, slow_messages) = asyncio.run(serve(**address))
+            for state, tick, ticks in ((fast_state, fast_tick, fast_ticks), (slow_state, slow_tick, slow_ticks)):
+                self.assertTrue(np.array_equal(state, RB_expected.get_wire_states()))
+                self.assertEqual(tick, 100)
+                self.assertEqual(ticks, 100)
+            self.assertLess(slow_messages, 100)
+    
+    def test_not_with_other_streams(self):
+        with self.assertRaises(ValueError):
+            main("testing/test_05_01.png", None, 2, serve = "0", raw = True)
+        with self.assertRaises(ValueError):
+            main("testing/test_05_01.png", None, 2, serve = "0",
+                 trace = os.path.join(self.output_dir.name, "out.trace"))
+    
+    def test_bad_rates(self):
+        RB = ResoBoard("testing/test_05_01.png")
+        with self.assertRaises(ValueError):
+            TickServer(RB, max_fps = 0)
+        with self.assertRaises(ValueError):
+            asyncio.run(tick_stream(RB, 1, ticks_per_second = 0).__anext__())
+
+
+class TraceTest(ut.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.output_dir.name, "out.trace")
+    
+    def tearDown(self):
+        self.output_dir.cleanup()
+    
+    def test_frames(self):
+        RB = ResoBoard("testing/test_03_01.png")
+        expected = [RB.get_image().copy()]
+        for _ in range(10):
+            RB.iterate()
+            expected.append(RB.get_image().copy())
+        
+        for compress in (True, False):
+            write_trace(ResoBoard("testing/test_03_01.png", engine="numpy"), 10, self.path,
+                        compress=compress, block_size=3)
+            with TraceReader(self.path) as trace:
+                self.assertEqual(trace.num_frames, 11)
+                # Out of order, across blocks
+                for frame in (10, 0, 4, 3, 5, 9, 1):
+                    self.assertTrue(np.array_equal(trace.frame(frame), expected[frame]))
+                with self.assertRaises(IndexError):
+                    trace.frame(11)
+    
+    def test_not_with_animation(self):
+        # Only one of them would be written.
+        with self.assertRaises(ValueError):
+            main("testing/test_05_01.png", None, 2, trace = self.path,
+                 animation = self.path + ".gif")
+        with self.assertRaises(ValueError):
+            main("testing/test_05_01.png", None, 2, trace = self.path, raw = True)
+    
+    def test_truncated(self):
+        RB = ResoBoard("testing/test_05_01.png")
+        with TraceWriter(self.path, RB, block_size=4) as trace:
+            for _ in range(10):
+                trace.write(RB.get_wire_states())
+                RB.iterate()
+        with open(self.path, "rb") as f:
+            data = f.read()
+        with open(self.path, "wb") as f:
+            f.write(data[:-1])
+        # The last, partial, block is lost
+        with TraceReader(self.path) as trace:
+            self.assertEqual(trace.num_frames, 8)
+        
+        with open(self.path, "wb") as f:
+            f.write(b"not a trace")
+        with self.assertRaises(ValueError):
+            TraceReader(self.path)
+
+
+class ProfilerTest(ut.TestCase):
+    def test_phases_and_stages(self):
+        profiler = Profiler()
+        for _ in range(3):
+            with profiler.phase("tick"):
+                with profiler.phase("tick.logic"):
+                    pass
+        profiler.add("compile", 2.0)
+        profiler.add("compile.objects", 1.0)
+        self.assertEqual(profiler.phases["tick"][1], 3)
+        self.assertEqual(profiler.phases["tick.logic"][1], 3)
+        stages = profiler.stage_seconds()
+        # Nested phases are only counted once
+        self.assertEqual(stages["compile"], 2.0)
+        self.assertEqual(stages["tick"], profiler.phases["tick"][0])
+        self.assertEqual(profiler.report()["bound"], "compile")
+        
+        profiler.histogram("fanout", np.array([0, 2, 2, 5]))
+        profiler.histogram("fanout", np.array([2]))
+        self.assertEqual(profiler.histograms["fanout"], {0 : 1, 2 : 3, 5 : 1})
+        out = io.StringIO()
+        profiler.write_json(out)
+        self.assertEqual(json.loads(out.getvalue())["histograms"]["fanout"], {"0" : 1, "2" : 3, "5" : 1})
+    
+    def test_profiled_board(self):
+        for engine in ("object", "numpy", "event"):
+            profiler = Profiler()
+            RB = ResoBoard("testing/test_05_01.png", engine=engine, profiler=profiler)
+            RB_plain = ResoBoard("testing/test_05_01.png", engine=engine)
+            RB.run(3)
+            RB.iterate()
+            RB_plain.run(3)
+            RB_plain.iterate()
+            self.assertTrue(np.array_equal(RB.get_image(), RB_plain.get_image()))
+            
+            report = profiler.report()
+            for phase in ("load.decode", "compile", "compile.label_regions",
+                          "compile.adjacency", "compile.state", "compile.netlist",
+                          "tick", "tick.logic", "tick.wires", "render"):
+                self.assertIn(phase, report["phases"])
+            # Only the "object" engine needs its adjacency dicts
+            self.assertEqual("compile.objects" in report["phases"], engine == "object")
+            self.assertEqual(report["phases"]["tick"]["calls"], 4)
+            counters = report["counters"]
+            self.assertEqual(counters["regions.total"], RB._RM.num_regions())
+            self.assertEqual(counters["regions.orange_wire"], len(RB._orange_wires))
+            self.assertEqual(counters.get("regions.xor", 0), len(RB._xors))
+            self.assertEqual(counters["edges.wire_input"], len(RB._netlist.wire_input_src))
+            # Every wire is in the fan-out histogram once
+            self.assertEqual(sum(report["histograms"]["fanout.wire_input"].values()), len(RB._wires))
+
+
+class BenchmarkTest(ut.TestCase):
+    def test_generators(self):
+        for name, generator in GENERATORS.items():
+            image = generator(50, 37)
+            self.assertEqual(image.shape, (50, 37, 3))
+            RB = ResoBoard(image)
+            self.assertGreater(len(RB._wires), 0, name)
+    
+    def test_adders_add(self):
+        RB = ResoBoard(adder_array(96, 32, seed=1), engine="numpy")
+        RB.run(20)
+        resels = RB.get_resel_map()
+        for x in range(0, 96, 24):
+            for y in range(0, 32, 8):
+                a, b, carry_in = resels[x+2,y+1] == pO, resels[x,y+3] == pS, resels[x+2,y+5] == pL
+                total = int(a) + int(b) + int(carry_in)
+                self.assertEqual(resels[x+19,y+1] == pO, total % 2 == 1)
+                self.assertEqual(resels[x+20,y+5] == pS, total >= 2)
+    
+    def test_rings(self):
+        # 4 buffers forward and 4 back
+        RB = ResoBoard(clock_rings(70, 20, stages=4), engine="numpy")
+        RB.run(50, detect_cycles=True)
+        self.assertEqual(RB.get_cycle(), (0, 8))
+        # Rings of inverters never settle
+        RB = ResoBoard(gate_chains(60, 30, gates="T"), engine="numpy")
+        RB.run(100)
+        before = RB.get_wire_states()
+        RB.run(1)
+        self.assertFalse(np.array_equal(before, RB.get_wire_states()))
+    
+    def test_benchmark(self):
+        results = benchmark(("clock_rings", "adders"), sizes=(32, 48), ticks=3, repeat=1)
+        self.assertEqual(len(results["results"]), 4)
+        for result in results["results"]:
+            for metric in ("seconds.region_mapper", "seconds.compile", "seconds.tick.numpy",
+                           "seconds.render", "bytes.compile", "bytes.tick"):
+                self.assertIn(metric, result["metrics"])
+        self.assertIn("seconds.compile", scaling(results)["adders"])
+        # Results survive a round trip through JSON, and compare to themselves
+        results = json.loads(json.dumps(results))
+        self.assertTrue(all(row[-1] == 1.0 for row in compare(results, results) if row[3] > 0))
+
+
+class ParallelTest(ut.TestCase):
+    def test_cones(self):
+        RB = ResoBoard(adder_array(72, 40, seed=2), engine="numpy")
+        netlist, state = RB._netlist, RB._wire_state
+        parts = partition_wires(netlist, 4)
+        self.assertEqual(sorted(np.concatenate(parts).tolist()), list(range(netlist.num_wires)))
+        # Each cone gives the exact next state of its own wires
+        for part in parts:
+            cone, cone_wires, owned = netlist.cone(part)
+            self.assertTrue(np.array_equal(cone.step(state[cone_wires])[owned], netlist.step(state)[part]))
+    
+    def test_simulator(self):
+        RB = ResoBoard(gate_chains(60, 50, gates="Tt"), engine="numpy")
+        netlist, state = RB._netlist, RB._wire_state
+        with ParallelSimulator(netlist, state, processes = 3) as simulator:
+            self.assertEqual(len(simulator.parts), 3)
+            for _ in range(5):
+                state = netlist.step(state)
+                simulator.run()
+                self.assertTrue(np.array_equal(simulator.get_state(), state))
+            for _ in range(20):
+                state = netlist.step(state)
+            simulator.run(20)
+            self.assertTrue(np.array_equal(simulator.get_state(), state))
+        with self.assertRaises(ValueError):
+            ParallelSimulator(netlist, state, parts = [np.arange(3)])
+    
+    def test_several_simulators(self):
+        # Simulators started and stopped while another one runs don't disturb it.
+        RB = ResoBoard("testing/test_05_01.png", engine="numpy")
+        netlist, state = RB._netlist, RB._wire_state
+        with ParallelSimulator(netlist, state, processes = 1) as simulator:
+            for _ in range(3):
+                other = ParallelSimulator(netlist, state, processes = 1)
+                other.run(2)
+                state = netlist.step(netlist.step(state))
+                simulator.run(2)
+                self.assertTrue(np.array_equal(simulator.get_state(), state))
+                other.close()
+    
+    def test_parallel_engine(self):
+        for fn in ("testing/test_05_01.png", "testing/test_03_01.png"):
+            RB_numpy = ResoBoard(fn, engine="numpy")
+            with ResoBoard(fn, engine="parallel", processes=2) as RB:
+                for _ in range(3):
+                    RB.iterate()
+                    RB_numpy.iterate()
+                    self.assertTrue(np.array_equal(RB.get_image(), RB_numpy.get_image()))
+                self.assertTrue(np.array_equal(RB.run(4, record = True), RB_numpy.run(4, record = True)))
+                RB.run(7)
+                RB_numpy.run(7)
+                self.assertTrue(np.array_equal(RB.get_image(), RB_numpy.get_image()))
+                self.assertEqual([wire.state for wire in RB._wires], [wire.state for wire in RB_numpy._wires])
+
+
+class BatchTest(ut.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+    
+    def tearDown(self):
+        self.dir.cleanup()
+    
+    def test_expand_boards(self):
+        boards = expand_boards(["testing/test_05_0*.png", "testing/test_05_01.png"])
+        self.assertEqual(boards, [f"testing/test_05_0{ii}.png" for ii in range(1, 7)])
+        manifest = os.path.join(self.dir.name, "boards.txt")
+        with open(manifest, "w") as f:
+            f.write("# Regression set\n\n" + os.path.abspath("testing/test_03_01.png") + "\n")
+        self.assertEqual(expand_boards([], manifest), [os.path.abspath("testing/test_03_01.png")])
+        with self.assertRaises(ValueError):
+            expand_boards(["testing/no_such_board_*.png"])
+        self.assertEqual(board_prefixes(["a/and.png", "b/and.png", "or.png"], "out/"),
+                         ["out/and_0_", "out/and_1_", "out/or_"])
+    
+    def test_run_batch(self):
+        boards = ["testing/test_05_01.png", "testing/no_such_board.png", "testing/test_03_01.png"]
+        prefix = os.path.join(self.dir.name, "")
+        report = run_batch(boards, prefix, iterations = 4, processes = 2)
+        self.assertEqual([summary["file"] for summary in report["boards"]], boards)
+        self.assertEqual(report["total"]["failed"], 1)
+        self.assertIn("error", report["boards"][1])
+        # Every board is simulated just as it would be on its own
+        for summary in (report["boards"][0], report["boards"][2]):
+            RB = ResoBoard(summary["file"])
+            RB.run(4)
+            self.assertEqual(summary["wires_on"], int(RB.get_wire_states().sum()))
+            name = os.path.splitext(os.path.basename(summary["file"]))[0]
+            saved = np.swapaxes(np.array(Image.open(f"{prefix}{name}_4.png"))[:, :, :3], 0, 1)
+            self.assertTrue(np.array_equal(saved, RB.get_image()))
+        # The report is the same in one process
+        report_1 = run_batch(boards, iterations = 4, processes = 1)
+        self.assertEqual([summary.get("state_hash") for summary in report["boards"]],
+                         [summary.get("state_hash") for summary in report_1["boards"]])
+        json.dumps(report)
+
+
 all_tests = [DefaultPaletteTests,
-             ResoBoardInitTest]
+             ResoBoardInitTest,
+             ResoBoardEngineTest,
+             JitTest,
+             ResoBoardRunTest,
+             ResoBoardCacheTest,
+             LargeBoardLoadingTest,
+             ResoBoardPatchTest,
+             PNGWriterPoolTest,
+             IndexedImageTest,
+             AnimationOutputTest,
+             StreamTest,
+             TraceTest,
+             ProfilerTest,
+             BenchmarkTest,
+             ParallelTest,
+             BatchTest]
 
 
 for test in all_tests:
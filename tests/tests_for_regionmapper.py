@@ -1,8 +1,9 @@
 from PIL import Image
+import tempfile
 import unittest as ut
 import numpy as np
 
-from reso.regionmapper import RegionMapper, ortho_map, diag_map
+from reso.regionmapper import RegionMapper, ortho_map, diag_map, _map_to_classes
 
 class RegionMapperTest_OrthoNbhd_NoWrap(ut.TestCase):
     def setUp(self):
@@ -115,9 +116,180 @@ class RegionMapperTest_OrthoNbhd_NoWrap(ut.TestCase):
         self.assertEqual(set(self.Mapped.adjacent_regions(reg5)), set([reg2,reg3]))
         self.assertEqual(self.Mapped.adjacent_regions(reg6), [reg3])
 
+    def test_adjacency_csr(self):
+        # adjacent_regions should read straight out of the CSR arrays
+        indptr, indices = self.Mapped.adjacency()
+        self.assertEqual(len(indptr), self.Mapped.num_regions() + 1)
+        for region_id in range(self.Mapped.num_regions()):
+            self.assertEqual(indices[indptr[region_id]:indptr[region_id+1]].tolist(),
+                             self.Mapped.adjacent_regions(region_id))
 
 
-all_tests = [RegionMapperTest_OrthoNbhd_NoWrap]
+    def test_labels(self):
+        # The label array and the per-region pixel indices should agree
+        # with region_at_pixel and regions.
+        labels = self.Mapped.labels()
+        self.assertEqual(labels.dtype, np.int32)
+        self.assertEqual(labels[1,0], -1)
+        for region_id in range(self.Mapped.num_regions()):
+            class_number, list_of_pixels = self.Mapped.regions(region_id)
+            self.assertEqual(self.Mapped.region_class(region_id), class_number)
+            xs, ys = np.unravel_index(self.Mapped.region_pixel_indices(region_id), labels.shape)
+            self.assertEqual(set(zip(xs.tolist(), ys.tolist())), set(list_of_pixels))
+            for x, y in list_of_pixels:
+                self.assertEqual(labels[x,y], region_id)
+
+
+class RegionMapperTest_Wrap(ut.TestCase):
+    def setUp(self):
+        # Two columns of class 1 at the left and right edges,
+        # and a diagonally-contiguous class 2 line that crosses the top edge.
+        self.pic = np.array([[1, 0, 0, 2],
+                             [0, 0, 0, 0],
+                             [0, 2, 0, 0],
+                             [1, 0, 0, 0]])
+        self.classes = { 1 : 1, 2 : 2 }
+        self.contiguity_map = { 2 : diag_map }
+
+    def test_no_wrap(self):
+        Mapped = RegionMapper(self.pic, self.classes, self.contiguity_map)
+        self.assertEqual(Mapped.num_regions(), 4)
+        self.assertNotEqual(Mapped.region_at_pixel(0,0), Mapped.region_at_pixel(3,0))
+        self.assertNotEqual(Mapped.region_at_pixel(0,3), Mapped.region_at_pixel(2,1))
+        self.assertEqual(Mapped.adjacent_regions(Mapped.region_at_pixel(0,0)), [])
+
+    def test_wrap(self):
+        Mapped = RegionMapper(self.pic, self.classes, self.contiguity_map, wrap=True)
+        self.assertEqual(Mapped.num_regions(), 3)
+        # (0,0) and (3,0) touch across the left/right edge
+        self.assertEqual(Mapped.region_at_pixel(0,0), Mapped.region_at_pixel(3,0))
+        # (0,3) -> (3,0) is a diagonal step across both edges, but (2,1) is
+        # not diagonally adjacent to either of them.
+        self.assertNotEqual(Mapped.region_at_pixel(0,3), Mapped.region_at_pixel(2,1))
+        # (0,3) and (0,0) are orthogonally adjacent across the top/bottom edge
+        self.assertEqual(Mapped.adjacent_regions(Mapped.region_at_pixel(0,3)),
+                         [Mapped.region_at_pixel(0,0)])
+
+
+class MapToClassesTest(ut.TestCase):
+    def setUp(self):
+        self.pic = np.swapaxes(np.array(Image.open("testing/region_mapper_test_image.png"))[:,:,:3], 0, 1)
+        self.classes = { (255,0,0) : 1, (0,255,0) : 2, (0,0,255) : 3 }
+
+    def test_matches_dict_lookup(self):
+        classes = _map_to_classes(self.classes, self.pic)
+        self.assertEqual(classes.dtype, np.uint8)
+        for x in range(self.pic.shape[0]):
+            for y in range(self.pic.shape[1]):
+                self.assertEqual(classes[x,y], self.classes.get(tuple(self.pic[x,y]), 0))
+
+    def test_out_and_chunks(self):
+        import reso.regionmapper as regionmapper
+        expected = _map_to_classes(self.classes, self.pic, dtype=np.int64)
+        chunk_pixels = regionmapper._CHUNK_PIXELS
+        regionmapper._CHUNK_PIXELS = 5
+        try:
+            out = np.full(self.pic.shape[:2], 7, dtype=np.uint16)
+            self.assertIs(_map_to_classes(self.classes, self.pic, out=out), out)
+        finally:
+            regionmapper._CHUNK_PIXELS = chunk_pixels
+        self.assertTrue(np.array_equal(out, expected))
+        # Scalar images map through a lookup table.
+        scalar = np.array([[0, 1], [2, 3]], dtype=np.uint8)
+        self.assertEqual(_map_to_classes({1 : 5, 3 : 300}, scalar, default=9).tolist(),
+                         [[9, 5], [9, 300]])
+
+
+class TiledRegionMapperTest(ut.TestCase):
+    def test_same_as_untiled(self):
+        # Random images, with a diagonally-contiguous class, labelled in strips
+        # of a few rows; also with tiny sort batches, for regions spanning strips.
+        import reso.regionmapper as regionmapper
+        rng = np.random.default_rng(1)
+        contiguities = { 1 : ortho_map + diag_map, 3 : diag_map }
+        chunk_pixels = regionmapper._CHUNK_PIXELS
+        try:
+            for ii in range(40):
+                regionmapper._CHUNK_PIXELS = 2**20 if ii % 2 else 8
+                width, height = rng.integers(1, 25, 2)
+                image = rng.integers(0, 4, (width, height)).astype(np.uint8)
+                class_dict = { 1 : 1, 2 : 2, 3 : 3 }
+                expected = RegionMapper(image, class_dict, contiguities)
+                with tempfile.TemporaryDirectory() as memmap_dir:
+                    tiled = RegionMapper(image, class_dict, contiguities,
+                                         strip_pixels = int(rng.integers(1, 100)),
+                                         memmap_dir = memmap_dir if ii % 3 == 0 else None)
+                    for name, array in expected.to_arrays().items():
+                        self.assertTrue(np.array_equal(array, tiled.to_arrays()[name]), name)
+        finally:
+            regionmapper._CHUNK_PIXELS = chunk_pixels
+
+    def test_bad_arguments(self):
+        image = np.zeros((3, 3), dtype=np.uint8)
+        with self.assertRaises(ValueError):
+            RegionMapper(image, {}, strip_pixels = 0)
+        with self.assertRaises(ValueError):
+            RegionMapper(image, {}, strip_pixels = 4, wrap = True)
+
+
+class ApplyPatchTest(ut.TestCase):
+    def assertSameRegions(self, patched, mapped):
+        # The same regions and adjacencies, though maybe with other IDs.
+        labels, expected_labels = patched.labels(), mapped.labels()
+        self.assertTrue(np.array_equal(labels < 0, expected_labels < 0))
+        self.assertEqual(patched.num_regions(), mapped.num_regions())
+        id_map = np.full(patched.num_regions(), -1)
+        id_map[labels[labels >= 0]] = expected_labels[labels >= 0]
+        self.assertEqual(sorted(id_map.tolist()), list(range(mapped.num_regions())))
+        for region_id in range(patched.num_regions()):
+            self.assertEqual(patched.region_class(region_id), mapped.region_class(id_map[region_id]))
+            self.assertTrue(np.array_equal(patched.region_pixel_indices(region_id),
+                                           mapped.region_pixel_indices(id_map[region_id])))
+            self.assertEqual(sorted(id_map[patched.adjacent_regions(region_id)].tolist()),
+                             mapped.adjacent_regions(id_map[region_id]))
+
+    def test_same_as_mapping_again(self):
+        rng = np.random.default_rng(2)
+        class_dict = { 1 : 1, 2 : 2, 3 : 3 }
+        contiguities = { 1 : ortho_map + diag_map, 3 : diag_map }
+        adjacencies = { 2 : ortho_map + diag_map }
+        for ii in range(30):
+            wrap = ii % 3 == 0
+            width, height = rng.integers(1, 16, 2)
+            image = rng.integers(0, 4, (width, height)).astype(np.uint8)
+            Mapped = RegionMapper(image, class_dict, contiguities, adjacencies, wrap = wrap)
+            for _ in range(3):
+                patch_width, patch_height = rng.integers(1, width + 1), rng.integers(1, height + 1)
+                x, y = rng.integers(0, width - patch_width + 1), rng.integers(0, height - patch_height + 1)
+                patch = rng.integers(0, 4, (patch_width, patch_height)).astype(np.uint8)
+                old_pixels = [Mapped.region_pixel_indices(ii).copy() for ii in range(Mapped.num_regions())]
+                old_adjacent = [Mapped.adjacent_regions(ii) for ii in range(Mapped.num_regions())]
+                new_id_of_old, new_regions, adjacent_changed = Mapped.apply_patch(x, y, patch)
+                image[x:x + patch_width, y:y + patch_height] = patch
+                self.assertSameRegions(Mapped, RegionMapper(image, class_dict, contiguities, adjacencies, wrap = wrap))
+                # Kept regions keep their pixels.
+                for old_id, new_id in enumerate(new_id_of_old.tolist()):
+                    if new_id >= 0:
+                        self.assertNotIn(new_id, new_regions)
+                        self.assertTrue(np.array_equal(old_pixels[old_id], Mapped.region_pixel_indices(new_id)))
+                # Regions that aren't in adjacent_changed list the same regions.
+                self.assertTrue(set(new_regions.tolist()) <= set(adjacent_changed.tolist()))
+                for old_id, new_id in enumerate(new_id_of_old.tolist()):
+                    if new_id >= 0 and new_id not in adjacent_changed:
+                        self.assertEqual(sorted(new_id_of_old[old_adjacent[old_id]].tolist()),
+                                         sorted(Mapped.adjacent_regions(new_id)))
+
+    def test_patch_outside(self):
+        Mapped = RegionMapper(np.ones((4, 4), dtype=np.uint8), { 1 : 1 })
+        with self.assertRaises(ValueError):
+            Mapped.apply_patch(3, 0, np.ones((2, 2), dtype=np.uint8))
+
+
+all_tests = [RegionMapperTest_OrthoNbhd_NoWrap,
+             RegionMapperTest_Wrap,
+             MapToClassesTest,
+             TiledRegionMapperTest,
+             ApplyPatchTest]
 
 for test in all_tests:
     ut.TextTestRunner(verbosity=2).run(ut.TestLoader().loadTestsFromTestCase(test))